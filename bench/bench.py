@@ -0,0 +1,314 @@
+#!/usr/bin/env python
+#
+# headless benchmarks of the editor. MainGUI runs against a fake screen that
+# takes the rendered canvas the way a terminal screen would but doesn't write
+# it anywhere, and every benchmark is a script of key presses with a redraw
+# after each one, like the main loop does:
+#
+#   python bench/bench.py                      run everything
+#   python bench/bench.py scroll find          run only these
+#   python bench/bench.py --save base.json     keep the results as a baseline
+#   python bench/bench.py --compare base.json  fail if anything got slower
+#
+# each benchmark is timed a few times and the fastest run counts, then run
+# once more under tracemalloc for the most memory it had allocated at once.
+
+import argparse
+import gc
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(HERE), 'scum'))
+
+# the session journal and the caches go to a scratch directory instead of the user's
+SCRATCH = tempfile.mkdtemp(prefix='scum-bench-')
+os.environ['XDG_STATE_HOME'] = os.path.join(SCRATCH, 'state')
+os.environ['XDG_CACHE_HOME'] = os.path.join(SCRATCH, 'cache')
+
+import urwid
+import main as scum
+
+COLS, ROWS = 120, 40
+BENCHMARKS = [] # (name, description, setup)
+
+
+class BenchScreen(urwid.BaseScreen):
+    """A screen that goes through every row of the canvas but has no terminal"""
+
+    def __init__(self):
+        super().__init__()
+        self.colors = 256
+
+    def get_cols_rows(self):
+        return COLS, ROWS
+
+    def set_terminal_properties(self, colors=None, bright_is_bold=None, has_underline=None):
+        if colors is not None:
+            self.colors = colors
+
+    def draw_screen(self, size, canvas):
+        for row in canvas.content():
+            for attr, cs, text in row:
+                pass
+
+
+def benchmark(name, description):
+    # setup(tmp) prepares everything that isn't timed and returns the function that is
+    def register(setup):
+        BENCHMARKS.append((name, description, setup))
+        return setup
+    return register
+
+
+def make_gui(files=()):
+    gui = scum.MainGUI()
+    gui.loop = scum.BatchLoop(gui.pile, gui.palette, handle_mouse=False,
+                              unhandled_input=gui.keypress, pop_ups=True,
+                              screen=BenchScreen(), batch=gui.batch_input,
+                              bound=gui.bound_keys)
+    gui.register_palette()
+    # syntax highlighting is done by a worker thread like in the editor (see
+    # MainGUI.display), whatever it finished is picked up before every frame
+    gui.worker_pipe, pipe = os.pipe()
+    os.set_blocking(gui.worker_pipe, False)
+    gui.worker = scum.HighlightWorker(pipe)
+    for fname in files:
+        gui.listbox.populate(fname)
+    draw(gui)
+    return gui
+
+
+def draw(gui):
+    try:
+        data = os.read(gui.worker_pipe, 65536)
+    except BlockingIOError:
+        data = b''
+    if data:
+        gui.highlight_done(data)
+    gui.loop.draw_screen()
+
+
+def press(gui, *keys):
+    for key in keys:
+        gui.loop.process_input([key])
+        draw(gui)
+
+
+def burst(gui, keys, size):
+    # keys as they come in when they repeat faster than a frame, size at a time
+    for i in range(0, len(keys), size):
+        gui.loop.process_input(keys[i:i + size])
+        draw(gui)
+
+
+def write_python(fname, lines):
+    # source code that gives the lexer something to do
+    with open(fname, 'w') as f:
+        for i in range(lines):
+            if i % 10 == 0:
+                f.write('def function_%d(value, *args):\n' % i)
+            elif i % 10 == 9:
+                f.write('    return "done %d"  # finished\n' % i)
+            else:
+                f.write('    value = value * %d + len(args)  # step\n' % i)
+    return fname
+
+
+@benchmark('open', 'open a 100k line file and draw it')
+def bench_open(tmp):
+    fname = write_python(os.path.join(tmp, 'open.py'), 100000)
+    gui = make_gui()
+
+    def run():
+        gui.listbox.populate(fname)
+        draw(gui)
+    return run
+
+
+@benchmark('scroll', 'page down 300 times through a 1M line file')
+def bench_scroll(tmp):
+    gui = make_gui([write_python(os.path.join(tmp, 'scroll.py'), 1000000)])
+
+    def run():
+        press(gui, *['page down'] * 300)
+    return run
+
+
+@benchmark('type', 'type 300 characters at the end of a 20k character line')
+def bench_type(tmp):
+    fname = os.path.join(tmp, 'long.py')
+    with open(fname, 'w') as f:
+        f.write('x = "' + 'abcdefghij' * 2000 + '"\n')
+    gui = make_gui([fname])
+    gui.listbox.focus.set_edit_pos(len(gui.listbox.focus.edit_text))
+
+    def run():
+        press(gui, *'the quick brown fox jumps over the lazy dog ' * 7)
+    return run
+
+
+@benchmark('burst', 'type 600 characters and move 6000 times in bursts of 20 keys')
+def bench_burst(tmp):
+    gui = make_gui([write_python(os.path.join(tmp, 'burst.py'), 1000000)])
+
+    def run():
+        burst(gui, list('the quick brown fox jumps over the lazy dog ') * 14, 20)
+        burst(gui, ['down'] * 2000 + ['left'] * 2000 + ['up'] * 2000, 20)
+    return run
+
+
+@benchmark('paste', 'paste a 10k line block in the middle of a file and undo it')
+def bench_paste(tmp):
+    # plain text, so this times the paste and not the worker lexing the pasted lines
+    gui = make_gui([write_python(os.path.join(tmp, 'paste.txt'), 100000)])
+    press(gui, *['down'] * 30)
+    block = ''.join(open(write_python(os.path.join(tmp, 'block.py'), 10000)).readlines())
+    keys = ['begin paste'] + [{'\n': 'enter'}.get(ch, ch) for ch in block] + ['end paste']
+
+    def run():
+        gui.loop.process_input(keys)
+        draw(gui)
+        press(gui, gui.config['undo'])
+    return run
+
+
+@benchmark('tabs', 'switch through 50 open tabs 4 times')
+def bench_tabs(tmp):
+    files = [write_python(os.path.join(tmp, 'tab%d.py' % i), 2000) for i in range(50)]
+    gui = make_gui(files)
+
+    def run():
+        press(gui, *[gui.config['nexttab']] * 200)
+    return run
+
+
+@benchmark('find', 'search a 1M line file and step through the matches')
+def bench_find(tmp):
+    gui = make_gui([write_python(os.path.join(tmp, 'find.py'), 1000000)])
+
+    def run():
+        press(gui, gui.config['find'])
+        press(gui, *'value * 5')
+        press(gui, *['right'] * 100)
+        press(gui, gui.config['find'])
+    return run
+
+
+@benchmark('undo', 'undo and redo 500 edits')
+def bench_undo(tmp):
+    gui = make_gui([write_python(os.path.join(tmp, 'undo.py'), 10000)])
+    for i in range(500):
+        # moving away seals the action so each edit is its own undo step
+        press(gui, 'x', 'down')
+    undo, redo = gui.config['undo'], gui.config['redo']
+
+    def run():
+        press(gui, *[undo] * 500)
+        press(gui, *[redo] * 500)
+    return run
+
+
+@benchmark('save', 'edit and save a 1M line file')
+def bench_save(tmp):
+    gui = make_gui([write_python(os.path.join(tmp, 'save.py'), 1000000)])
+
+    def run():
+        press(gui, 'x', gui.config['save'])
+        # big files are saved in the background, the benchmark waits for it
+        for save in list(gui.saves.values()):
+            save.thread.join()
+            gui.save_done(save)
+        draw(gui)
+    return run
+
+
+def measure(setup, repeat):
+    # (fastest time in seconds, peak traced memory in bytes)
+    times = []
+    for i in range(repeat):
+        tmp = tempfile.mkdtemp(dir=SCRATCH)
+        try:
+            run = setup(tmp)
+            gc.collect()
+            start = time.perf_counter()
+            run()
+            times.append(time.perf_counter() - start)
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    tmp = tempfile.mkdtemp(dir=SCRATCH)
+    try:
+        run = setup(tmp)
+        gc.collect()
+        tracemalloc.start()
+        run()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+    return min(times), peak
+
+
+def compare(results, baseline, threshold):
+    # the names of the benchmarks that got slower than threshold allows
+    slower = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        ratio = result['seconds'] / base['seconds'] if base['seconds'] else 1
+        mem = result['peak'] / base['peak'] if base['peak'] else 1
+        flag = ''
+        if ratio > 1 + threshold:
+            flag = '  SLOWER'
+            slower.append(name)
+        print('%-8s %8.1f ms  was %8.1f ms  %5.2fx  memory %5.2fx%s' % (
+            name, result['seconds'] * 1000, base['seconds'] * 1000, ratio, mem, flag))
+    return slower
+
+
+def main():
+    parser = argparse.ArgumentParser(description='headless benchmarks of the scum editor')
+    parser.add_argument('names', nargs='*', help='benchmarks to run (default: all of them)')
+    parser.add_argument('--repeat', type=int, default=3, help='timed runs of each benchmark')
+    parser.add_argument('--save', metavar='FILE', help='write the results to FILE as a baseline')
+    parser.add_argument('--compare', metavar='FILE', help='compare the results with a baseline')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='how much slower than the baseline counts as a regression (0.2 = 20%%)')
+    args = parser.parse_args()
+
+    known = [name for name, description, setup in BENCHMARKS]
+    for name in args.names:
+        if name not in known:
+            parser.error('no benchmark called %s (there is %s)' % (name, ', '.join(known)))
+
+    results = {}
+    for name, description, setup in BENCHMARKS:
+        if args.names and name not in args.names:
+            continue
+        seconds, peak = measure(setup, args.repeat)
+        results[name] = {'seconds': seconds, 'peak': peak}
+        print('%-8s %8.1f ms %8.1f MB  %s' % (name, seconds * 1000, peak / 2**20, description))
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        print()
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    try:
+        main()
+    finally:
+        shutil.rmtree(SCRATCH, ignore_errors=True)
@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 
 import urwid
+import collections
 import os
 import re
 import signal
@@ -8,100 +9,27 @@ import string
 #from scum.modules import *
 from modules import *
 
-import pygments.util
-from pygments.lexers import guess_lexer_for_filename, get_lexer_for_filename
-from pygments.lexers.special import TextLexer
-from pygments.lexers.python import PythonLexer, Python3Lexer
-from pygments.token import Token
-from pygments.filter import Filter
-from pygments.styles import get_style_by_name
-
-from pkg_resources import resource_filename
 
 RE_WORD = re.compile(r'\w+')
 RE_NOT_WORD = re.compile(r'\W+')
 
+# the name of the tab find in files puts its results in
+RESULTS_TAB = 'find in files'
 
-try:
-    CONFIG_PATH = os.path.abspath(resource_filename('scum.resources', 'config.txt'))
-    HELP_PATH = os.path.abspath(resource_filename('scum.resources', 'help.txt'))
-    TABS_PATH = os.path.abspath(resource_filename('scum.resources', 'tabs.dat'))
-    START_PATH = os.path.abspath(resource_filename('scum.resources', 'start_up.txt'))
 
-except:
-    CONFIG_PATH = os.path.abspath(resource_filename('resources', 'config.txt'))
-    HELP_PATH = os.path.abspath(resource_filename('resources', 'help.txt'))
-    TABS_PATH = os.path.abspath(resource_filename('resources', 'tabs.dat'))
-    START_PATH = os.path.abspath(resource_filename('resources', 'start_up.txt'))
+# the resources are installed next to this file, finding them with pkg_resources
+# would mean scanning every installed package on each start up
+RESOURCES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'resources')
+CONFIG_PATH = os.path.join(RESOURCES, 'config.txt')
+HELP_PATH = os.path.join(RESOURCES, 'help.txt')
+TABS_PATH = os.path.join(RESOURCES, 'tabs.dat')
+START_PATH = os.path.join(RESOURCES, 'start_up.txt')
 
-CONFIG = {
-    'short_to_rgb': {  # color look-up table for 8-bit to RGB hex
-        # Primary 3-bit (8 colors). Unique representation!
-        '00': '000000', '01': '800000', '02': '008000', '03': '808000', '04': '000080',
-        '05': '800080', '06': '008080', '07': 'c0c0c0',
-        # Equivalent "bright" versions of original 8 colors.
-        '08': '808080', '09': 'ff0000', '10': '00ff00', '11': 'ffff00', '12': '0000ff',
-        '13': 'ff00ff', '14': '00ffff', '15': 'ffffff',
-        # Strictly ascending.
-        '16': '000000', '17': '00005f', '18': '000087', '19': '0000af', '20': '0000d7',
-        '21': '0000ff', '22': '005f00', '23': '005f5f', '24': '005f87', '25': '005faf',
-        '26': '005fd7', '27': '005fff', '28': '008700', '29': '00875f', '30': '008787',
-        '31': '0087af', '32': '0087d7', '33': '0087ff', '34': '00af00', '35': '00af5f',
-        '36': '00af87', '37': '00afaf', '38': '00afd7', '39': '00afff', '40': '00d700',
-        '41': '00d75f', '42': '00d787', '43': '00d7af', '44': '00d7d7', '45': '00d7ff',
-        '46': '00ff00', '47': '00ff5f', '48': '00ff87', '49': '00ffaf', '50': '00ffd7',
-        '51': '00ffff', '52': '5f0000', '53': '5f005f', '54': '5f0087', '55': '5f00af',
-        '56': '5f00d7', '57': '5f00ff','58': '5f5f00', '59': '5f5f5f', '60': '5f5f87',
-        '61': '5f5faf', '62': '5f5fd7', '63': '5f5fff', '64': '5f8700', '65': '5f875f',
-        '66': '5f8787', '67': '5f87af', '68': '5f87d7', '69': '5f87ff', '70': '5faf00',
-        '71': '5faf5f', '72': '5faf87', '73': '5fafaf', '74': '5fafd7', '75': '5fafff',
-        '76': '5fd700', '77': '5fd75f', '78': '5fd787', '79': '5fd7af', '80': '5fd7d7',
-        '81': '5fd7ff', '82': '5fff00', '83': '5fff5f', '84': '5fff87', '85': '5fffaf',
-        '86': '5fffd7', '87': '5fffff', '88': '870000', '89': '87005f', '90': '870087',
-        '91': '8700af', '92': '8700d7', '93': '8700ff', '94': '875f00', '95': '875f5f',
-        '96': '875f87', '97': '875faf', '98': '875fd7', '99': '875fff', '100': '878700',
-        '101': '87875f', '102': '878787', '103': '8787af', '104': '8787d7',
-        '105': '8787ff', '106': '87af00', '107': '87af5f', '108': '87af87',
-        '109': '87afaf', '110': '87afd7', '111': '87afff', '112': '87d700',
-        '113': '87d75f', '114': '87d787', '115': '87d7af', '116': '87d7d7',
-        '117': '87d7ff', '118': '87ff00', '119': '87ff5f', '120': '87ff87',
-        '121': '87ffaf', '122': '87ffd7', '123': '87ffff', '124': 'af0000',
-        '125': 'af005f', '126': 'af0087', '127': 'af00af', '128': 'af00d7',
-        '129': 'af00ff', '130': 'af5f00', '131': 'af5f5f', '132': 'af5f87',
-        '133': 'af5faf', '134': 'af5fd7', '135': 'af5fff', '136': 'af8700',
-        '137': 'af875f', '138': 'af8787', '139': 'af87af', '140': 'af87d7',
-        '141': 'af87ff', '142': 'afaf00', '143': 'afaf5f', '144': 'afaf87',
-        '145': 'afafaf', '146': 'afafd7', '147': 'afafff', '148': 'afd700',
-        '149': 'afd75f', '150': 'afd787', '151': 'afd7af', '152': 'afd7d7',
-        '153': 'afd7ff', '154': 'afff00', '155': 'afff5f', '156': 'afff87',
-        '157': 'afffaf', '158': 'afffd7', '159': 'afffff', '160': 'd70000',
-        '161': 'd7005f', '162': 'd70087', '163': 'd700af', '164': 'd700d7',
-        '165': 'd700ff', '166': 'd75f00', '167': 'd75f5f', '168': 'd75f87',
-        '169': 'd75faf', '170': 'd75fd7', '171': 'd75fff', '172': 'd78700',
-        '173': 'd7875f', '174': 'd78787', '175': 'd787af', '176': 'd787d7',
-        '177': 'd787ff', '178': 'd7af00', '179': 'd7af5f', '180': 'd7af87',
-        '181': 'd7afaf', '182': 'd7afd7', '183': 'd7afff', '184': 'd7d700',
-        '185': 'd7d75f', '186': 'd7d787', '187': 'd7d7af', '188': 'd7d7d7',
-        '189': 'd7d7ff', '190': 'd7ff00', '191': 'd7ff5f', '192': 'd7ff87',
-        '193': 'd7ffaf', '194': 'd7ffd7', '195': 'd7ffff', '196': 'ff0000',
-        '197': 'ff005f', '198': 'ff0087', '199': 'ff00af', '200': 'ff00d7',
-        '201': 'ff00ff', '202': 'ff5f00', '203': 'ff5f5f', '204': 'ff5f87',
-        '205': 'ff5faf', '206': 'ff5fd7', '207': 'ff5fff', '208': 'ff8700',
-        '209': 'ff875f', '210': 'ff8787', '211': 'ff87af', '212': 'ff87d7',
-        '213': 'ff87ff', '214': 'ffaf00', '215': 'ffaf5f', '216': 'ffaf87',
-        '217': 'ffafaf', '218': 'ffafd7', '219': 'ffafff', '220': 'ffd700',
-        '221': 'ffd75f', '222': 'ffd787', '223': 'ffd7af', '224': 'ffd7d7',
-        '225': 'ffd7ff', '226': 'ffff00', '227': 'ffff5f', '228': 'ffff87',
-        '229': 'ffffaf', '230': 'ffffd7', '231': 'ffffff',
-        # Gray-scale range.
-        '232': '080808', '233': '121212', '234': '1c1c1c', '235': '262626',
-        '236': '303030', '237': '3a3a3a', '238': '444444', '239': '4e4e4e',
-        '240': '585858', '241': '626262', '242': '6c6c6c', '243': '767676',
-        '244': '808080', '245': '8a8a8a', '246': '949494', '247': '9e9e9e',
-        '248': 'a8a8a8', '249': 'b2b2b2', '250': 'bcbcbc', '251': 'c6c6c6',
-        '252': 'd0d0d0', '253': 'dadada', '254': 'e4e4e4', '255': 'eeeeee',
-        },
+# the open tabs are journaled here (see modules/session.py), tabs.dat is only
+# read once to bring over the tabs from before the journal existed
+SESSION_PATH = os.path.join(state_dir(), 'session.log')
 
+CONFIG = {
         'header':['header', 'white', 'dark gray', 'bold'],
         'browse':['browse', 'black', 'light gray'],
         'footer':['footer', 'white', 'dark gray', 'bold'],
@@ -113,10 +41,27 @@ CONFIG = {
 
         'style':'monokai',
 
+        'bigfile':'32',
+        'undolimit':'1000',
+        'undosize':'32',
+        'stripspace':'yes',
+        'prefetch':'yes',
+        'lexers':'',
+        'truecolor':'auto',
+        'scrollregion':'yes',
+
         'open':'ctrl o',
+        'quickopen':'ctrl p',
         'save':'ctrl s',
         'find':'ctrl f',
+        'findregex':'meta r',
+        'findcase':'meta c',
+        'findword':'meta w',
+        'findfiles':'meta f',
+        'findreplace':'meta h',
+        'findreplaceall':'meta a',
         'undo':'ctrl q',
+        'redo':'ctrl r',
         'delline':'ctrl d',
         'prevtab':'meta page up',
         'nexttab':'meta page down',
@@ -124,11 +69,11 @@ CONFIG = {
         'terminal':'ctrl g',
         'linenum':'ctrl n',
         'layout':'f1',
+        'hud':'f2',
         'config':'f5',
         'exit':'ctrl x'
     }
 
-CONFIG['rgb_to_short'] = {v: k for k, v in CONFIG['short_to_rgb'].items()}
 
 # all the possible widgets that can be defined in the config
 palette_items = ['header', 'flagged focus', 'key', 'footer', 'focus', 'selected', 'flagged', 'browse']
@@ -169,100 +114,204 @@ def strip_path(fname):
     peices = os.path.abspath(fname).split("/")
     return "/".join(peices[0:-1])
 
-def rgb_to_short(rgb, mapping):
-    """Find the closest xterm-256 approximation to the given RGB value."""
-    # Thanks to Micah Elliott (http://MicahElliott.com) for colortrans.py
-    rgb = rgb.lstrip('#') if rgb.startswith('#') else rgb
-    incs = (0x00, 0x5f, 0x87, 0xaf, 0xd7, 0xff)
-    # Break 6-char RGB code into 3 integer vals.
-    parts = [int(h, 16) for h in re.split(r'(..)(..)(..)', rgb)[1:4]]
-    res = []
-    for part in parts:
-        i = 0
-        while i < len(incs)-1:
-            s, b = incs[i], incs[i+1]  # smaller, bigger
-            if s <= part <= b:
-                s1 = abs(s - part)
-                b1 = abs(b - part)
-                if s1 < b1: closest = s
-                else: closest = b
-                res.append(closest)
-                break
-            i += 1
-    res = ''.join([ ('%02.x' % i) for i in res ])
-    equiv = mapping[res]
-    return equiv, res
-
 # since this is a multi-tab editor, there are a lot of peices of info that need to be stored for each tab
 # instead of keeping a bunch of dicts to key the data we need, we can just have one dict and key up an
 # object that has all the data we need
 #
 # DATA:
-#       file content
-#       cursor pos
-#       undo stack
+#       file content (a LineWalker around the file's TextBuffer)
+#       cursor pos and scroll offset
+#       undo history
+#       the tab button and its index
+#       whether the file still has to be read (tabs restored from the session)
+#       what the file looked like when it was read and the buffer versions that
+#       were saved and journaled, to tell which edits still have to be journaled
+#
+# the lexer and syntax highlighting cache belong to the LineWalker, so switching
+# tabs only has to swap which TabInfo is shown, no matter how big the files are
 #
 class TabInfo(object):
     def __init__(self, display):
         self.display = display
-        self.lines = []
+        self.lines = None
         self.cursor = [0, 0]
+        self.offset = 0 # how far down the screen the cursor line was, to scroll back to it
+        self.index = 0 # where the tab is in file_names
+        self.tab = None # the button in the tab bar
+        self.pending = None # the session's SessionTab until the file is read
+        self.base = None # the size and mtime of the file the buffer was read from
+        self.saved_version = 0
+        self.journaled = 0
         self.undo = UndoStack(self.display)
+        # only set for the find in files tab, the (path, row, col) each line points at
+        self.results = None
+
+# the undo history is made of actions, one for each key that changed the text. An
+# action holds the edits the LineWalker made while handling that key, e.g. enter
+# is a SET of the line that was split plus an INSERT of its second half:
+#
+#   edit              stored as
+#   ----              ---------
+#   change a line     (SET, row, old text, new text)
+#   change many       (SETS, None, [(row, old text)...], [(row, new text)...])
+#   insert lines      (INSERT, row, lines, None)
+#   delete lines      (DELETE, row, lines, None)
+#
+# typing (or deleting) a run of characters on one line only changes that line,
+# so those actions are merged into one and undo takes back the whole run. The
+# oldest actions are dropped once there are more than undolimit of them or they
+# hold more than undosize megabytes of text.
+
+class UndoAction(object):
+    __slots__ = ('edits', 'before', 'after', 'size', 'key', 'sealed', 'dirty')
+
+    def __init__(self, key, before):
+        self.edits = []
+        self.before = before # the cursor before the action, restored by undo
+        self.after = before # the cursor after it, restored by redo
+        self.size = 0
+        self.key = key
+        self.sealed = False # the cursor moved away so nothing can be merged into it
+        self.dirty = False # edited since the cursor was last saved in after
 
 class UndoStack(object):
-    def __init__(self, display):
-        self.items = []
-        self.display = display
+    SET, SETS, INSERT, DELETE = range(4)
 
-    def undo(self):
-        # this method undoes the last action from the undo stack. This could be a character added, deleted, a line
-        # added, a line combined with the previous or the next. It is pretty ugly becuase there are quite a bit of special
-        # cases to take into consideration like pressing delete at the end of a line, or backspace at the beginning of
-        # a line. It works though!
-        if self.items == []:
+    # keys that are left out of the history, they only move the cursor
+    MOVE_KEYS = {'up', 'down', 'left', 'right', 'page up', 'page down', 'home', 'end',
+                 'ctrl right', 'ctrl left', 'meta right', 'meta left'}
+
+    def __init__(self, display, lines=None):
+        self.display = display
+        self.lines = lines # the LineWalker this history belongs to
+        self.items = collections.deque()
+        self.redo_items = []
+        self.pending = None # the action for the key being handled
+        self.merge = False # can the pending action be merged into the last one
+        self.size = 0
+        self.replaying = False
+        self.max_items = int(display.config['undolimit'])
+        self.max_size = float(display.config['undosize']) * 1024 * 1024
+
+    def cursor(self):
+        lb = self.display.listbox
+        return (lb.focus_position, lb.focus.edit_pos)
+
+    def new_action(self, key):
+        # called for every key the editor gets, before the key is handled
+        pending = self.pending
+        if key in self.MOVE_KEYS:
+            # nothing is recorded for these, but they end a run of typing
+            if pending is not None:
+                if pending.dirty:
+                    pending.after = self.cursor()
+                    pending.dirty = False
+                pending.sealed = True
             return
-        item = self.items.pop(-1)
-        # item[0] = keys, item[1] = position, item[2] = change
-
-        self.display.listbox.set_focus(item[1][0])
-        self.display.listbox.focus.set_edit_pos(item[1][1])
-
-        if item[2]: # something deleted, so add
-            if item[0] == 'backspace': # backspace at beginning of line or del at end
-                self.display.listbox.set_focus(item[1][0])
-                self.display.listbox.focus.set_edit_pos(item[1][1])
-                self.display.listbox.do_enter()
-                self.items.pop(-1)
-                return
-            elif item[0][-1] == '\n': # if ctrl d is pressed (delete line)
-                text = TextLine(item[0][:-1], self.display)
-                self.display.listbox.lines.insert(item[1][0], text)
-                self.display.line_nums.add()
-            else: # this is just a normal backspace
-                self.display.listbox.focus.insert_text(item[0])
-
-        else: # something added so delete!
-            if item[0] == 'enter': # undo an enter press
-                self.display.listbox.set_focus(item[1][0]+1)
-                self.display.listbox.combine_previous()
-                return
-            # otherwise undo a normal character deletion
-            old_text = self.display.listbox.focus.edit_text
-            index = int(item[0])
-            #self.display.loop.process_input(['backspace'])
-            if index != len(old_text):
-                new_text = old_text[:index-1] + old_text[index:]
+        self.finish()
+        self.pending = UndoAction(key, self.cursor())
+
+    def finish(self):
+        # move the pending action onto the stack
+        action = self.pending
+        self.pending = None
+        if action is None or not action.edits:
+            return
+        if action.dirty:
+            action.after = self.cursor()
+        typing = self.typing(action.key)
+        merged = self.merge and typing and self.try_merge(action)
+        if not merged:
+            self.items.append(action)
+            self.size += action.size
+        self.merge = typing and not action.sealed
+        while len(self.items) > 1 and (len(self.items) > self.max_items or self.size > self.max_size):
+            self.size -= self.items.popleft().size
+
+    def typing(self, key):
+        # typing a character, backspace and delete can be merged with the keys around them
+        return key is not None and (len(key) == 1 or key in ('backspace', 'delete', 'tab'))
+
+    def try_merge(self, action):
+        if not self.items or len(action.edits) != 1:
+            return False
+        last = self.items[-1]
+        if len(last.edits) != 1:
+            return False
+        kind, row, old, new = last.edits[0]
+        kind2, row2, old2, new2 = action.edits[0]
+        if kind != self.SET or kind2 != self.SET or row != row2:
+            return False
+        # don't mix typing with deleting
+        if (len(new) > len(old)) != (len(new2) > len(old2)):
+            return False
+        last.edits[0] = (kind, row, old, new2)
+        last.after = action.after
+        self.size += len(new2) - len(new)
+        last.size += len(new2) - len(new)
+        return True
+
+    def record(self, kind, row, old, new=None):
+        # called by the LineWalker for every change to the text
+        if self.replaying:
+            return
+        if self.pending is None:
+            self.pending = UndoAction(None, self.cursor())
+        action = self.pending
+        action.edits.append((kind, row, old, new))
+        if kind == self.SET:
+            action.size += len(old) + len(new)
+        elif kind == self.SETS:
+            action.size += sum(len(t) for r, t in old) + sum(len(t) for r, t in new)
+        else:
+            action.size += sum(len(t) for t in old)
+        action.dirty = True
+        # a new change means the undone actions can't be redone anymore
+        self.redo_items = []
+
+    def apply(self, edits, undo):
+        lines = self.lines
+        self.replaying = True
+        for kind, row, old, new in (reversed(edits) if undo else edits):
+            if kind == self.SET:
+                lines.set_lines([(row, old if undo else new)])
+            elif kind == self.SETS:
+                lines.set_lines(old if undo else new)
+            elif (kind == self.INSERT) == undo:
+                lines.delete_lines(row, len(old))
             else:
-                new_text = old_text[:index-1]
-
-            self.display.listbox.focus.set_edit_text(new_text)
+                lines.insert_lines(row, old)
+        self.replaying = False
+
+    def goto(self, cursor):
+        lb = self.display.listbox
+        row = min(cursor[0], len(lb.lines) - 1)
+        lb.set_focus(row)
+        lb.focus.set_edit_pos(min(cursor[1], len(lb.focus.edit_text)))
+        self.display.update_line_numbers()
 
-    def log(self, keys, position, change):
-        #keys: text to insert, or un-insert
-        #position: where to place or take out text
-        #change: if removed this is 1 (backspace, delete), if added this is 0 (keypress)
-        new_item = [keys, position, change]
-        self.items.append(new_item)
+    def undo(self):
+        # take back the last action, however many lines it changed
+        self.finish()
+        self.merge = False
+        if not self.items:
+            return
+        action = self.items.pop()
+        self.size -= action.size
+        self.apply(action.edits, True)
+        self.redo_items.append(action)
+        self.goto(action.before)
+
+    def redo(self):
+        self.finish()
+        self.merge = False
+        if not self.redo_items:
+            return
+        action = self.redo_items.pop()
+        self.apply(action.edits, False)
+        self.items.append(action)
+        self.size += action.size
+        self.goto(action.after)
 
 class FindField(urwid.Edit):
     def __init__(self, display, **kwargs):
@@ -270,43 +319,140 @@ class FindField(urwid.Edit):
         self.display = display
         self.index = 0
         self.line = 0
-        self.last = 0
-        self.on_line = []
-        self.history = []
+        self.match = -1 # which match we are on, -1 if there are none
+        self.matches = SearchIndex()
+        # search modes, toggled with the findregex, findcase and findword keys
+        self.regex = False
+        self.case = True
+        self.word = False
+        # while replacing the edit text is the replacement and the search string is kept here
+        self.replacing = False
+        self.query = ''
+        self.replacement = ''
         self.searches = []
         self.search_pos = -1
 
-    def goto(self, word, current):
-        # this method is some crazy sh*t, I wrote it and I still am not quite sure how it works...
-        # but since it works, I will not mess with it :-)
-        found = False
-        if self.history == [] or self.history[-1] != (self.line, self.index):
-            self.history.append((self.line, self.index))
-
-        if len(self.on_line) > 0:
-            self.index = self.on_line.pop(0)
-
+    def start(self):
+        # called when the find bar is opened, the file may have changed since the last search
+        self.matches.reset()
+        self.match = -1
+        self.update_caption()
+
+    def search(self):
+        # find every occurence of the search string, narrowing the last results when we can
+        query = self.get_query()
+        self.matches.search(self.display.listbox.lines, query, self.regex, self.case, self.word)
+        if query:
+            self.goto(self.matches.find((0, 0)))
         else:
-            for line in self.display.listbox.lines[current[0]:]:
-                if word in line.edit_text:
-                    for m in re.finditer(word, line.edit_text):
-                        self.on_line.append(m.start())
-
-                    self.index = self.on_line.pop(0)
-
-                    self.last = self.line
-                    self.line = self.display.listbox.lines.index(line)
-                    found = True
-                    break
-        if not found:
-            self.history.pop(-1)
+            self.match = -1
+            self.update_caption()
+
+    def extend(self):
+        # the file got longer while it was being indexed, the new lines are searched too
+        if self.matches.lines is not self.display.listbox.lines or not self.get_query():
             return
+        self.matches.extend()
+        if self.match < 0 and self.matches:
+            self.goto(self.matches.find((0, 0)))
+        else:
+            self.update_caption()
 
+    def goto(self, match):
+        # jump to the match with the given index in the list of matches
+        self.match = match
+        self.update_caption()
+        if match < 0:
+            return
+        self.line, self.index = self.matches.matches[match]
         self.display.top.set_focus('body')
         self.display.listbox.lines[self.line].set_edit_pos(self.index)
         self.display.listbox.set_focus(self.line)
         self.display.update_line_numbers()
 
+    def get_query(self):
+        return self.query if self.replacing else self.edit_text
+
+    def update_caption(self, note=None):
+        modes = [name for name, on in (('regex', self.regex), ('nocase', not self.case), ('word', self.word)) if on]
+        caption = "find [" + ", ".join(modes) + "]" if modes else "find"
+        if self.replacing:
+            caption = "replace '" + self.query + "'" + caption[4:]
+            end = " with: "
+        else:
+            end = ": "
+        if note is not None:
+            self.set_caption(caption + " (" + note + ")" + end)
+        elif not self.get_query():
+            self.set_caption(caption + end)
+        else:
+            # a big file that is still being indexed has only been searched as far as it got
+            more = " so far" if self.display.listbox.lines.buffer.loading else ""
+            if self.match < 0:
+                self.set_caption(caption + " (no matches" + more + ")" + end)
+            else:
+                self.set_caption(caption + " (match %d of %d%s)" % (self.match + 1, len(self.matches), more) + end)
+
+    def toggle_replace(self):
+        # switch between typing the search string and typing what to replace it with
+        if self.replacing:
+            self.replacement = self.edit_text
+            self.set_edit_text(self.query)
+        else:
+            self.query = self.edit_text
+            self.set_edit_text(self.replacement)
+        self.replacing = not self.replacing
+        self.update_caption()
+
+    def replace_next(self):
+        # replace the match we are on and go to the one after it
+        if self.match < 0:
+            return
+        lines = self.display.listbox.lines
+        row, col = self.matches.matches[self.match]
+        text = lines.get_text(row)
+        result = replace_match(text, col, self.query, self.edit_text, self.regex, self.case, self.word)
+        if result is None:
+            return
+        new_text, end = result
+        lines[row].set_edit_text(new_text)
+        self.matches.rescan(row)
+        self.goto(self.matches.find((row, end)))
+
+    def replace_all(self):
+        # every line is replaced in a single pass over the buffer and undone in one step
+        lines = self.display.listbox.lines
+        # a big file might still be being indexed, it's only replaced once every line is known
+        if lines.buffer.wait():
+            lines._modified()
+            self.display.update_line_numbers()
+        changes = replace_lines(lines.iter_text(), self.query, self.edit_text, self.regex, self.case, self.word)
+        if not changes:
+            return
+        lines.set_lines([(row, new) for row, old, new in changes], [(row, old) for row, old, new in changes])
+        self.matches.reset()
+        self.search()
+        self.update_caption("changed %d lines" % len(changes))
+
+    def stop(self):
+        # close the find bar and go back to editing
+        if self.replacing:
+            self.toggle_replace()
+        self.display.top.contents['footer'] = (self.display.foot_col, None)
+        self.searches.insert(0, self.edit_text)
+        self.set_edit_text("")
+        self.update_caption()
+        if self.display.layout:
+            self.display.top.contents['footer'] = (self.display.status, None)
+        else:
+            for file in self.display.file_names:
+                # since these files are already open, the list box won't repopulate
+                # but the tabs will be re-drawn!
+                self.display.listbox.populate(file)
+
+        self.display.listbox.set_focus(self.line)
+        self.display.finding = False
+
     def handle_key(self, key):
         # this is where all the keypress for the find bar happen, I don't use the keypress method
         # becuase we are never actually focused on the find bar, we are always focused on the text
@@ -314,54 +460,49 @@ class FindField(urwid.Edit):
         # bar, and running each function according to the keypress we get
 
         if key in string.printable: # if the key press was a printable character
-            # we are searching for a new string so we clear everyhting and find the first occurence
-            self.on_line = []
+            # the search string got longer so the matches are narrowed and we go to the first one
             self.insert_text(key)
-            self.goto(self.edit_text, (0,0))
-            self.history = []
+            if not self.replacing:
+                self.search()
 
         if key == self.display.config['find']: # if ctrl+f is pressed again stop finding
-            self.display.top.contents['footer'] = (self.display.foot_col, None)
-            self.searches.insert(0, self.edit_text)
-            self.set_edit_text("")
-            self.on_line = []
-            if self.display.layout:
-                self.display.top.contents['footer'] = (self.display.status, None)
-            else:
-                for file in self.display.file_names:
-                    # since these files are already open, the list box won't repopulate
-                    # but the tabs will be re-drawn!
-                    self.display.listbox.populate(file)
-
-            self.display.listbox.set_focus(self.line)
-            self.display.finding = False
-            #self.display.update_line_numbers()
+            self.stop()
             return
 
+        if key == self.display.config['findfiles']: # search for the string in every file instead
+            query = self.get_query()
+            self.stop()
+            self.display.find_in_files(query, self.regex, self.case, self.word)
+            return
+
+        if key == self.display.config['findreplace']:
+            self.toggle_replace()
+        elif key == self.display.config['findreplaceall'] and self.replacing:
+            self.replace_all()
+        elif key == 'enter' and self.replacing:
+            self.replace_next()
+
+        # these switch between search modes and search again
+        if key == self.display.config['findregex']:
+            self.regex = not self.regex
+            self.search()
+        elif key == self.display.config['findcase']:
+            self.case = not self.case
+            self.search()
+        elif key == self.display.config['findword']:
+            self.word = not self.word
+            self.search()
+
         if key == 'right': # go to the next occurence of the search string
-            if len(self.edit_text) > 0:
-                self.goto(self.edit_text, (self.line+1, self.index+1))
-                self.display.update_line_numbers(cfrom='above')
+            self.goto(self.matches.next((self.line, self.index)))
 
         if key == 'left': # go to the previous occurence of the search string
-            if len(self.history) > 0: # if there is a previous one to go to
-                previous = self.history.pop(-1)
-                self.last = self.line
-                self.line, self.index = previous[0], previous[1]
-                self.display.listbox.lines[self.line].set_edit_pos(self.index)
-                self.display.listbox.set_focus(self.line)
-                self.display.update_line_numbers(cfrom='below')
-            else: # we are at the first occurence so ensure that nothing wonky happens
-                self.on_line = []
-                self.goto(self.edit_text, (0,0))
-                self.history = []
-                return
+            self.goto(self.matches.prev((self.line, self.index)))
 
-        if key == 'backspace': # this means we are starting a new search
-            self.on_line = []
+        if key == 'backspace': # the previous results are reused for the shorter string
             self.set_edit_text(self.edit_text[:-1]) # get the string wihtout the last letter
-            self.goto(self.edit_text, (0, 0))
-            self.history = []
+            if not self.replacing:
+                self.search()
 
         #if key == 'up':
             #self.search_pos += 1
@@ -375,31 +516,31 @@ class FindField(urwid.Edit):
             #else:
                 #self.set_edit_text("")
 
-        self.display.listbox.lines[self.line].set_edit_pos(self.index)
-        self.display.listbox.set_focus(self.line)
-        self.display.update_line_numbers()
-
 class TextLine(urwid.Edit):
-    def __init__(self, text, display, tabsize=4, **kwargs):
+    def __init__(self, text, display, tabsize=4, walker=None, row=None, **kwargs):
+        self.walker = None
         super().__init__(edit_text=text.expandtabs(4), wrap='clip', **kwargs)
         self.display = display
         self.tab = tabsize
-        self.tokens = []
-        self.attribs = []
-        self.parsed = False
-        self.original = text
+        # the walker and row this widget is showing, edits are written back to the buffer
+        self.walker = walker
+        self.row = row
+
+    def recycle(self, row, text):
+        # reuse this widget for another row of the buffer without writing anything back
+        self.row = row
+        super().set_edit_text(text.expandtabs(self.tab))
+        self.set_edit_pos(0)
+
+    def set_edit_text(self, text):
+        super().set_edit_text(text)
+        if self.walker is not None:
+            self.walker.set_text(self.row, self.edit_text)
 
     def get_text(self):
+        # the highlighter only lexes the line again if it (or a line before it) changed
         etext = self.get_edit_text()
-        # this is done to ensure that parsing is only done if the line is selected and altered
-        if not self.parsed or (self.display.listbox.focus == self and self.edit_text != self.original):
-            self.parsed = True
-            # get the new tokens and return them
-            self.tokens = self.display.listbox.get_tokens(self.edit_text)
-            self.attribs = [(tok, len(s)) for tok, s in self.tokens]
-            self.original = self.edit_text
-
-        return etext, self.attribs
+        return etext, self.walker.highlighter.get_attribs(self.row, etext)
 
     def get_tabsize(self, pos):
         mod = pos % self.tab
@@ -417,147 +558,371 @@ class TextLine(urwid.Edit):
         ret = super().keypress(size, key)
 
         if key == 'tab':
-            lb = self.display.listbox
-            pos = lb.focus.edit_pos
-            tabsize = self.get_tabsize(pos)
-            for i in range(1, tabsize+1):
-                cur_tab = self.display.tab_info[self.display.listbox.fname]
-                cur_tab.undo.log(pos+i, [lb.focus_position, lb.focus.edit_pos], 0)
+            tabsize = self.get_tabsize(self.edit_pos)
             self.insert_text(' ' * tabsize)
 
         return ret
 
-# the line numbers to the left of the editor window is actually a listbox of its own
-# it is placed next to the main editor listbox in a column container like so:
+# the text of each tab lives in a TextBuffer, the LineWalker hands the TextList
+# TextLine widgets only for the rows that are actually being looked at. Widgets
+# for rows that scrolled far away are reused for the new rows, so a file with
+# a million lines still only has a screenful or so of widgets.
+
+class LineWalker(urwid.ListWalker):
+    def __init__(self, display, buffer, lexer, max_widgets=256):
+        self.display = display
+        self.buffer = buffer
+        self.focus = 0
+        self.max_widgets = max_widgets
+        self.widgets = {} # row -> TextLine for the rows that have been shown
+        self.undo = None # the UndoStack every change is recorded in
+        self.highlighter = Highlighter(lexer, self.get_text, self.__len__, display.worker)
+        self.highlighter.updated = self.highlighted
+
+    def __len__(self):
+        return len(self.buffer)
+
+    def __getitem__(self, row):
+        if row < 0 or row >= len(self.buffer):
+            raise IndexError(row)
+        widget = self.widgets.get(row)
+        if widget is None:
+            text = self.buffer[row]
+            if len(self.widgets) >= self.max_widgets:
+                # recycle the widget that is the farthest away from the focus
+                far = max(self.widgets, key=lambda r: abs(r - self.focus))
+                widget = self.widgets.pop(far)
+                widget.recycle(row, text)
+            else:
+                widget = TextLine(text, self.display, walker=self, row=row)
+            self.widgets[row] = widget
+        return widget
+
+    def get_text(self, row):
+        # the text of a row the way it is shown in the editor (tabs expanded)
+        widget = self.widgets.get(row)
+        if widget is not None:
+            return widget.edit_text
+        text = self.buffer[row]
+        if '\t' in text:
+            return text.expandtabs(4)
+        return text
+
+    def highlighted(self, rows):
+        # the highlight worker found new attributes for these rows, so redraw them
+        for row in rows:
+            widget = self.widgets.get(row)
+            if widget is not None:
+                widget._invalidate()
+        self._modified()
+
+    def set_text(self, row, text):
+        if self.undo is not None:
+            old = self.buffer[row]
+            if '\t' in old:
+                old = old.expandtabs(4)
+            if old == text:
+                return
+            self.undo.record(UndoStack.SET, row, old, text)
+        self.buffer.set_line(row, text)
+        self.highlighter.changed(row)
+
+    def rebase(self, saved):
+        # the file was saved, saved is the buffer the way it went in the file (see
+        # TextBuffer.written). The lines that had whitespace stripped get new widgets
+        self.buffer.rebase(saved)
+        self.widgets = {}
+        self._modified()
+
+    def iter_text(self, start=0):
+        # edits are always written back to the buffer so only the tabs need expanding
+        for text in self.buffer.iter_lines(start):
+            if '\t' in text:
+                yield text.expandtabs(4)
+            else:
+                yield text
+
+    def get_focus(self):
+        if len(self.buffer) == 0:
+            return None, None
+        self.focus = min(self.focus, len(self.buffer)-1)
+        return self[self.focus], self.focus
+
+    def set_focus(self, position):
+        self.focus = position
+        self._modified()
+
+    def get_next(self, position):
+        if position + 1 >= len(self.buffer):
+            return None, None
+        return self[position+1], position+1
+
+    def get_prev(self, position):
+        if position <= 0:
+            return None, None
+        return self[position-1], position-1
+
+    def positions(self, reverse=False):
+        if reverse:
+            return range(len(self.buffer)-1, -1, -1)
+        return range(len(self.buffer))
+
+    def _shift(self, row, amount):
+        # move the cached widgets at or after row by amount, dropping any that were deleted
+        widgets = {}
+        for r, widget in self.widgets.items():
+            if r >= row:
+                if amount < 0 and r < row - amount:
+                    continue
+                r += amount
+                widget.row = r
+            widgets[r] = widget
+        self.widgets = widgets
+
+    def set_lines(self, changes, old=None):
+        # change a lot of rows in one go (replace all), changes is a sorted list of (row, text)
+        # and old can be the (row, text) they had before if the caller knows it already
+        if not changes:
+            return
+        if self.undo is not None and not self.undo.replaying:
+            if old is None:
+                old = [(row, self.get_text(row)) for row, text in changes]
+            self.undo.record(UndoStack.SETS, None, old, changes)
+        self.buffer.set_lines(changes)
+        for row, text in changes:
+            widget = self.widgets.get(row)
+            if widget is not None:
+                widget.recycle(row, text)
+        self.highlighter.changed(changes[0][0])
+        self.highlighter.changed(changes[-1][0])
+        self._modified()
+
+    def insert(self, row, text):
+        self.insert_lines(row, [text])
+
+    def insert_lines(self, row, lines):
+        if self.undo is not None:
+            self.undo.record(UndoStack.INSERT, row, list(lines))
+        self.buffer.insert_lines(row, lines)
+        self._shift(row, len(lines))
+        self.highlighter.inserted(row, len(lines))
+        self._modified()
+
+    def splice(self, row, lines):
+        # put lines in place of row in one edit of the buffer (a paste)
+        if self.undo is not None:
+            self.undo.record(UndoStack.DELETE, row, [self.buffer[row]])
+            self.undo.record(UndoStack.INSERT, row, list(lines))
+        self.buffer.replace_lines(row, 1, lines)
+        self._shift(row + 1, len(lines) - 1)
+        widget = self.widgets.get(row)
+        if widget is not None:
+            widget.recycle(row, lines[0])
+        if len(lines) > 1:
+            self.highlighter.inserted(row + 1, len(lines) - 1)
+        self.highlighter.changed(row)
+        self._modified()
+
+    def __delitem__(self, row):
+        self.delete_lines(row, 1)
+
+    def delete_lines(self, row, count):
+        if self.undo is not None:
+            self.undo.record(UndoStack.DELETE, row, list(self.buffer.iter_lines(row, row + count)))
+        self.buffer.delete_lines(row, count)
+        self._shift(row, -count)
+        self.highlighter.deleted(row, count)
+        if len(self.buffer) == 0:
+            # there must always be a line to edit
+            self.buffer.insert_line(0, '')
+            self.highlighter.inserted(0, 1)
+        self._modified()
+
+# the line numbers to the left of the editor window are drawn by a widget that
+# sits next to the main editor listbox in a column container like so:
 # __________________________________
 # |    Urwid Column container      |
 # ----------------------------------
 # |1| text                         |
 # |2| text                         |
 #
-# to simulate scrolling I simply set the focus of the line number list box
-# to the same focus position as the main editor window. Unfortunately the
-# line numbers are copyable so if you try to copy multiple lines they will be
-# copied as well :/ so I made them togglable!
+# it doesn't keep a widget per line, every time it is drawn it asks the editor
+# listbox which rows are on screen and writes out just those numbers, so it is
+# always in sync with the scrolling and it costs the same for 10 or 100k lines.
+# Unfortunately the line numbers are copyable so if you try to copy multiple
+# lines they will be copied as well :/ so I made them togglable!
+
+class LineNumbers(urwid.Widget):
+    _sizing = frozenset(['box'])
+    _selectable = False # can't be selectable!
+    # the numbers depend on the scroll position of another widget so never reuse a canvas
+    no_cache = ['render']
 
-class LineNumbers(urwid.ListBox):
     def __init__(self, display):
         self.display = display
-        self.numbers = [] # this is the list the listbox uses
-        super().__init__(self.numbers) # instantiate the parent class with the list
-        self._selectable = False # can't be selectable!
-        self.width = 1 # this tells how wide to make the line num column
-        # since the line numbers aren't selectable we simulate them being selected
-        # by changing their color. this field is used to save the last number that
-        # was highlighted in order to unhighlight it
-        self.previous  = 1
-
-    # each time the user switches tabs the line numbers need to be cleared and
-    # repopulated. For some reason this is the way this has to be done...
-    def clear(self):
-        self.previous = 1
-        for _ in range(0, len(self.numbers)):
-            self.sub()
-
-    # this populates the line number listbox , it takes a list as an arg,
-    # but it really only needs a length.. it calls clear then
-    # it calls  add a bunch to create the new line num
-    def populate(self, lines):
-        if not self.display.show_lnums:
-            return
-        self.clear()
-        self.width = 1
-        for i in range(0, len(lines)):
-            self.add()
-
-    # this method is called when a new number needs to be added. if the new number is
-    # a digit longer than the last then the column width is increased!
-    def add(self):
-        self.numbers.append(urwid.Text(str(len(self.numbers)+1) + '| ', align='right'))
-        if len(str(len(self.numbers)-1)) > self.width:
-            self.width += 1
-            new_col = urwid.Columns([(self.width+2, self.display.line_nums), self.display.listbox], focus_column=1)
-            self.display.top.contents['body'] = (new_col, None)
-
-    # this method simply deletes a line from the end of the line numbers
-    # note: we have to check that we didnt delete the last line or we get an index out of bounds!
-    def sub(self):
-        if self.display.listbox.focus_position == len(self.numbers)-1:
-            self.previous = len(self.numbers)-2
-        self.numbers.pop(-1)
+        self.width = 1 # this tells how many digits wide the line num column is
+
+    # this is called whenever the number of lines may have changed (new tab, insert,
+    # delete, toggle). the column only has to be resized when the number of digits changes
+    def update(self):
+        width = len(str(len(self.display.listbox.lines)))
+        if width != self.width:
+            self.width = width
+            cols = self.display.body_col
+            if self.display.show_lnums and cols.contents[0][0] is self:
+                cols.contents[0] = (self, cols.options('given', width + 2))
+        self._invalidate()
+
+    def render(self, size, focus=False):
+        maxcol, maxrow = size
+        listbox = self.display.listbox
+        # the rows are worked out at the size the listbox was drawn at, not the width
+        # of this column, until it has been drawn there is nothing to number
+        if listbox.size is None:
+            return urwid.SolidCanvas(' ', maxcol, maxrow)
+        middle, top, bottom = listbox.calculate_visible(listbox.size, True)
+        if middle is None:
+            return urwid.SolidCanvas(' ', maxcol, maxrow)
+
+        # the line on every row of the screen, None for the rows a line wrapped onto
+        rows = []
+        for widget, row, count in reversed(top[1]):
+            rows += [row] + [None] * (count - 1)
+        focus_pos = middle[2]
+        rows += [focus_pos] + [None] * (middle[3] - 1)
+        for widget, row, count in bottom[1]:
+            rows += [row] + [None] * (count - 1)
+        rows = rows[top[0]:top[0] + maxrow]
+
+        text, attr = [], []
+        for row in rows:
+            if row is None:
+                text.append(b' ' * maxcol)
+                attr.append([])
+                continue
+            num = (str(row + 1) + '| ').rjust(maxcol)[-maxcol:]
+            text.append(num.encode())
+            # simulate the line number being selected by changing its color
+            attr.append([('key', maxcol)] if row == focus_pos else [])
+        while len(text) < maxrow:
+            text.append(b' ' * maxcol)
+            attr.append([])
+        return urwid.TextCanvas(text, attr, maxcol=maxcol)
 
 class TextList(urwid.ListBox):
     def __init__(self, display):
         self.display = display
-        self.lines = []
+        self.lines = LineWalker(display, TextBuffer.from_text(''), display.lexers.plain)
         super().__init__(self.lines)
         self.fname = ' '
         self.short_name = ' '
         self.lexer = None
         self.config = self.display.config
+        self.size = None # the size it was last drawn at, the batched keys need it
+
+    def render(self, size, focus=False):
+        self.size = size
+        return super().render(size, focus)
 
     def populate(self, fname):
         # this function populates the TextList and creates a new tabs
         # The same Textlist is used for each tab but when tabs are switched the
         # contents of the tab are grabbed from the files TabInfo instance
         if fname not in self.display.file_names:
-            # grab the lines from the file and strip the newline char
-            # then iterate through and create a new TextLine object for each line
-            try:
-                with open(fname) as f:
-                    content = [x.strip('\n') for x in f.readlines()]
-            except:
+            loaded = self.read_file(fname)
+            if loaded is None:
                 self.redraw_tabs()
                 return
-
+            buffer, base = loaded
+            self.watch_loading(buffer)
             # the short name is the file name without a path
             self.short_name = strip_fname(fname)
-            self.display.file_names.append(fname)
-            new_lines = []
-
-            # grab the lines from the file and strip the newline char
-            # Then iterate through and create a new TextLine object for each line
-            for line in content:
-                text = TextLine(line, self.display)
-                new_lines.append(text)
-
-            # if the file is empty then add one empty line so it can be displayed
-            if len(new_lines) < 1:
-                text = TextLine(' ', self.display)
-                new_lines.append(text)
-
-            # create a new tab (button widget) with the correct attributes
-            self.display.cur_tab = self.display.tab_info[fname] = TabInfo(self.display)
-            new_tab_info = self.display.tab_info[fname]
-            new_tab_info.lines = new_lines
-            new_tab_info.undo = UndoStack(self.display)
-            new_tab_info.cursor = (0, 0)
-
-            self.display.line_nums.populate(new_lines)
-            button = urwid.Button(self.short_name)
-            button._label.align = 'center'
-            attrib = urwid.AttrMap(button, 'footer')
-            self.display.tabs.append(attrib)
-            # switch to the new tab
-            self.switch_tabs(fname)
+            self.display.session.open(fname)
+            info = self.add_tab(fname, buffer, self.get_lexer(fname, buffer))
+            info.base = base
         else:
-            self.display.line_nums.populate(self.lines)
+            self.display.update_line_numbers()
         self.redraw_tabs()
 
+    def read_file(self, fname):
+        # load the file into a text buffer, TextLine widgets are only made
+        # later on for the lines that are displayed. Returns (buffer, base) or
+        # None if the file can't be read
+        try:
+            base = file_base(fname)
+            # files over the bigfile size (in MB) are memory mapped and indexed in the background
+            if os.path.getsize(fname) > float(self.config['bigfile']) * 1024 * 1024:
+                buffer = TextBuffer.from_map(fname)
+            else:
+                buffer = TextBuffer.from_file(fname)
+        except:
+            return None
+        return buffer, base
+
+    def watch_loading(self, buffer):
+        # a memory mapped file is still being indexed, its lines are added as they're found
+        if buffer.loading and not self.display.polling:
+            self.display.poll_loading()
+
+    def new_walker(self, buffer, lexer):
+        lines = LineWalker(self.display, buffer, lexer)
+        urwid.connect_signal(lines, 'modified', self._invalidate)
+        lines.undo = UndoStack(self.display, lines)
+        return lines
+
+    def add_tab(self, fname, buffer, lexer, switch=True):
+        # create a tab showing the buffer and switch to it, fname doesn't have to be a real file
+        self.display.file_names.append(fname)
+        new_lines = self.new_walker(buffer, lexer)
+
+        # create a new tab (button widget) with the correct attributes
+        new_tab_info = self.display.tab_info[fname] = TabInfo(self.display)
+        new_tab_info.lines = new_lines
+        new_tab_info.undo = new_lines.undo
+        new_tab_info.cursor = (0, 0)
+        new_tab_info.index = len(self.display.file_names) - 1
+
+        button = urwid.Button(strip_fname(fname))
+        button._label.align = 'center'
+        attrib = urwid.AttrMap(button, 'footer')
+        new_tab_info.tab = attrib
+        self.display.tabs.append(attrib)
+        # switch to the new tab
+        if switch:
+            self.switch_tabs(fname)
+        return new_tab_info
+
+    def open_result(self, results):
+        # open the file a find in files result points at and jump to the match
+        row = self.focus_position
+        if row >= len(results) or results[row] is None:
+            return
+        fname, line, col = results[row]
+        self.populate(fname)
+        self.switch_tabs(fname)
+        if self.fname != fname: # the file couldn't be opened
+            return
+        self.set_focus(min(line, len(self.lines) - 1))
+        self.focus.set_edit_pos(col)
+        self.display.update_line_numbers()
+
     def redraw_tabs(self):
-         # this is done to ensure that the bottom bar is re-drawn after opening files
-        foot_col = urwid.Columns(self.display.tabs)
-        foot = urwid.AttrMap(foot_col, 'footer')
-        if self.display.layout:
-            self.display.top.contents['header'] = (foot, None)
-        else:
-            self.display.top.contents['footer'] = (foot, None)
+        # put the tab bar back after opening files. The same columns are kept and only
+        # change when a tab came or went, so the buttons keep their canvases and a
+        # frame that didn't touch the tabs doesn't draw them again
+        display = self.display
+        foot_col = display.foot_col
+        if [w for w, options in foot_col.contents] != display.tabs:
+            foot_col.contents[:] = [(tab, foot_col.options()) for tab in display.tabs]
+        part = 'header' if display.layout else 'footer'
+        if display.top.contents[part][0] is not foot_col:
+            display.top.contents[part] = (foot_col, None)
 
     def delete_tab(self, fname):
         files = self.display.file_names
         # make sure there is more than one file open
         if len(files) > 1:
-            index = files.index(fname)
+            index = self.display.tab_info[fname].index
             if index < len(files)-1: # if not last in list
                 new_name = files[index+1]
             else: # if last file in list
@@ -566,64 +931,114 @@ class TextList(urwid.ListBox):
             #del self.display.tab_info[fname]
             del files[index]
             del self.display.tabs[index]
+            # the tabs after the deleted one all move down a spot
+            for name in files[index:]:
+                self.display.tab_info[name].index -= 1
             # reset the footer with new tab amount
-            foot_col = urwid.Columns(self.display.tabs)
-            foot = urwid.AttrMap(foot_col, 'footer')
-            if self.display.layout:
-                self.display.top.contents['header'] = (foot, None)
-            else:
-                self.display.top.contents['footer'] = (foot, None)
+            self.redraw_tabs()
 
             self.switch_tabs(new_name)
             del self.display.tab_info[fname]
-
-    def get_lexer(self):
-        # this function gets the lexer depending on the files name
-        try:
-            lexer = get_lexer_for_filename(self.short_name)
-        except pygments.util.ClassNotFound:
-            lexer = TextLexer()
-
-        lexer.add_filter('tokenmerge')
-
-        return lexer
+            self.display.session.close(fname)
+
+    def add_placeholder(self, tab):
+        # a tab from the last session, it shows up in the tab bar right away but the
+        # file is only read once the tab is switched to (see load_tab)
+        info = self.add_tab(tab.path, TextBuffer.from_text(''), self.display.lexers.plain, switch=False)
+        info.pending = tab
+        info.cursor = tab.cursor
+        return info
+
+    def load_tab(self, fname):
+        # read the file of a placeholder tab and put back its unsaved edits and cursor
+        info = self.display.tab_info[fname]
+        tab, info.pending = info.pending, None
+        prefetch = self.display.prefetch
+        if prefetch is not None and prefetch.tab is tab:
+            # it's being read in the background already
+            prefetch.thread.join()
+            loaded = prefetch.loaded
+        else:
+            loaded = self.read_tab(tab)
+        if loaded is None:
+            self.display.show_message('could not open %s' % strip_fname(fname))
+            info.cursor = (0, 0)
+            return
+        buffer, base = loaded
+        self.watch_loading(buffer)
+        info.lines = self.new_walker(buffer, self.get_lexer(fname, buffer))
+        info.undo = info.lines.undo
+        info.base = base
+        info.journaled = buffer.version
+        row, col = tab.cursor
+        info.cursor = (max(0, min(row, len(buffer) - 1)), col)
+
+    def read_tab(self, tab):
+        # read the file of a placeholder tab with its unsaved edits put back. This
+        # runs on a background thread when the tab is prefetched (see TabPrefetch)
+        loaded = self.read_file(tab.path)
+        if loaded is None:
+            return None
+        buffer, base = loaded
+        # the unsaved edits only apply if the file didn't change since
+        if tab.pieces is not None and tab.base == base:
+            buffer.wait()
+            try:
+                buffer.load_pieces(tab.pieces)
+                buffer.replay(tab.lines)
+                # the journal has these edits, only the ones after them are journaled
+                buffer.log = []
+            except ValueError:
+                pass
+        return loaded
+
+    def get_lexer(self, fname, buffer=None):
+        # this function gets the lexer depending on the files name, every tab with
+        # the same kind of file shares one lexer. The start of the text is only
+        # looked at if the name doesn't give a lexer
+        head = ''
+        if buffer is not None:
+            head = '\n'.join(buffer.iter_lines(0, 5))
+        return self.display.lexers.get(fname, head)
 
     def switch_tabs(self, fname):
         # this method switches to a tab according to the provided filename
         if self.fname != fname: # make sure we aren't already on this tab
-            cur_tab_info = self.display.cur_tab
-            if self.fname != ' ':
+            new_tab_info = self.display.tab_info[fname]
+            if new_tab_info.pending is not None:
+                self.load_tab(fname)
+            if self.fname in self.display.tab_info:
+                # remember where we were in the old tab and un-highlight it
                 cur_tab_info = self.display.tab_info[self.fname]
-                cur_tab_info.lines[:] = self.lines
                 try:
-                    line = self.focus_position
-                    col = self.focus.edit_pos
-                    cur_tab_info.cursor = (line, col)
+                    cur_tab_info.cursor = (self.focus_position, self.focus.edit_pos)
+                    cur_tab_info.offset = self.offset_rows
                 except:
                     cur_tab_info.cursor = (0, 0)
-            index = self.display.file_names.index(fname)
-            tabs = self.display.tabs
-            if self.fname != ' ': #hopefully ensures all lines are saved when switching tabs
-                cur_tab_info.lines[:] = self.lines
-            # change tab colors depending on current index
-            for i in range(0, len(tabs)):
-                if i != index:
-                    tabs[i].set_attr_map({None:'footer'})
-                else:
-                    tabs[i].set_attr_map({None:'selected'})
+                    cur_tab_info.offset = 0
+                self.display.session.cursor(self.fname, *cur_tab_info.cursor)
+                cur_tab_info.tab.set_attr_map({None:'footer'})
+            new_tab_info.tab.set_attr_map({None:'selected'})
             # re-assign the current path and filename
             self.fname = fname
-            new_tab_info = self.display.tab_info[self.fname]
             self.short_name = strip_fname(fname)
-            # repopulate the lines list from the line dict in the main class
-            self.lines[:] = new_tab_info.lines
-            self.display.line_nums.populate(self.lines[:])
+            # every tab owns its lines so we only have to swap which walker is shown
+            self.lines = new_tab_info.lines
+            self.body = self.lines
             self.display.top.set_focus('body')
-            self.lexer = self.get_lexer()
-            self.set_focus(new_tab_info.cursor[0])
-            self.focus.set_edit_pos(new_tab_info.cursor[1])
+            self.lexer = self.lines.highlighter.lexer
+            # a file that is still being indexed might not have any lines yet
+            if len(self.lines):
+                self.set_focus(new_tab_info.cursor[0])
+                # put the cursor line back where it was on the screen, the listbox
+                # clamps this itself if the window got smaller since
+                self.offset_rows = new_tab_info.offset
+                self.inset_fraction = (0, 1)
+                self.focus.set_edit_pos(new_tab_info.cursor[1])
             self.display.update_line_numbers()
             self.display.cur_tab = new_tab_info
+            self.display.session.focus(fname)
+            self.display.start_prefetch()
         else:
             # not really needed since no mouse support :/
             self.display.top.set_focus('body')
@@ -633,7 +1048,7 @@ class TextList(urwid.ListBox):
         lead = self.get_leading()
         self.split_focus(self.focus_position)
         #text = self.focus.edit_text.strip()
-        self.display.line_nums.add()
+        self.display.update_line_numbers()
         self.display.loop.process_input(['down'])
         #if text != "":
         #   self.focus.set_edit_pos(lead)
@@ -641,13 +1056,8 @@ class TextList(urwid.ListBox):
 
     def get_leading(self):
         #get the leading whitespace of a line!
-        line = self.lines[self.focus_position]
         return len(self.focus.edit_text) - len(self.focus.edit_text.lstrip())
 
-    def get_tokens(self, text):
-        # this function returns the tokens for the provided text
-        return list(self.lexer.get_tokens(text))
-
     def get_line(self, position):
         # gets the TextLine object at the given position
         # I don't think I use this anywhere
@@ -693,12 +1103,12 @@ class TextList(urwid.ListBox):
         # split the current line at the cursor position (when enter is pressed)
         focus = self.lines[index]
         position = focus.edit_pos
-        # make a new edit for split half of the line
-        new_edit = TextLine(focus.text[position:], self.display)
+        # the split half of the line goes into the buffer as a new line
+        new_text = focus.text[position:]
         focus.set_edit_text(focus.text[:position])
         self.focus.set_edit_pos(0)
         # insert the newline at the correct index
-        self.lines.insert(index+1, new_edit)
+        self.lines.insert(index+1, new_text)
 
     def del_line(self):
         pos = self.focus_position
@@ -707,11 +1117,57 @@ class TextList(urwid.ListBox):
 
     def save_file(self):
         # this function is used to save the current file.
-        with open(self.fname, 'w') as f:
-            for line in self.lines:
-                f.write(line.edit_text.rstrip()+'\n')
+        if self.display.tab_info[self.fname].results is not None:
+            return # the find in files tab isn't a file
+        display = self.display
+        buffer = self.lines.buffer
+        strip = self.config['stripspace'] != 'no'
+        # a newer save of the same file makes the one still running pointless
+        old = display.saves.pop(self.fname, None)
+        if old is not None:
+            old.cancel()
+
+        if display.loop is not None and (buffer.mapped or len(buffer) >= FileSave.min_lines):
+            # big files are written in the background, the status bar shows how far along it is
+            save = None
+            pipe = display.loop.watch_pipe(lambda data: display.save_done(save))
+            save = display.saves[self.fname] = FileSave(self.fname, buffer, pipe, strip)
+            display.show_message('saving %s...' % self.short_name)
+            return
+
+        buffer.wait()
+        version = buffer.version
+        changed = []
+        try:
+            write_lines(self.fname, saved_lines(buffer.iter_lines(), strip, changed), False)
+        except OSError as e:
+            display.show_message('could not save %s: %s' % (self.short_name, e.strerror or e))
+            return
+        self.saved(self.fname, version, buffer.written(changed))
+
+    def saved(self, fname, version, saved):
+        # runs once a file is safely on the disk, version is the buffer version that was
+        # saved and saved the text that is in the file now
+        info = self.display.tab_info.get(fname)
+        if info is not None:
+            if info.lines.buffer.version == version:
+                # the buffer starts over from the saved text, so unsaved edits can be
+                # journaled as changes to what is on the disk now
+                current = fname == self.fname
+                if current:
+                    col = self.focus.edit_pos
+                info.lines.rebase(saved)
+                if current:
+                    self.focus.set_edit_pos(col)
+                info.base = file_base(fname)
+                info.saved_version = info.journaled = info.lines.buffer.version
+            else:
+                # it was edited while being saved in the background, so the edits
+                # since then can't be told apart until the next save
+                info.base = None
+            self.display.session.saved(fname)
 
-        if self.short_name == 'config.txt':
+        if strip_fname(fname) == 'config.txt':
             self.display.configure()
             self.display.register_palette()
             self.display.loop.screen.clear()
@@ -721,23 +1177,18 @@ class TextList(urwid.ListBox):
         # this function implements all the keypress behaviour of the text editor window
         # some of the keypress strings are grabbed from the config becuase they are customizable
         cur_tab = self.display.tab_info[self.fname]
-        bkey, dkey = '', ''
-        pos = 0
-        if self.lines != []:
-            if len(self.focus.edit_text) > 0:
-                pos = self.focus.edit_pos
-                bkey = self.focus.edit_text[pos-1]
-                if pos < len(self.focus.edit_text):
-                    dkey = self.focus.edit_text[pos]
+        # everything this key changes is undone together
+        cur_tab.undo.new_action(key)
+
+        # enter on a line in the find in files tab opens the result
+        if key == 'enter' and cur_tab.results is not None:
+            self.open_result(cur_tab.results)
+            return
 
         ret = super().keypress(size, key)
         if self.display.finding:
             return
 
-        if key in string.printable:
-            pos = self.focus.edit_pos
-            cur_tab.undo.log(pos, [self.focus_position, self.focus.edit_pos], 0)
-
         if key == 'down' or key == 'up' or key == 'page down' or key == 'page up':
             # we need to set the correct coming_from attribute or the line numbers won't
             # scroll correctly
@@ -747,14 +1198,7 @@ class TextList(urwid.ListBox):
                 cfrom = 'below'
             self.display.update_line_numbers(cfrom=cfrom)
 
-        elif key == 'backspace':
-            cur_tab.undo.log(bkey, [self.focus_position, self.focus.edit_pos], 1)
-
-        elif key == 'delete':
-            cur_tab.undo.log(dkey, [self.focus_position, self.focus.edit_pos], 1)
-
         elif key == 'enter':
-            cur_tab.undo.log('enter', [self.focus_position, self.focus.edit_pos], 0)
             self.do_enter()
         # the next two conditionals use regex to create the Ctrl+arrow behaviour
         elif key == "ctrl right" or key == "meta right":
@@ -795,7 +1239,7 @@ class TextList(urwid.ListBox):
 
         # this elif moves to the next tab and if user is on the last tab goes to the frst
         elif key == self.config['nexttab']:
-            index = self.display.file_names.index(self.fname)
+            index = cur_tab.index
             if index + 1 < len(self.display.file_names):
                 next_index = index + 1
             else:
@@ -805,7 +1249,7 @@ class TextList(urwid.ListBox):
             self.display.cur_tab = self.display.tab_info[self.fname]
 
         elif key == self.config['prevtab']:
-            index = self.display.file_names.index(self.fname)
+            index = cur_tab.index
             if index - 1 >= 0:
                 next_index = index - 1
             else:
@@ -817,17 +1261,109 @@ class TextList(urwid.ListBox):
         # this elif closes the current tab
         elif key == self.config['closetab']:
             self.delete_tab(self.fname)
-            self.display.save_tabs()
         # this elif saves the current tab
         elif key == self.config['save']:
             self.save_file()
 
         return ret
 
+    # the batching main loop (see modules/batch.py) hands a burst of keys to these
+    # in one go, each of them does the same as the keys would have one by one
+
+    def type_text(self, text):
+        # text is a run of typed characters, inserted with one edit
+        cur_tab = self.display.tab_info[self.fname]
+        if cur_tab.results is not None:
+            return 0
+        # the run merges with the typing around it like its characters would have
+        cur_tab.undo.new_action(text[-1])
+        self.focus.insert_text(text)
+        return len(text)
+
+    def move(self, key, count):
+        # the cursor moves count times, returns how many of them it could do in one jump
+        size = self.size
+        self.display.tab_info[self.fname].undo.new_action(key)
+        line = self.focus
+        if key == 'left' or key == 'right':
+            # only within the line, going past its end is left to the editor's keypress
+            text = line.edit_text
+            pos = line.edit_pos
+            done = 0
+            while done < count:
+                if key == 'right':
+                    if pos >= len(text):
+                        break
+                    pos = urwid.util.move_next_char(text, pos, len(text))
+                else:
+                    if pos <= 0:
+                        break
+                    pos = urwid.util.move_prev_char(text, 0, pos)
+                done += 1
+            line.set_edit_pos(pos)
+            return done
+        if key == 'up' or key == 'down':
+            pos = self.focus_position
+            if key == 'down':
+                cfrom = 'above'
+                self.jump(min(pos + count, len(self.lines) - 1), cfrom)
+            else:
+                cfrom = 'below'
+                self.jump(max(pos - count, 0), cfrom)
+            self.display.update_line_numbers(cfrom=cfrom)
+            return count
+        for i in range(count):
+            super().keypress(size, key)
+        self.display.update_line_numbers()
+        return count
+
+    def jump(self, target, cfrom):
+        # focus target, scrolled the way as many up or down presses would have.
+        # Every line is one row (they are clipped), so that's easy to work out
+        size = self.size
+        middle, top, bottom = self.calculate_visible(size, True)
+        if middle is None:
+            return
+        offset, widget, pos = middle[:3]
+        if cfrom == 'above':
+            offset = min(offset + target - pos, size[1] - 1)
+        else:
+            offset = max(offset - (pos - target), 0)
+        if target != pos:
+            self.change_focus(size, target, offset, cfrom)
+
+    def paste(self, text):
+        # a paste is spliced into the buffer in one edit, however many lines it
+        # has, and is taken back with a single undo
+        cur_tab = self.display.tab_info[self.fname]
+        if cur_tab.results is not None:
+            return 0
+        cur_tab.undo.new_action('paste')
+        line = self.focus
+        row = self.focus_position
+        head, tail = line.edit_text[:line.edit_pos], line.edit_text[line.edit_pos:]
+        parts = text.split('\n')
+        # tabs are expanded like the tab key would have
+        lines = [(head + parts[0]).expandtabs(line.tab)] + [part.expandtabs(line.tab) for part in parts[1:]]
+        col = len(lines[-1])
+        lines[-1] += tail
+        if len(lines) == 1:
+            line.set_edit_text(lines[0])
+        else:
+            self.lines.splice(row, lines)
+            self.jump(row + len(lines) - 1, 'above')
+            self.display.update_line_numbers(cfrom='above')
+        self.focus.set_edit_pos(col)
+        return len(text)
+
 class MainGUI(object):
-    def __init__(self):
+    def __init__(self, profile=None, trace=None):
         # set up all the empty lists, dicts and strings needed
         # also create the widgets that will be used later
+        self.profile = profile # a StartupTimer with --profile-startup
+        self.trace_path = trace # where --trace writes the frame trace on exit
+        self.tracer = FrameTracer(self.show_hud)
+        self.hud = False
         self.cwd = os.getcwd()
         self.tab_info = {}
         self.file_names = []
@@ -842,12 +1378,26 @@ class MainGUI(object):
         self.state = ''
         self.rows = 0
 
+        self.loop = None
+        self.polling = False
+        self.worker = None
+        self.grep = None # the find in files search that is running
+        self.saves = {} # fname -> the FileSave writing it in the background
+        self.prefetching = False
+        self.prefetch = None # the TabPrefetch reading a tab in the background
+        self.session = Session(SESSION_PATH)
+        self.session.dump = self.dump_tab
+
         # this variable represents the UI layout. if this value is False
         # then the tabs are on bottom and status is on top. when this value
         # is True then the layout is switched!
         self.layout = False
 
+        self.lexers = LexerCache()
+        self.palettes = PaletteCache()
+        self.colors = 256
         self.configure()
+        self.mark('config')
 
         self.stext = ('header', ['SCUM   ',
                                     ('key', 'ESC'), ' Help ',
@@ -878,11 +1428,19 @@ class MainGUI(object):
         self.fedit = urwid.AttrMap(self.finder, 'footer')
 
         # openfile state GUI
-        self.new_files = []
+        # the flagged files, a dict so they open in the order they were flagged
+        self.new_files = {}
         self.openfile_top = urwid.Text(self.openfile_stext)
         self.oftbar = urwid.AttrMap(self.openfile_top, 'header')
 
-        self.browser = urwid.TreeListBox(urwid.TreeWalker(DirectoryNode(self.cwd, self)))
+        self.browser_cache = BrowserCache(self)
+        # quick open is made the first time it is used, it starts indexing right away
+        self.quick = None
+        self.quick_stext = ('header', ['Quick Open: type part of a path ',
+                                    ('key', 'Enter'), ' Open ',
+                                    ('key', 'Esc'), ' Cancel'])
+        self.qtbar = urwid.AttrMap(urwid.Text(self.quick_stext), 'header')
+        self.browser = urwid.TreeListBox(self.browser_cache.walker(self.cwd))
         self.browser.offset_rows = 1
         urwid.AttrWrap(self.browser, 'browse')
 
@@ -894,44 +1452,85 @@ class MainGUI(object):
 
         self.state = 'editor'
 
-        self.term = ToggleTerm(self)
-        self.termbox = urwid.LineBox(self.term)
+        # the terminal is made the first time it is opened
+        self.term = None
+        self.termbox = None
 
         self.pile = urwid.Pile([self.top])
+        self.mark('widgets')
         self.open_tabs()
 
         if len(self.tabs) == 0:
             self.listbox.populate(START_PATH)
+        self.mark('open tabs')
+
+    def mark(self, phase):
+        if self.profile is not None:
+            self.profile.mark(phase)
+
+    def first_frame(self):
+        # the main loop draws the screen before running its other idle callbacks. This
+        # can't remove itself while the idle callbacks are being run, so it's done after
+        self.mark('first frame')
+        self.loop.set_alarm_in(0, lambda loop, data: loop.event_loop.remove_enter_idle(self.idle_handle))
 
     def display(self):
         # this method starts the main loop and such
-        self.loop = urwid.MainLoop(self.pile,
-                                   self.palette,
-                                   handle_mouse = False,
-                                   unhandled_input = self.keypress,
-                                   pop_ups = True)
-        self.loop.screen.set_terminal_properties(colors=256)
+        # bursts of keys and pastes are handed to batch_input before the widgets
+        self.loop = BatchLoop(self.pile,
+                              self.palette,
+                              handle_mouse = False,
+                              unhandled_input = self.keypress,
+                              pop_ups = True,
+                              screen = DamageScreen(),
+                              batch = self.batch_input,
+                              bound = self.bound_keys)
+        self.loop.screen.scrolling = self.config['scrollregion'] != 'no'
+        if self.use_truecolor():
+            self.colors = TRUECOLOR
+        self.loop.screen.set_terminal_properties(colors=self.colors)
         self.register_palette()
-
-        self.term.main_loop = self.loop
+        self.poll_loading()
+        self.mark('palette')
+
+        # from now on syntax highlighting is done in the background
+        self.worker = HighlightWorker(self.loop.watch_pipe(self.highlight_done))
+        for info in self.tab_info.values():
+            info.lines.highlighter.worker = self.worker
+        self.listbox.lines.highlighter.worker = self.worker
+
+        self.loop.set_alarm_in(2, self.journal_session)
+        self.start_prefetch()
+        if self.profile is not None:
+            self.idle_handle = self.loop.event_loop.enter_idle(self.first_frame)
+        if self.trace_path is not None:
+            self.start_tracing()
         try:
             self.loop.run()
         except:
             return 'failure'
-
-        with open(TABS_PATH, 'a') as f:
-            f.write(str(self.layout))
+        finally:
+            # don't lose a save that is still being written
+            for save in list(self.saves.values()):
+                save.thread.join()
+            self.journal_session()
+            self.session.close_journal()
+            if self.trace_path is not None:
+                self.write_trace(self.trace_path)
 
         return 'exit'
 
     def configure(self):
         # this method is run to re-parse the config and set the palette
         self.config = read_config()
+        self.lexers.set_overrides(self.config['lexers'])
+        # characters that are bound to something can't be typed in a batch
+        self.bound_keys = {v for v in self.config.values() if isinstance(v, str) and len(v) == 1}
+        if self.loop is not None:
+            self.loop.bound = self.bound_keys
+            self.loop.screen.scrolling = self.config['scrollregion'] != 'no'
 
-        self.style = get_style_by_name(self.config['style'])
-
-        for item in palette_items:
-            self.palette.append(tuple(self.config[item]))
+        self.palette = [tuple(self.config[item]) for item in palette_items]
 
     def update_top_bar(self):
         self.stext = ('header', ['SCUM   ',
@@ -945,6 +1544,13 @@ class MainGUI(object):
 
         self.top.contents['header'] = (self.status, None)
 
+    def show_message(self, text):
+        # put a message in the top bar until the next one (or until it is reset)
+        self.tbar.set_text(('header', text))
+
+    def clear_message(self):
+        self.tbar.set_text(self.stext)
+
     def update_status(self):
         # this method is runs to update the top bar depending on the current state
         col, self.rows = self.loop.screen.get_cols_rows()
@@ -955,18 +1561,51 @@ class MainGUI(object):
         extra = col - len(selected) - 1
         self.ofbbar.set_text(selected)
 
+    def clear_flagged(self):
+        # the browser trees are kept between openings, so the widgets that were
+        # flagged have to be drawn unflagged again
+        flagged = self.new_files
+        self.new_files = {}
+        self.browser_cache.update_flagged(flagged)
+
+    def quick_open(self):
+        # find a file under the directory the editor started in by typing part of its path
+        if self.quick is None:
+            self.quick = QuickOpen(self, self.cwd)
+        self.quick.start()
+        self.switch_states('quickopen')
+
+    def close_quick_open(self, fname=None):
+        self.switch_states('editor')
+        if fname is not None:
+            self.listbox.populate(fname)
+            # populate leaves a file that was open already alone, so switch to it
+            if fname in self.tab_info:
+                self.listbox.switch_tabs(fname)
+        else:
+            self.listbox.redraw_tabs()
+
+    def batch_input(self, run):
+        # a run of keys from the main loop (see modules/batch.py), returns how
+        # many of its keys were taken care of, the rest go through the widgets
+        listbox = self.listbox
+        if (self.state != 'editor' or self.finding or listbox.size is None or
+                self.pile.focus is not self.top or self.top.focus_position != 'body' or
+                self.body_col.focus is not listbox or listbox.focus is None):
+            return 0
+        kind = run[0]
+        if kind == 'text':
+            return listbox.type_text(run[1])
+        if kind == 'move':
+            return listbox.move(run[1], run[2])
+        if kind == 'paste':
+            return listbox.paste(run[1])
+        return 0
+
     def update_line_numbers(self, cfrom=None):
+        # the gutter reads the scroll position when it is drawn, it only needs a redraw
         if self.show_lnums:
-            focus_pos = self.listbox.focus_position
-            lnums = self.line_nums
-            lnums.set_focus(focus_pos, coming_from=cfrom)
-            foc = lnums.numbers[focus_pos]
-
-            prev = lnums.numbers[lnums.previous]
-            lnums.numbers[lnums.previous] = urwid.Text(prev.text, align='right')
-
-            lnums.numbers[focus_pos] = urwid.AttrWrap(foc, 'key')
-            lnums.previous = focus_pos
+            self.line_nums.update()
 
     def switch_states(self, state):
         # this method is run to switch states, it reassigns what content is in the Frame
@@ -980,28 +1619,141 @@ class MainGUI(object):
 
         elif state == 'openfile':
             path = strip_path(self.listbox.fname)
-            self.browser = urwid.TreeListBox(urwid.TreeWalker(DirectoryNode(path, self)))
+            self.browser = urwid.TreeListBox(self.browser_cache.walker(path))
             self.top.contents['header'] = (self.oftbar, None)
             self.top.contents['body'] = (self.browser, None)
             self.top.contents['footer'] = (self.ofbbar, None)
             self.ofbbar.set_text('')
 
+        elif state == 'quickopen':
+            self.top.contents['header'] = (self.qtbar, None)
+            self.top.contents['body'] = (self.quick, None)
+            self.top.contents['footer'] = (None, None)
+
         self.state = state
 
+    def highlight_done(self, data):
+        # runs in the main loop whenever the highlight worker finished some jobs
+        for job in self.worker.finished():
+            job.highlighter.finish(job)
+        return True
+
+    def save_done(self, save):
+        # runs in the main loop whenever a background save wrote another chunk
+        name = strip_fname(save.fname)
+        if save.saving:
+            self.show_message('saving %s... %d%%' % (name, save.percent()))
+            return True
+        if self.saves.get(save.fname) is save:
+            del self.saves[save.fname]
+        if save.cancelled.is_set():
+            return False
+        if save.error is not None:
+            error = getattr(save.error, 'strerror', None) or save.error
+            self.show_message('could not save %s: %s' % (name, error))
+        else:
+            self.clear_message()
+            self.listbox.saved(save.fname, save.buffer.version, save.saved)
+        return False
+
+    def find_in_files(self, query, regex=False, case=True, word=False):
+        # search every file under the directory the file browser starts in, the
+        # results are listed in their own tab as they come in
+        if not query:
+            return
+        if self.grep is not None:
+            self.grep.cancel()
+            self.loop.remove_watch_pipe(self.grep.pipe)
+
+        if RESULTS_TAB not in self.tab_info:
+            self.listbox.add_tab(RESULTS_TAB, TextBuffer.from_text(''), self.lexers.plain)
+            self.listbox.redraw_tabs()
+            # the results are never edited so there is nothing to undo
+            self.tab_info[RESULTS_TAB].lines.undo = None
+        info = self.tab_info[RESULTS_TAB]
+        # the first line says what was searched for, every other line is a result
+        info.lines.delete_lines(1, len(info.lines))
+        info.results = [None]
+        self.listbox.switch_tabs(RESULTS_TAB)
+        self.listbox.set_focus(0)
+
+        pipe = self.loop.watch_pipe(self.grep_done)
+        self.grep = FileSearch(self.cwd, query, pipe, regex, case, word)
+        self.update_results()
+
+    def grep_done(self, data):
+        # runs in the main loop whenever the find in files workers have new results
+        grep = self.grep
+        info = self.tab_info.get(RESULTS_TAB)
+        if grep is None:
+            return False
+        if info is None: # the results tab was closed
+            grep.cancel()
+            self.grep = None
+            return False
+
+        lines = []
+        for path, row, col, text in grep.finished():
+            lines.append('%s:%d: %s' % (os.path.relpath(path, grep.root), row + 1, text))
+            # the cursor goes to the match, not the start of the result line
+            info.results.append((path, row, col))
+        if lines:
+            info.lines.insert_lines(len(info.lines), lines)
+        self.update_results()
+
+        if not grep.searching:
+            self.grep = None
+            return False
+        return True
+
+    def update_results(self):
+        grep = self.grep
+        header = "find in files: '%s' in %s - %d matches in %d files" % (
+            grep.query, grep.root, grep.count, grep.files)
+        if grep.searching:
+            header += ' (searching...)'
+        self.tab_info[RESULTS_TAB].lines[0].set_edit_text(header)
+        if self.listbox.fname == RESULTS_TAB:
+            self.update_line_numbers()
+
+    def poll_loading(self, loop=None, data=None):
+        # while big files are still being indexed in the background this runs every
+        # half second to add the lines that have been found so far
+        self.polling = False
+        if self.loop is None:
+            return
+
+        loading = False
+        for fname, info in self.tab_info.items():
+            buffer = info.lines.buffer
+            loading = loading or buffer.loading
+            if buffer.sync() and fname == self.listbox.fname:
+                info.lines._modified()
+                self.update_line_numbers()
+        if self.finding:
+            # search the lines that were added, and drop "so far" once the file is done
+            self.finder.extend()
+
+        if loading:
+            self.polling = True
+            self.loop.set_alarm_in(0.5, self.poll_loading)
+
     def toggle_line_numbers(self):
         self.show_lnums = not self.show_lnums
         if self.show_lnums:
-            self.line_nums.populate(self.listbox.lines)
-            self.body_col = urwid.Columns([(self.line_nums.width+2, self.line_nums), self.listbox], focus_column=1)
+            self.line_nums.width = len(str(len(self.listbox.lines)))
+            self.body_col.contents.insert(0, (self.line_nums, self.body_col.options('given', self.line_nums.width+2)))
         else:
             self.body_col.contents.pop(0)
-
-        self.top.contents['body'] = (self.body_col, None)
+        self.body_col.focus_position = len(self.body_col.contents) - 1
         self.update_line_numbers()
 
     def toggle_term(self):
         self.show_term = not self.show_term
         if self.show_term:
+            if self.term is None:
+                self.term = ToggleTerm(self)
+                self.termbox = urwid.LineBox(self.term)
             cols, rows = self.loop.screen.get_cols_rows()
             height = min(25, rows/2)
             pile = self.pile
@@ -1011,36 +1763,162 @@ class MainGUI(object):
         else:
             self.pile.contents.pop(-1)
 
+    def start_tracing(self):
+        # time each frame (see modules/trace.py), the methods are only wrapped while this is on
+        self.tracer.enable([
+            (self.loop, 'process_input', 'input'),
+            (Highlighter, 'get_attribs', 'highlight'),
+            (Highlighter, 'finish', 'highlight'),
+            (self, 'update_line_numbers', 'line numbers'),
+            (LineNumbers, 'render', 'line numbers'),
+            (self.loop, 'draw_screen', 'render'),
+            (self.loop.screen, 'draw_screen', 'flush'),
+        ])
+        if hasattr(self.loop.screen, 'take_written'):
+            # the bytes sent to the terminal, what counts over a slow ssh link
+            self.loop.screen.take_written()
+            self.tracer.counters['tty bytes'] = self.loop.screen.take_written
+
+    def toggle_hud(self):
+        # show the frame times in the top bar, turning it off writes out the trace
+        self.hud = not self.hud
+        # the frame times are kept to one line so the screen below doesn't move
+        self.tbar.set_wrap_mode('clip' if self.hud else 'space')
+        if self.hud:
+            self.start_tracing()
+            self.show_message('frame times on, %s again to write the trace' % self.config['hud'])
+            return
+        fname = self.trace_path or os.path.join(state_dir(), 'trace.json')
+        if self.trace_path is None:
+            self.tracer.disable()
+        if self.write_trace(fname):
+            self.show_message('trace written to %s' % fname)
+
+    def write_trace(self, fname):
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(fname)), exist_ok=True)
+            self.tracer.write(fname)
+        except OSError as e:
+            self.show_message('could not write %s: %s' % (fname, e.strerror))
+            return False
+        return True
+
+    def show_hud(self, phases):
+        # the tracer calls this after each frame, it shows up in the next one
+        if self.hud:
+            self.tbar.set_text(('header', self.tracer.summary(phases)))
+
     def toggle_layout(self):
         self.layout = not self.layout
+        self.session.set_layout(self.layout)
         content = self.top.contents
         content['header'], content['footer'] = content['footer'], content['header']
 
     def open_tabs(self):
-        # this method reads the saved tabs from the data file and opens the files on start up
-        with open(TABS_PATH, 'r') as f:
-            lines = [line.strip('\n') for line in f.readlines()]
-        if len(lines) == 0:
-            with open(TABS_PATH, 'w') as f:
-                f.write(START_PATH + '\n')
-                f.write('False')
-            self.listbox.populate(START_PATH)
+        # this method reads the last session from the journal and puts its tabs back on
+        # start up. Only the tab that was focused is read, the others are read when they
+        # are switched to or prefetched once the editor is idle
+        session = self.session
+        if not session.load():
+            self.import_tabs()
+        for tab in list(session.tabs.values()):
+            if not os.path.isfile(tab.path): # the file is gone
+                session.close(tab.path)
+                continue
+            self.listbox.add_placeholder(tab)
+        if self.file_names:
+            active = session.active
+            if active not in self.tab_info:
+                active = self.file_names[-1]
+            self.listbox.switch_tabs(active)
+            self.listbox.redraw_tabs()
+        if session.layout:
+            self.toggle_layout()
 
+    def import_tabs(self):
+        # bring over the tabs saved in tabs.dat by older versions
+        try:
+            with open(TABS_PATH, 'r') as f:
+                lines = [line.strip('\n') for line in f.readlines()]
+        except OSError:
+            return
         for line in lines:
-            if line != lines[-1]:
-                self.listbox.populate(line)
+            if line in ('True', 'False'):
+                self.session.set_layout(line == 'True')
+            elif line:
+                self.session.open(line)
+
+    def start_prefetch(self):
+        if self.loop is not None and not self.prefetching and self.config['prefetch'] != 'no':
+            self.prefetching = True
+            self.loop.set_alarm_in(0.5, self.prefetch_tabs)
+
+    def prefetch_tabs(self, loop=None, data=None):
+        # reads the placeholder tabs next to the current one, one at a time on a
+        # background thread, so switching to them doesn't have to wait for the disk
+        index = self.cur_tab.index
+        for i in (index + 1, index - 1):
+            if 0 <= i < len(self.file_names):
+                tab = self.tab_info[self.file_names[i]].pending
+                if tab is not None:
+                    prefetch = None
+                    pipe = self.loop.watch_pipe(lambda data: self.prefetch_done(prefetch))
+                    prefetch = self.prefetch = TabPrefetch(tab, self.listbox.read_tab, pipe)
+                    return
+        self.prefetching = False
+
+    def prefetch_done(self, prefetch):
+        # runs in the main loop once a prefetched file was read
+        info = self.tab_info.get(prefetch.tab.path)
+        # the tab might have been closed or switched to (and loaded) in the meantime
+        if info is not None and info.pending is prefetch.tab:
+            self.listbox.load_tab(prefetch.tab.path)
+        self.prefetch = None
+        self.prefetching = False
+        self.start_prefetch()
+        return False
+
+    def journal_session(self, loop=None, data=None):
+        # runs every couple of seconds, writes the unsaved edits and the cursor
+        # position to the session journal and makes sure it's on the disk
+        for fname, info in self.tab_info.items():
+            buffer = info.lines.buffer
+            version = buffer.version
+            if version == info.journaled or info.results is not None:
+                continue
+            if buffer.loading:
+                continue # the pieces only cover the lines found so far, wait for the rest
+            if version == info.saved_version:
+                self.session.saved(fname)
+                buffer.log = None
+            elif info.base is None:
+                buffer.log = None
             else:
-                if line == 'True':
-                    self.toggle_layout()
-
-        self.save_tabs()
-
-    def save_tabs(self):
-        # this method is run whenever a tab is opened or closed, it writes
-        # the current open file names to a data file to be read on start up
-        with open(TABS_PATH, 'w') as f:
-            for tab in self.file_names:
-                f.write(tab + '\n')
+                # only the edits since the last time are written, unless the piece
+                # table is shorter than that (after a replace all) or there isn't one
+                log = buffer.log
+                if log is None or len(log) > len(buffer.pieces) or not self.session.lines(fname, log):
+                    self.session.edits(fname, info.base, buffer.dump_pieces())
+                buffer.log = []
+            info.journaled = version
+        listbox = self.listbox
+        if listbox.focus is not None:
+            self.session.cursor(listbox.fname, listbox.focus_position, listbox.focus.edit_pos)
+        self.session.sync()
+        if loop is not None:
+            loop.set_alarm_in(2, self.journal_session)
+
+    def dump_tab(self, path):
+        # the whole piece table of a tab for the session to compact the journal with,
+        # only if everything in it was journaled already
+        info = self.tab_info.get(path)
+        if info is None or info.pending is not None or info.base is None:
+            return None
+        buffer = info.lines.buffer
+        if buffer.loading or buffer.version != info.journaled:
+            return None
+        buffer.log = []
+        return info.base, buffer.dump_pieces()
 
     def keypress(self, k):
         # this method handles any keypresses that are unhandled by other widgets
@@ -1060,14 +1938,12 @@ class MainGUI(object):
             # current text line with the one prior. This function
             # returns the length of the previous line. We have to wait to set the edit_pos
             # because self.loop.process_input changes the edit_pos
-            if self.listbox.focus_position != 0:
-                self.line_nums.sub()
             self.listbox.combine_previous()
-            self.cur_tab.undo.log('backspace', [self.listbox.focus_position, self.listbox.focus.edit_pos], 1)
+            self.update_line_numbers()
 
         elif k == 'delete':
             self.listbox.combine_next()
-            self.cur_tab.undo.log('backspace', [self.listbox.focus_position, self.listbox.focus.edit_pos], 1)
+            self.update_line_numbers()
 
         # this keypress opens up the configuration file so it can be edited
         elif k == self.config['config']:
@@ -1080,22 +1956,27 @@ class MainGUI(object):
                 self.listbox.focus.set_edit_text('')
                 return
 
-            self.cur_tab.undo.log(self.listbox.focus.edit_text+'\n', [self.listbox.focus_position, 0], 1)
-            self.line_nums.sub()
             self.listbox.del_line()
+            self.update_line_numbers()
 
         elif k == self.config['layout']:
             self.toggle_layout()
 
+        elif k == self.config['hud']:
+            self.toggle_hud()
+
         elif k == self.config['linenum']:
             self.toggle_line_numbers()
 
         elif k == self.config['terminal']:
             self.toggle_term()
 
+        elif k == self.config['quickopen']:
+            self.quick_open()
+
         elif k == self.config['open']:
-            self.new_files = []
-            self.browser = urwid.TreeListBox(urwid.TreeWalker(DirectoryNode(self.cwd, self)))
+            self.clear_flagged()
+            self.browser = urwid.TreeListBox(self.browser_cache.walker(self.cwd))
             self.browser.offset_rows = 1
             self.switch_states('openfile')
 
@@ -1112,16 +1993,18 @@ class MainGUI(object):
                 else:
                     self.listbox.populate(self.file_names[0])
 
-                self.new_files = []
-                self.save_tabs()
+                self.clear_flagged()
 
         elif k == self.config['find']:
             self.finding = True
+            self.finder.start()
             self.top.contents['footer'] = (self.fedit, None)
 
         elif k == self.config['undo']:
             self.cur_tab.undo.undo()
-            self.update_line_numbers()
+
+        elif k == self.config['redo']:
+            self.cur_tab.undo.redo()
 
         elif k == 'ctrl x':
             # get outta here!
@@ -1133,30 +2016,24 @@ class MainGUI(object):
 
     def register_palette(self):
         """Converts pygmets style to urwid palatte"""
+        # the conversion is cached per style (see modules/palette.py), so this is
+        # quick even when switching themes with the config
         default = 'default'
         palette = list(self.palette)
-        mapping = CONFIG['rgb_to_short']
-        for tok in self.style.styles.keys():
-            for t in tok.split()[::-1]:
-                st = self.style.styles[t]
-                if '#' in st:
-                    break
-            if '#' not in st:
-                st = ''
-            st = st.split()
-            st.sort()   # '#' comes before '[A-Za-z0-9]'
-            if len(st) == 0:
-                c = default
-            elif st[0].startswith('bg:'):
-                c = default
-            elif len(st[0]) == 7:
-                c = 'h' + rgb_to_short(st[0][1:], mapping)[0]
-            elif len(st[0]) == 4:
-                c = 'h' + rgb_to_short(st[0][1]*2 + st[0][2]*2 + st[0][3]*2, mapping)[0]
-            else:
-                c = default
-            a = urwid.AttrSpec(c, default, colors=256)
-            row = (tok, default, default, default, a.foreground, default)
-            palette.append(row)
+        for tok, fg in self.palettes.get(self.config['style'], self.colors):
+            palette.append((tok, default, default, default, fg, default))
         self.loop.screen.register_palette(palette)
 
+    def use_truecolor(self):
+        # truecolor needs a terminal that says it can do it and an urwid that knows about it
+        setting = self.config['truecolor']
+        if setting == 'no':
+            return False
+        if setting != 'yes' and os.environ.get('COLORTERM') not in ('truecolor', '24bit'):
+            return False
+        try:
+            urwid.AttrSpec('#ffffff', 'default', colors=TRUECOLOR)
+        except Exception:
+            return False
+        return True
+
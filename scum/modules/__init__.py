@@ -1,10 +1,36 @@
 
 try:
-    from scum.modules.browse import DirectoryNode
+    from scum.modules.batch import BatchLoop, PasteScreen
+    from scum.modules.damage import DamageScreen
+    from scum.modules.browse import DirectoryNode, BrowserCache
     from scum.modules.term import ToggleTerm
     from scum.modules.popup import *
+    from scum.modules.buffer import TextBuffer, MappedLines, StringLines
+    from scum.modules.highlight import Highlighter, HighlightWorker
+    from scum.modules.lexers import LexerCache
+    from scum.modules.palette import PaletteCache, TRUECOLOR
+    from scum.modules.search import SearchIndex, replace_lines, replace_match
+    from scum.modules.grep import FileSearch
+    from scum.modules.quickopen import QuickOpen
+    from scum.modules.save import FileSave, write_lines, saved_lines
+    from scum.modules.session import Session, TabPrefetch, file_base, state_dir
+    from scum.modules.timing import StartupTimer
+    from scum.modules.trace import FrameTracer
 
 except:
-    from modules.browse import DirectoryNode
+    from modules.batch import BatchLoop, PasteScreen
+    from modules.damage import DamageScreen
+    from modules.browse import DirectoryNode, BrowserCache
     from modules.term import ToggleTerm
     from modules.popup import *
+    from modules.buffer import TextBuffer, MappedLines, StringLines
+    from modules.highlight import Highlighter, HighlightWorker
+    from modules.lexers import LexerCache
+    from modules.palette import PaletteCache, TRUECOLOR
+    from modules.search import SearchIndex, replace_lines, replace_match
+    from modules.grep import FileSearch
+    from modules.quickopen import QuickOpen
+    from modules.save import FileSave, write_lines, saved_lines
+    from modules.session import Session, TabPrefetch, file_base, state_dir
+    from modules.timing import StartupTimer
+    from modules.trace import FrameTracer
@@ -0,0 +1,132 @@
+import urwid
+from urwid import raw_display
+
+# the terminal hands the main loop every key that came in since it last
+# looked, and the main loop draws the screen once after all of them. When keys
+# repeat or text is pasted that can be hundreds of keys, and each one still
+# went through every widget on the way down to the editor. The batching loop
+# splits a burst into runs first:
+#
+#   ['a', 'b', 'c', 'down', 'down', 'down', 'ctrl s']
+#   -> ('text', 'abc'), ('move', 'down', 3), ('key', 'ctrl s')
+#
+# and offers each run to a handler, which does the whole run in one go if it
+# can (one insert for the text, one jump for the moves) and says how many of
+# its keys it took care of. Whatever is left goes through the widgets one key
+# at a time like before.
+#
+# the terminal is also asked for bracketed paste, so a paste arrives wrapped
+# in 'begin paste' and 'end paste' and is handed over as a single
+# ('paste', text) run, even if it took more than one read to come in.
+
+MOVE_KEYS = frozenset(['up', 'down', 'left', 'right', 'page up', 'page down'])
+# the keys a paste is made of that aren't the character itself
+PASTE_KEYS = {'enter': '\n', 'tab': '\t'}
+
+
+def is_char(key):
+    return isinstance(key, str) and len(key) == 1 and key.isprintable()
+
+
+def run_keys(run):
+    # the keys a run was made from
+    kind = run[0]
+    if kind == 'text':
+        return list(run[1])
+    if kind == 'move':
+        return [run[1]] * run[2]
+    if kind == 'paste':
+        keys = {v: k for k, v in PASTE_KEYS.items()}
+        return [keys.get(ch, ch) for ch in run[1]]
+    return [run[1]]
+
+
+def coalesce(keys, bound=()):
+    # split keys into runs, the characters in bound are kept as keys of their own
+    runs = []
+    for key in keys:
+        last = runs[-1] if runs else None
+        if is_char(key) and key not in bound:
+            if last is not None and last[0] == 'text':
+                last[1].append(key)
+            else:
+                runs.append(['text', [key]])
+        elif key in MOVE_KEYS:
+            if last is not None and last[0] == 'move' and last[1] == key:
+                last[2] += 1
+            else:
+                runs.append(['move', key, 1])
+        else:
+            runs.append(['key', key])
+    for run in runs:
+        if run[0] == 'text':
+            run[1] = ''.join(run[1])
+    return [tuple(run) for run in runs]
+
+
+class PasteScreen(raw_display.Screen):
+    """A raw_display screen that turns on bracketed paste while it runs"""
+
+    def _start(self, *args, **kwargs):
+        ret = super()._start(*args, **kwargs)
+        self.write('\x1b[?2004h')
+        self.flush()
+        return ret
+
+    def _stop(self):
+        self.write('\x1b[?2004l')
+        self.flush()
+        return super()._stop()
+
+
+class BatchLoop(urwid.MainLoop):
+    """A MainLoop that offers bursts of keys to batch before dispatching them"""
+
+    def __init__(self, *args, batch=None, bound=(), **kwargs):
+        super().__init__(*args, **kwargs)
+        # batch(run) returns how many of the keys of run it took care of
+        self.batch = batch
+        self.bound = bound # keys that have to go through the widgets, even if they are characters
+        self.pasting = None # the keys of a paste that hasn't ended yet
+
+    def process_input(self, keys):
+        if self.batch is None or (len(keys) == 1 and self.pasting is None and keys[0] != 'begin paste'):
+            return super().process_input(keys)
+        handled = False
+        pending = [] # keys that go through the widgets as they are
+        for run in self.runs(keys):
+            if run[0] == 'key':
+                pending.append(run[1])
+                continue
+            if pending:
+                handled = super().process_input(pending) or handled
+                pending = []
+            left = run_keys(run)[self.batch(run):]
+            if left:
+                handled = super().process_input(left) or handled
+            else:
+                handled = True
+        if pending:
+            handled = super().process_input(pending) or handled
+        return handled
+
+    def runs(self, keys):
+        # the runs in keys, with everything between 'begin paste' and 'end paste' as one
+        start = 0
+        for i, key in enumerate(keys):
+            if self.pasting is not None:
+                if key == 'end paste':
+                    text = ''.join(PASTE_KEYS.get(k, k) for k in self.pasting if k in PASTE_KEYS or is_char(k))
+                    self.pasting = None
+                    if text:
+                        yield ('paste', text)
+                    start = i + 1
+                else:
+                    self.pasting.append(key)
+            elif key == 'begin paste':
+                yield from coalesce(keys[start:i], self.bound)
+                self.pasting = []
+            if self.pasting is not None:
+                start = i + 1
+        if self.pasting is None:
+            yield from coalesce(keys[start:], self.bound)
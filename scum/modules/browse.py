@@ -30,9 +30,13 @@ Features:
 - outputs a quoted list of files and directories "selected" on exit
 """
 
+import collections
+import heapq
 import itertools
 import re
 import os
+import threading
+import time
 
 import urwid
 
@@ -49,9 +53,14 @@ class FlagFileWidget(urwid.TreeWidget):
         self.display= display
         # insert an extra AttrWrap for our own use
         self._w = urwid.AttrWrap(self._w, None)
-        self.flagged = False
         self.update_w()
 
+    @property
+    def flagged(self):
+        # the flagged paths are kept by the display, so a widget that is shown
+        # again in a later opening of the browser doesn't keep an old flag
+        return self.get_node().get_value() in self.display.new_files
+
     def selectable(self):
         return True
 
@@ -68,11 +77,11 @@ class FlagFileWidget(urwid.TreeWidget):
         Default behavior: Toggle flagged on space, ignore other keys.
         """
         if key == " ":
+            path = self.get_node().get_value()
             if not self.flagged:
-                self.display.new_files.append(self.get_node().get_value())
+                self.display.new_files[path] = None
             else:
-                self.display.new_files.remove(self.get_node().get_value())
-            self.flagged = not self.flagged
+                del self.display.new_files[path]
             self.update_w()
             self.display.update_status()
         else:
@@ -93,8 +102,6 @@ class FileTreeWidget(FlagFileWidget):
     """Widget for individual files."""
     def __init__(self, node, display):
         self.__super.__init__(node, display)
-        path = node.get_value()
-        add_widget(path, self)
 
     def get_display_text(self):
         return self.get_node().get_key()
@@ -114,12 +121,18 @@ class ErrorWidget(urwid.TreeWidget):
         return ('error', "(error/permission denied)")
 
 
+class LoadingWidget(urwid.TreeWidget):
+    """A marker for directories that are still being read."""
+
+    def get_display_text(self):
+        return ('flag', '(loading\u2026)')
+
+
 class DirectoryWidget(urwid.TreeWidget):
     """Widget for a directory."""
     def __init__(self, node):
         self.__super.__init__(node)
         path = node.get_value()
-        add_widget(path, self)
         self.expanded = starts_expanded(path)
         self.update_expanded_icon()
 
@@ -160,11 +173,176 @@ class ErrorNode(urwid.TreeNode):
         return ErrorWidget(self)
 
 
+class LoadingNode(urwid.TreeNode):
+    def load_widget(self):
+        return LoadingWidget(self)
+
+
+def scan_directory(path):
+    # (sort key, name, is a directory) for everything in path. scandir knows the
+    # type of most entries already, so unlike isdir() this doesn't stat every file
+    with os.scandir(path) as entries:
+        for entry in entries:
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                is_dir = False
+            yield alphabetize(entry.name), entry.name, is_dir
+
+
+def directory_mtime(path):
+    # adding, removing or renaming anything in a directory changes its mtime
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+class Listing(object):
+    """The sorted contents of a directory as they were at mtime"""
+
+    def __init__(self, mtime):
+        self.mtime = mtime
+        # dirs and files are kept apart, each sorted as (sort key, name)
+        self.dirs = []
+        self.files = []
+        self.dir_names = set()
+
+    def __len__(self):
+        return len(self.dirs) + len(self.files)
+
+    def add_entries(self, entries):
+        # sort the new entries and merge them in, so a huge directory is sorted a
+        # batch at a time instead of all over again for every batch
+        dirs = sorted((key, name) for key, name, is_dir in entries if is_dir)
+        files = sorted((key, name) for key, name, is_dir in entries if not is_dir)
+        if dirs:
+            self.dirs = list(heapq.merge(self.dirs, dirs))
+            self.dir_names.update(name for key, name in dirs)
+        if files:
+            self.files = list(heapq.merge(self.files, files))
+
+    def keys(self):
+        # dirs first, then files
+        return [name for key, name in self.dirs] + [name for key, name in self.files]
+
+
+class DirectoryScan(object):
+    """Reads a directory on a background thread, the entries are picked up with finished()"""
+
+    batch_time = 0.05 # seconds between handing entries to the main loop
+
+    def __init__(self, path, pipe):
+        self.path = path
+        self.pipe = pipe
+        self.listing = None
+        self.done = collections.deque()
+        self.error = None
+        self.scanning = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        try:
+            batch = []
+            last = time.monotonic()
+            for entry in scan_directory(self.path):
+                batch.append(entry)
+                if time.monotonic() - last >= self.batch_time:
+                    self.done.append(batch)
+                    self.notify()
+                    batch = []
+                    last = time.monotonic()
+            self.done.append(batch)
+        except OSError as e:
+            self.error = e
+        finally:
+            self.scanning = False
+            self.notify()
+            # the main loop closes its end once it sees the scan is over
+            os.close(self.pipe)
+
+    def notify(self):
+        try:
+            os.write(self.pipe, b'.')
+        except OSError:
+            pass
+
+    def finished(self):
+        while self.done:
+            yield self.done.popleft()
+
+
+class BrowserCache(object):
+    """Directory listings and browser trees kept between openings of the file browser"""
+
+    max_entries = 200000 # names kept over all the cached listings
+    max_roots = 8 # trees kept, one for each directory the browser was opened in
+
+    def __init__(self, display):
+        self.display = display
+        # both are in least recently used order
+        self.listings = collections.OrderedDict() # path -> Listing
+        self.entries = 0
+        self.roots = collections.OrderedDict() # path -> root DirectoryNode
+
+    def listing(self, path):
+        # the cached listing of path, or None if there isn't one or the directory changed
+        listing = self.listings.get(path)
+        if listing is None:
+            return None
+        if directory_mtime(path) != listing.mtime:
+            self.drop(path)
+            return None
+        self.listings.move_to_end(path)
+        return listing
+
+    def store(self, path, listing):
+        self.drop(path)
+        self.listings[path] = listing
+        self.entries += len(listing)
+        while self.entries > self.max_entries and len(self.listings) > 1:
+            path, old = self.listings.popitem(last=False)
+            self.entries -= len(old)
+
+    def drop(self, path):
+        old = self.listings.pop(path, None)
+        if old is not None:
+            self.entries -= len(old)
+
+    def walker(self, path):
+        # the tree for a browser opened in path, it keeps what was expanded and
+        # where the focus was the last time. Listings that changed are read again
+        root = self.roots.get(path)
+        if root is None:
+            root = DirectoryNode(path, self.display)
+            root.walker = urwid.TreeWalker(root)
+            self.roots[path] = root
+            while len(self.roots) > self.max_roots:
+                self.roots.popitem(last=False)
+        else:
+            self.roots.move_to_end(path)
+            root.refresh()
+        return root.walker
+
+    def update_flagged(self, paths):
+        # redraw the widgets of the given paths in the trees that have them loaded
+        for root in self.roots.values():
+            for path in paths:
+                node = root.find(path)
+                if node is not None and node._widget is not None:
+                    node._widget.update_w()
+
+
 class DirectoryNode(urwid.ParentNode):
     """Metadata storage for directories"""
 
     def __init__(self, path, display, parent=None):
         self.display = display
+        self.listing = None
+        self.scan = None
+        self.walker = None # the TreeWalker of the browser this node is in
+        self.kept = []
         if path == dir_sep():
             depth = 0
             key = None
@@ -181,29 +359,65 @@ class DirectoryNode(urwid.ParentNode):
         return parent
 
     def load_child_keys(self):
-        dirs = []
-        files = []
-        try:
-            path = self.get_value()
-            # separate dirs and files
-            for a in os.listdir(path):
-                if os.path.isdir(os.path.join(path,a)):
-                    dirs.append(a)
-                else:
-                    files.append(a)
-        except OSError as e:
-            depth = self.get_depth() + 1
-            self._children[None] = ErrorNode(self, parent=self, key=None,
-                                             depth=depth)
-            return [None]
-
-        # sort dirs and files
-        dirs.sort(key=alphabetize)
-        files.sort(key=alphabetize)
-        # store where the first file starts
-        self.dir_count = len(dirs)
-        # collect dirs and files together again
-        keys = dirs + files
+        path = self.get_value()
+        depth = self.get_depth() + 1
+        cache = self.display.browser_cache
+        listing = cache.listing(path)
+        if listing is not None:
+            self.listing = listing
+            return self.finish_keys()
+
+        loop = self.display.loop
+        if loop is None:
+            # there is no main loop to hand the entries to yet, so read them right away
+            listing = Listing(directory_mtime(path))
+            try:
+                listing.add_entries(list(scan_directory(path)))
+            except OSError as e:
+                self._children[None] = ErrorNode(self, parent=self, key=None,
+                                                 depth=depth)
+                return [None]
+            self.listing = listing
+            cache.store(path, listing)
+            return self.finish_keys()
+
+        # big directories (or slow disks) are read in the background, the entries
+        # show up as they come in with a loading marker after them. A parent of
+        # the directory the browser was opened in already has that child, which
+        # has to stay listed while the rest comes in
+        self.kept = [key for key in self._children if key is not None]
+        self._children[None] = LoadingNode(self, parent=self, key=None,
+                                           depth=depth)
+        self.start_scan()
+        self.listing = self.scan.listing
+        return self.kept + [None]
+
+    def start_scan(self):
+        # the mtime is taken before reading, so a change during the scan makes
+        # the listing look out of date the next time and it's read again
+        mtime = directory_mtime(self.get_value())
+        pipe = self.display.loop.watch_pipe(self.scan_done)
+        self.scan = DirectoryScan(self.get_value(), pipe)
+        self.scan.listing = Listing(mtime)
+
+    def refresh(self):
+        # read the listings of this tree again where the directory changed since
+        if self.scan is not None or self._child_keys is None:
+            return
+        if self.listing is not None and directory_mtime(self.get_value()) != self.listing.mtime:
+            # the old entries stay until the new ones are all in, so the focus
+            # and the rest of the tree don't lose their place in the meantime
+            if self.display.loop is None:
+                self._child_keys = self.load_child_keys()
+                self.prune()
+                return
+            self.start_scan()
+        for child in list(self._children.values()):
+            if isinstance(child, DirectoryNode):
+                child.refresh()
+
+    def finish_keys(self):
+        keys = self.listing.keys()
         if len(keys) == 0:
             depth=self.get_depth() + 1
             self._children[None] = EmptyNode(self, parent=self, key=None,
@@ -211,42 +425,88 @@ class DirectoryNode(urwid.ParentNode):
             keys = [None]
         return keys
 
+    def prune(self):
+        # forget the children that are gone, or turned from a file into a directory or back
+        keys = set(self._child_keys)
+        for key, child in list(self._children.items()):
+            if key is None:
+                if None not in keys:
+                    del self._children[key]
+            elif key not in keys or isinstance(child, DirectoryNode) != (key in self.listing.dir_names):
+                del self._children[key]
+
+    def scan_done(self, data):
+        # runs in the main loop whenever the background scan has new entries
+        scan = self.scan
+        if scan is None:
+            return True
+        # checked before taking the entries, the last batch is queued before this goes False
+        scanning = scan.scanning
+        for batch in scan.finished():
+            scan.listing.add_entries(batch)
+        if scanning:
+            if self.listing is scan.listing:
+                keys = self.listing.keys()
+                found = set(keys)
+                self._child_keys = keys + [key for key in self.kept if key not in found] + [None]
+        else:
+            self.scan = None
+            if scan.error is not None and not scan.listing:
+                self._children[None] = ErrorNode(self, parent=self, key=None,
+                                                 depth=self.get_depth() + 1)
+                self._child_keys = [None]
+            else:
+                self._children.pop(None, None)
+                self.listing = scan.listing
+                self.display.browser_cache.store(self.get_value(), self.listing)
+                self._child_keys = self.finish_keys()
+            self.prune()
+
+        walker = self.walker
+        if walker is not None:
+            # if the focus was on something that is gone now, move it to this directory
+            depth = self.get_depth() + 1
+            node = walker.focus
+            while node.get_depth() > depth:
+                node = node.get_parent()
+            if node.get_depth() == depth and node.get_parent() is self and \
+                    self._children.get(node.get_key()) is not node:
+                walker.focus = self
+            walker._modified()
+        return self.scan is not None
+
+    def find(self, path):
+        # the loaded node for path under this one, None if it hasn't been loaded
+        rel = os.path.relpath(path, self.get_value())
+        if rel.startswith(os.pardir):
+            return None
+        node = self
+        for name in rel.split(dir_sep()):
+            if name == os.curdir:
+                continue
+            if not isinstance(node, DirectoryNode):
+                return None
+            node = node._children.get(name)
+            if node is None:
+                return None
+        return node
+
     def load_child_node(self, key):
         """Return either a FileNode or DirectoryNode"""
-        index = self.get_child_index(key)
         if key is None:
             return EmptyNode(None)
         else:
             path = os.path.join(self.get_value(), key)
-            if index < self.dir_count:
-                return DirectoryNode(path, self.display, parent=self)
+            if key in self.listing.dir_names:
+                node = DirectoryNode(path, self.display, parent=self)
+                node.walker = self.walker
+                return node
             else:
-                path = os.path.join(self.get_value(), key)
                 return FileNode(path, self.display, parent=self)
 
     def load_widget(self):
         return DirectoryWidget(self)
 
-#######
-# global cache of widgets
-_widget_cache = {}
-
-def add_widget(path, widget):
-    """Add the widget for a given path"""
-
-    _widget_cache[path] = widget
-
-def get_flagged_names():
-    """Return a list of all filenames marked as flagged."""
-
-    l = []
-    for w in _widget_cache.values():
-        if w.flagged:
-            l.append(w.get_node().get_value())
-    return l
-
-
-
 ######
 # store path components of initial current working directory
 _initial_cwd = []
@@ -260,7 +520,7 @@ def store_initial_cwd(name):
 def starts_expanded(name):
     """Return True if directory is a parent of initial cwd."""
 
-    if name is '/':
+    if name == '/':
         return True
 
     l = name.split(dir_sep())
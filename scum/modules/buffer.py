@@ -0,0 +1,477 @@
+import bisect
+import mmap
+import threading
+from array import array
+from itertools import accumulate
+
+# the text of a file is kept in a line based piece table. The original contents
+# of the file are never copied or changed, instead the buffer keeps a list of
+# pieces that each point to a run of lines either in the original text or in
+# the list of lines that were added while editing:
+#
+#   original:  |def f():|    return 1|print(f())|
+#   added:     |    return 2|
+#   pieces:    [(ORIGINAL, 0, 1), (ADDED, 0, 1), (ORIGINAL, 2, 1)]
+#
+# so the document reads "def f():", "    return 2", "print(f())". Edits only
+# touch the piece list, which stays small, so the memory used grows with the
+# size of the file in bytes and not with the number of lines.
+
+ORIGINAL = 0
+ADDED = 1
+
+# bytes that aren't valid utf-8 are decoded to lone surrogates and encoded back
+# to the same bytes when the file is saved (see save.write_lines), so a file in
+# some other encoding isn't changed where it wasn't edited
+ERRORS = 'surrogateescape'
+
+
+class StringLines(object):
+    """The original text of a file with an index of where each line starts"""
+
+    loading = False
+
+    def __init__(self, text):
+        self.text = text
+        self.starts = array('L', [0])
+        find = text.find
+        pos = find('\n')
+        while pos != -1:
+            self.starts.append(pos + 1)
+            pos = find('\n', pos + 1)
+        # a trailing newline does not start another line
+        if len(self.starts) > 1 and self.starts[-1] == len(text):
+            self.starts.pop()
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __getitem__(self, index):
+        start = self.starts[index]
+        if index + 1 < len(self.starts):
+            return self.text[start:self.starts[index + 1] - 1]
+        return self.text[start:].rstrip('\n')
+
+    def slice(self, start, stop):
+        # the lines from start to stop as a list, split in one go instead of line by line
+        begin = self.starts[start]
+        if stop < len(self.starts):
+            return self.text[begin:self.starts[stop] - 1].split('\n')
+        text = self.text[begin:]
+        if text.endswith('\n'):
+            text = text[:-1]
+        return text.split('\n')
+
+
+class MappedLines(object):
+    """The original lines of a big file, read straight out of a memory map"""
+
+    chunk_size = 4 * 1024 * 1024
+
+    def __init__(self, fname, encoding='utf-8'):
+        self.encoding = encoding
+        with open(fname, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.size = len(self.map)
+        self.starts = array('Q', [0])
+        self.count = 0 # lines published so far, see end for the last one
+        self.loading = True
+        # the first chunk is read right away so there is something to show, the
+        # rest of the newlines are found by a background thread
+        pos = self.scan_chunk(0)
+        # publish the first line even if the chunk had no newline in it (minified
+        # files), it's read up to wherever it really ends (see end)
+        if self.size > 0:
+            self.count = max(self.count, 1)
+        self.thread = threading.Thread(target=self.scan, args=(pos,), daemon=True)
+        self.thread.start()
+
+    def scan_chunk(self, pos):
+        data = self.map[pos:pos + self.chunk_size]
+        # the offset after every newline in the chunk, computed without a python loop
+        lengths = map((1).__add__, map(len, data.split(b'\n')[:-1]))
+        starts = accumulate(lengths, initial=pos)
+        next(starts)
+        self.starts.extend(starts)
+        self.count = max(self.count, len(self.starts) - 1)
+        return pos + len(data)
+
+    def scan(self, pos):
+        while pos < self.size:
+            pos = self.scan_chunk(pos)
+        # a trailing newline does not start another line
+        if self.starts[-1] != self.size:
+            self.count = len(self.starts)
+        self.loading = False
+
+    def wait(self):
+        self.thread.join()
+
+    def __len__(self):
+        return self.count
+
+    def end(self, index):
+        # the offset of the newline that ends line index. The scan might not have
+        # got that far for the last line it published, so that one is looked up
+        if index + 1 < len(self.starts):
+            return self.starts[index + 1] - 1
+        end = self.map.find(b'\n', self.starts[index])
+        return self.size if end == -1 else end
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self.count
+        if not 0 <= index < self.count:
+            raise IndexError('line out of range')
+        start = self.starts[index]
+        line = self.map[start:self.end(index)]
+        if line.endswith(b'\r'):
+            line = line[:-1]
+        return line.decode(self.encoding, ERRORS)
+
+    def slice(self, start, stop):
+        stop = min(stop, self.count)
+        if start >= stop:
+            return []
+        text = self.map[self.starts[start]:self.end(stop - 1)].decode(self.encoding, ERRORS)
+        lines = text.split('\n')
+        if '\r' in text:
+            lines = [line[:-1] if line.endswith('\r') else line for line in lines]
+        return lines
+
+
+class TextBuffer(object):
+    """A line oriented piece table holding the text of one file"""
+
+    block_size = 4096 # how many original lines iter_lines splits at once
+
+    def __init__(self, original):
+        # original can be any sequence of lines (see StringLines)
+        self.original = original
+        self.added = []
+        self.pieces = []
+        # how many of the original lines the pieces know about, this only
+        # changes while a MappedLines is still being scanned
+        self.known = len(original)
+        if self.known > 0:
+            self.pieces.append((ORIGINAL, 0, self.known))
+        self._reindex()
+        # goes up with every edit, so it's easy to tell if anything changed since
+        self.version = 0
+        # when it's a list every edit is added to it as (line, count, lines), the
+        # lines that replaced count lines from line on. The session journal writes
+        # these out instead of the whole piece table (see replay)
+        self.log = None
+
+    @classmethod
+    def from_text(cls, text):
+        return cls(StringLines(text))
+
+    @classmethod
+    def from_file(cls, fname):
+        with open(fname, encoding='utf-8', errors=ERRORS) as f:
+            return cls.from_text(f.read())
+
+    @classmethod
+    def from_map(cls, fname):
+        return cls(MappedLines(fname))
+
+    @property
+    def loading(self):
+        return self.original.loading
+
+    @property
+    def mapped(self):
+        return isinstance(self.original, MappedLines) or getattr(self.original, 'mapped', False)
+
+    def wait(self):
+        # block until the whole original text is known, returns True if lines were added
+        if self.loading:
+            self.original.wait()
+        return self.sync()
+
+    def snapshot(self):
+        # a copy that later edits don't change. The original lines are shared, only
+        # the pieces and the added lines (which are changed in place) are copied
+        copy = object.__new__(type(self))
+        copy.original = self.original
+        copy.added = list(self.added)
+        copy.pieces = list(self.pieces)
+        copy.starts = list(self.starts)
+        copy.length = self.length
+        copy.known = self.known
+        copy.version = self.version
+        copy.log = None
+        return copy
+
+    def written(self, changed):
+        # a copy holding the text that was just saved, to rebase onto instead of
+        # reading the file again. changed are the (line, text) the save wrote
+        # differently (see save.saved_lines). A buffer can be the original of
+        # another one, but the copy always points at plain original lines, so
+        # saving again and again doesn't stack them up
+        copy = self.snapshot()
+        inner = copy.original
+        if isinstance(inner, TextBuffer):
+            pieces = []
+            for source, start, count in copy.pieces:
+                if source == ADDED:
+                    pieces.append((source, start, count))
+                    continue
+                # the pieces of the inner buffer that cover these lines
+                i, offset = inner._locate(start)
+                while count > 0:
+                    isource, istart, icount = inner.pieces[i]
+                    n = min(count, icount - offset)
+                    if isource == ORIGINAL:
+                        pieces.append((ORIGINAL, istart + offset, n))
+                    else:
+                        pieces.append((ADDED, len(copy.added), n))
+                        copy.added.extend(inner.added[istart + offset:istart + offset + n])
+                    count -= n
+                    offset = 0
+                    i += 1
+            copy.original = inner.original
+            copy.known = inner.known
+            copy.pieces = pieces
+            copy._merge()
+        if changed:
+            copy.set_lines(changed)
+        return copy
+
+    def slice(self, start, stop):
+        # so a buffer can be the original of another one (see written)
+        return list(self.iter_lines(start, stop))
+
+    def dump_pieces(self):
+        # the edits as a list the session journal can store, runs of original
+        # lines are [start, count] and added lines are written out in a list
+        dumped = []
+        for source, start, count in self.pieces:
+            if source == ORIGINAL:
+                dumped.append([start, count])
+            else:
+                dumped.append(self.added[start:start + count])
+        return dumped
+
+    def load_pieces(self, dumped):
+        # put back edits saved with dump_pieces, the original has to be fully known
+        pieces = []
+        added = []
+        for run in dumped:
+            if run and isinstance(run[0], int):
+                start, count = run
+                if start < 0 or start + count > self.known:
+                    raise ValueError('piece out of range')
+                pieces.append((ORIGINAL, start, count))
+            else:
+                pieces.append((ADDED, len(added), len(run)))
+                added.extend(run)
+        self.pieces = pieces
+        self.added = added
+        self._merge()
+        self.version += 1
+
+    def rebase(self, original):
+        # start over from new original lines (the file was just saved), the edits
+        # that were made so far are part of it now
+        self.original = original
+        self.added = []
+        self.known = len(original)
+        self.pieces = [(ORIGINAL, 0, self.known)] if self.known > 0 else []
+        self._reindex()
+        self.version += 1
+        # edits logged so far were made to the old original
+        self.log = None
+
+    def replay(self, edits):
+        # make the edits a log holds (see log), e.g. the ones read back from the journal
+        for line, count, lines in edits:
+            if not 0 <= line <= self.length:
+                raise ValueError('edit out of range')
+            self.replace_lines(line, count, lines)
+
+    def sync(self):
+        """Add any original lines found since the last call, returns True if there were any"""
+        known = len(self.original)
+        if known == self.known:
+            return False
+        for i, (source, start, count) in enumerate(self.pieces):
+            if source == ORIGINAL and start + count == self.known:
+                self.pieces[i] = (source, start, known - start)
+                break
+        else:
+            self.pieces.append((ORIGINAL, self.known, known - self.known))
+        self.known = known
+        self._merge()
+        return True
+
+    def _reindex(self):
+        # starts[i] is the document line where pieces[i] begins
+        self.starts = []
+        total = 0
+        for piece in self.pieces:
+            self.starts.append(total)
+            total += piece[2]
+        self.length = total
+
+    def _locate(self, line):
+        # find the piece containing the given line, returns (piece index, offset in piece)
+        if line < 0:
+            line += self.length
+        if not 0 <= line < self.length:
+            raise IndexError('line out of range')
+        i = bisect.bisect_right(self.starts, line) - 1
+        return i, line - self.starts[i]
+
+    def _split(self, line):
+        # make sure a piece begins at the given line and return its index
+        if line >= self.length:
+            return len(self.pieces)
+        i, offset = self._locate(line)
+        if offset == 0:
+            return i
+        source, start, count = self.pieces[i]
+        self.pieces[i:i+1] = [(source, start, offset), (source, start + offset, count - offset)]
+        self.starts.insert(i + 1, line)
+        return i + 1
+
+    def _merge(self):
+        # join pieces that point at neighbouring runs of the same source
+        merged = []
+        for piece in self.pieces:
+            if piece[2] == 0:
+                continue
+            if merged and merged[-1][0] == piece[0] and merged[-1][1] + merged[-1][2] == piece[1]:
+                last = merged.pop()
+                piece = (last[0], last[1], last[2] + piece[2])
+            merged.append(piece)
+        self.pieces = merged
+        self._reindex()
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, line):
+        i, offset = self._locate(line)
+        source, start, count = self.pieces[i]
+        if source == ORIGINAL:
+            return self.original[start + offset]
+        return self.added[start + offset]
+
+    def __iter__(self):
+        return self.iter_lines()
+
+    def iter_lines(self, start=0, stop=None):
+        # yield the lines from start up to (but not including) stop
+        if stop is None or stop > self.length:
+            stop = self.length
+        if start >= stop:
+            return
+        i, offset = self._locate(start)
+        line = start
+        while line < stop:
+            source, first, count = self.pieces[i]
+            end = first + min(count, offset + stop - line)
+            if source == ORIGINAL:
+                # the original lines are split a block at a time, much faster than one by one
+                for k in range(first + offset, end, self.block_size):
+                    yield from self.original.slice(k, min(k + self.block_size, end))
+            else:
+                yield from self.added[first + offset:end]
+            line += count - offset
+            offset = 0
+            i += 1
+
+    def set_line(self, line, text):
+        i, offset = self._locate(line)
+        if self.log is not None:
+            self.log.append((line, 1, [text]))
+        source, start, count = self.pieces[i]
+        if source == ADDED:
+            # added lines belong to a single piece so they can be changed in place
+            self.added[start + offset] = text
+            self.version += 1
+            return
+        self.added.append(text)
+        new = [(ORIGINAL, start, offset), (ADDED, len(self.added) - 1, 1),
+               (ORIGINAL, start + offset + 1, count - offset - 1)]
+        self.pieces[i:i+1] = [p for p in new if p[2] > 0]
+        self._reindex()
+        self.version += 1
+
+    def set_lines(self, changes):
+        # change many lines in one pass over the pieces, changes is a list of
+        # (line, text) sorted by line. Calling set_line for each one would copy
+        # the piece list every time
+        if self.log is not None:
+            self.log.extend((line, 1, [text]) for line, text in changes)
+        pieces = []
+        k = 0
+        for (source, start, count), first in zip(self.pieces, self.starts):
+            end = first + count
+            if k == len(changes) or changes[k][0] >= end:
+                pieces.append((source, start, count))
+                continue
+            if source == ADDED:
+                while k < len(changes) and changes[k][0] < end:
+                    line, text = changes[k]
+                    self.added[start + line - first] = text
+                    k += 1
+                pieces.append((source, start, count))
+                continue
+            # split the original piece around every changed line
+            pos = first
+            while k < len(changes) and changes[k][0] < end:
+                line, text = changes[k]
+                if line > pos:
+                    pieces.append((ORIGINAL, start + pos - first, line - pos))
+                pieces.append((ADDED, len(self.added), 1))
+                self.added.append(text)
+                pos = line + 1
+                k += 1
+            if pos < end:
+                pieces.append((ORIGINAL, start + pos - first, end - pos))
+        self.pieces = pieces
+        self._merge()
+        self.version += 1
+
+    def insert_lines(self, line, lines):
+        if not lines:
+            return
+        if self.log is not None:
+            self.log.append((line, 0, list(lines)))
+        i = self._split(line)
+        self.pieces.insert(i, (ADDED, len(self.added), len(lines)))
+        self.added.extend(lines)
+        self._merge()
+        self.version += 1
+
+    def replace_lines(self, line, count, lines):
+        # put lines in place of count lines from line on, in one edit of the pieces
+        if self.log is not None:
+            self.log.append((line, count, list(lines)))
+        i = self._split(line)
+        j = self._split(min(line + count, self.length))
+        self.pieces[i:j] = [(ADDED, len(self.added), len(lines))]
+        self.added.extend(lines)
+        self._merge()
+        self.version += 1
+
+    def insert_line(self, line, text):
+        self.insert_lines(line, [text])
+
+    def delete_lines(self, line, count=1):
+        count = min(count, self.length - line)
+        if count <= 0:
+            return
+        if self.log is not None:
+            self.log.append((line, count, []))
+        i = self._split(line)
+        j = self._split(line + count)
+        del self.pieces[i:j]
+        self._merge()
+        self.version += 1
+
+    def get_text(self):
+        return '\n'.join(self.iter_lines())
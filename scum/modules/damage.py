@@ -0,0 +1,99 @@
+from urwid import escape
+
+from .batch import PasteScreen
+
+# urwid's raw screen keeps the rows it drew last time and only sends the rows
+# of a new frame that are different. That's one row when a character is typed,
+# but when the editor scrolls every row moved, so every row is sent again even
+# though the terminal already shows all but one of them.
+#
+# the damage screen looks for that before urwid draws the frame: if a run of
+# the new rows is the same as a run of the old ones a few rows up or down, the
+# terminal is asked to scroll just those rows (a scroll region, then index or
+# reverse index) and the remembered rows are moved along with them:
+#
+#   old        new          sent
+#   header     header       (same)
+#   1| a       2| b         scroll rows 1-3 up by one
+#   2| b       3| c
+#   3| c       4| d         4| d
+#
+# so scrolling a line costs a line, not a screen. It also counts the bytes
+# it writes, the frame tracer shows how many each frame took.
+
+MIN_ROWS = 3 # a scroll has to save sending at least this many rows
+
+
+def row_key(row):
+    # a row of canvas content as something that can go in a dict
+    return tuple((attr, cs, text) for attr, cs, text in row)
+
+
+def find_scroll(old, new):
+    # (first, last, amount) when new rows first..last are the old rows amount
+    # further down (or up when it's negative), None if nothing moved
+    height = min(len(old), len(new))
+    try:
+        where = {}
+        for k in range(height):
+            where.setdefault(row_key(old[k]), k)
+        keys = [row_key(row) for row in new[:height]]
+    except TypeError:
+        return None # an attribute that can't be hashed, just draw it
+    for y in range(height):
+        if new[y] == old[y]:
+            continue
+        k = where.get(keys[y])
+        if k is None or k == y:
+            continue
+        amount = k - y
+        last = y
+        while last + 1 < height and 0 <= last + 1 + amount < height and new[last + 1] == old[last + 1 + amount]:
+            last += 1
+        if last - y + 1 >= MIN_ROWS:
+            return y, last, amount
+    return None
+
+
+class DamageScreen(PasteScreen):
+    """A raw_display screen that scrolls the terminal instead of sending rows that only moved"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.scrolling = True # use scroll regions, some terminals get them wrong
+        self.written = 0 # bytes written since take_written was last called
+
+    def take_written(self):
+        written = self.written
+        self.written = 0
+        return written
+
+    def write(self, data):
+        self.written += len(data) if data.isascii() else len(data.encode('utf-8', 'replace'))
+        super().write(data)
+
+    def draw_screen(self, size, canvas):
+        old = self.screen_buf
+        if (self.scrolling and old and self._started and not self._resized and
+                self._rows_used is None and canvas is not getattr(self, '_screen_buf_canvas', None)):
+            scroll = find_scroll(old, list(canvas.content()))
+            if scroll is not None:
+                self.scroll(*scroll)
+        super().draw_screen(size, canvas)
+
+    def scroll(self, first, last, amount):
+        # move the rows the terminal shows, the rows that scroll in are sent by urwid
+        top, bottom = min(first, first + amount), max(last, last + amount)
+        out = [escape.HIDE_CURSOR, '\x1b[%d;%dr' % (top + 1, bottom + 1)]
+        if amount > 0:
+            out += [escape.set_cursor_position(0, bottom), '\x1bD' * amount]
+        else:
+            out += [escape.set_cursor_position(0, top), '\x1bM' * -amount]
+        out.append('\x1b[r')
+        for data in out:
+            self.write(data)
+        buf = list(self.screen_buf)
+        for y in range(top, bottom + 1):
+            y2 = y + amount
+            buf[y] = self.screen_buf[y2] if top <= y2 <= bottom else None
+        self.screen_buf = buf
@@ -0,0 +1,241 @@
+import collections
+import fnmatch
+import multiprocessing
+import os
+import re
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from .search import compile_pattern
+
+# "find in files" searches every file under a directory. The directory tree is
+# walked on a background thread, skipping anything a .gitignore rules out, and
+# the files are handed out in batches to a pool of processes that do the
+# actual searching so a big project uses every core:
+#
+#   walk thread:   [a.py b.py c.py ...]  [d.py e.py ...]  ...
+#                        |                     |
+#   processes:      search_files()        search_files()
+#                        |                     |
+#   main loop:      results tab  <----  done deque + a byte on the pipe
+#
+# results are handed to the main loop as each batch finishes, the same way the
+# highlight worker does it, so they show up while the search is still going.
+
+SKIP_DIRS = {'.git', '.hg', '.svn', '__pycache__'}
+
+
+class IgnoreRules(object):
+    """The .gitignore patterns that apply inside one directory"""
+
+    def __init__(self, base, parent=None):
+        self.base = base
+        # (regex, negated, only matches directories, matched against the full path)
+        self.rules = list(parent.rules) if parent is not None else []
+        try:
+            with open(os.path.join(base, '.gitignore'), errors='replace') as f:
+                lines = f.read().splitlines()
+        except OSError:
+            return
+        for line in lines:
+            line = line.rstrip()
+            if not line or line.startswith('#'):
+                continue
+            negated = line.startswith('!')
+            if negated:
+                line = line[1:]
+            dir_only = line.endswith('/')
+            line = line.rstrip('/')
+            # a pattern with a slash in it is relative to the .gitignore
+            anchored = '/' in line
+            if anchored:
+                line = os.path.join(base, line.lstrip('/'))
+            regex = re.compile(fnmatch.translate(line))
+            self.rules.append((regex, negated, dir_only, anchored))
+
+    def ignored(self, path, name, is_dir):
+        # the last rule that matches decides
+        result = False
+        for regex, negated, dir_only, anchored in self.rules:
+            if dir_only and not is_dir:
+                continue
+            if regex.match(path if anchored else name):
+                result = not negated
+        return result
+
+
+def walk_files(root, cancelled=None):
+    # yield every file under root that isn't ignored
+    stack = [(root, IgnoreRules(root))]
+    while stack:
+        path, rules = stack.pop()
+        try:
+            entries = sorted(os.scandir(path), key=lambda e: e.name)
+        except OSError:
+            continue
+        dirs = []
+        for entry in entries:
+            if cancelled is not None and cancelled.is_set():
+                return
+            try:
+                is_dir = entry.is_dir(follow_symlinks=False)
+            except OSError:
+                continue
+            if is_dir and entry.name in SKIP_DIRS:
+                continue
+            if rules.ignored(entry.path, entry.name, is_dir):
+                continue
+            if is_dir:
+                dirs.append(entry.path)
+            elif entry.is_file():
+                yield entry.path
+        for d in reversed(dirs):
+            stack.append((d, IgnoreRules(d, rules)))
+
+
+def search_files(paths, query, regex=False, case=True, word=False, limit=1000):
+    # runs in a worker process, returns (path, row, col, line) for every match
+    plain = not (regex or word or not case)
+    pattern = None if plain else compile_pattern(query, regex, case, word)
+    results = []
+    for path in paths:
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except OSError:
+            continue
+        # a file with a null byte near the start is most likely binary
+        if b'\0' in data[:8192]:
+            continue
+        text = data.decode('utf-8', 'replace')
+        # most files don't match at all, so check the whole text in one go first
+        if plain:
+            if query not in text:
+                continue
+        elif pattern is None or pattern.search(text) is None:
+            continue
+
+        found = 0
+        for row, line in enumerate(text.split('\n')):
+            if line.endswith('\r'):
+                line = line[:-1]
+            if plain:
+                col = line.find(query)
+            else:
+                m = pattern.search(line)
+                col = -1 if m is None else m.start()
+            if col == -1:
+                continue
+            # the editor shows tabs as four spaces so the column has to match that
+            col = len(line[:col].expandtabs(4))
+            results.append((path, row, col, line.expandtabs(4)[:200]))
+            found += 1
+            if found >= limit:
+                break
+    return results
+
+
+class FileSearch(object):
+    """A search through every file under root, results are picked up with finished()"""
+
+    batch_size = 64 # files per job sent to a worker process
+    max_pending = 32 # jobs waiting at once, keeps memory flat on huge trees
+    max_results = 10000
+
+    _pool = None
+
+    def __init__(self, root, query, pipe, regex=False, case=True, word=False):
+        self.root = root
+        self.query = query
+        self.options = (regex, case, word)
+        self.pipe = pipe
+        self.done = collections.deque()
+        self.files = 0 # files that were searched
+        self.count = 0 # matches found
+        self.searching = True
+        self.cancelled = threading.Event()
+        self.pending = threading.Semaphore(self.max_pending)
+        # the walk plus every job whose results haven't been collected yet, the
+        # pipe is closed by whichever of them finishes last. Done callbacks run
+        # after anything waiting on the future wakes up, so the walk thread can't
+        # just wait for the jobs and close it
+        self.running = 1
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    @classmethod
+    def pool(cls):
+        # the worker processes are started once and reused for every search. They are
+        # spawned rather than forked so they don't inherit the editor's threads and pipes
+        if cls._pool is None:
+            cls._pool = ProcessPoolExecutor(mp_context=multiprocessing.get_context('spawn'))
+        return cls._pool
+
+    def run(self):
+        batch = []
+        try:
+            for path in walk_files(self.root, self.cancelled):
+                batch.append(path)
+                if len(batch) >= self.batch_size:
+                    self.submit(batch)
+                    batch = []
+            if batch and not self.cancelled.is_set():
+                self.submit(batch)
+        finally:
+            self.finish()
+
+    def submit(self, paths):
+        self.pending.acquire()
+        if self.cancelled.is_set():
+            self.pending.release()
+            return
+        with self.lock:
+            self.running += 1
+        try:
+            future = self.pool().submit(search_files, paths, self.query, *self.options)
+        except BaseException:
+            self.pending.release()
+            self.finish()
+            raise
+        future.add_done_callback(lambda f, n=len(paths): self.collect(f, n))
+
+    def collect(self, future, files):
+        self.pending.release()
+        try:
+            if self.cancelled.is_set() or future.exception() is not None:
+                return
+            results = future.result()
+            self.files += files
+            if results:
+                self.done.append(results)
+                self.count += len(results)
+                if self.count >= self.max_results:
+                    self.cancelled.set()
+            self.notify()
+        finally:
+            self.finish()
+
+    def finish(self):
+        # the walk or a job is over, the last one tells the main loop the search is done
+        with self.lock:
+            self.running -= 1
+            if self.running > 0:
+                return
+        self.searching = False
+        self.notify()
+        # the main loop closes its end once it sees the search is over
+        os.close(self.pipe)
+
+    def notify(self):
+        try:
+            os.write(self.pipe, b'.')
+        except OSError:
+            pass
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def finished(self):
+        while self.done:
+            yield from self.done.popleft()
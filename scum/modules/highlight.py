@@ -0,0 +1,405 @@
+import bisect
+import collections
+import os
+import queue
+import threading
+
+from pygments.lexer import RegexLexer
+from pygments.token import Error, Whitespace, _TokenType
+
+# syntax highlighting is done one line at a time, but the state the lexer was in
+# at the end of a line is carried on to the next one so multi-line strings and
+# comments come out right. The lexer state at the start of every `interval`th
+# line is kept as a checkpoint (a mark):
+#
+#   line 0    mark ('root',)
+#   ...
+#   line 64   mark ('root', 'tdqs')    <- inside a """ string
+#   ...
+#
+# when a line is edited the lines after it are lexed again from the mark before
+# the edit, and as soon as a later mark comes out in the same state as before
+# the rest of the document is known to be unchanged. The attributes of every
+# line that was asked for are cached, along with the state the line started
+# in, so scrolling never lexes a line twice and an edit usually only has to
+# lex the edited line and the one after it.
+#
+# once the main loop is running the lexing itself is done on a background
+# thread (see HighlightWorker). Lines are drawn plain, or with the attributes
+# they had before an edit, until the worker hands back their new attributes.
+
+ROOT = ('root',)
+
+
+def stateful(lexer):
+    # only plain regex lexers can be started in the middle of a document
+    return (isinstance(lexer, RegexLexer) and
+            type(lexer).get_tokens_unprocessed is RegexLexer.get_tokens_unprocessed)
+
+
+def lex_line(lexer, text, stack):
+    """
+    Lex one line (ending in a newline) starting from the given state stack.
+    This follows RegexLexer.get_tokens_unprocessed, but also hands back the
+    stack the lexer ended up with. Returns (tokens, stack)
+    """
+    pos = 0
+    tokens = []
+    tokendefs = lexer._tokens
+    statestack = list(stack)
+    statetokens = tokendefs[statestack[-1]]
+    while 1:
+        for rexmatch, action, new_state in statetokens:
+            m = rexmatch(text, pos)
+            if m:
+                if action is not None:
+                    if type(action) is _TokenType:
+                        tokens.append((action, m.group()))
+                    else:
+                        tokens.extend((tok, value) for _, tok, value in action(lexer, m))
+                pos = m.end()
+                if new_state is not None:
+                    if isinstance(new_state, tuple):
+                        for state in new_state:
+                            if state == '#pop':
+                                if len(statestack) > 1:
+                                    statestack.pop()
+                            elif state == '#push':
+                                statestack.append(statestack[-1])
+                            else:
+                                statestack.append(state)
+                    elif isinstance(new_state, int):
+                        if abs(new_state) >= len(statestack):
+                            del statestack[1:]
+                        else:
+                            del statestack[new_state:]
+                    elif new_state == '#push':
+                        statestack.append(statestack[-1])
+                    statetokens = tokendefs[statestack[-1]]
+                break
+        else:
+            if pos >= len(text):
+                break
+            if text[pos] == '\n':
+                # at the end of the line the lexer goes back to root
+                statestack = ['root']
+                statetokens = tokendefs['root']
+                tokens.append((Whitespace, '\n'))
+            else:
+                tokens.append((Error, text[pos]))
+            pos += 1
+    return tokens, tuple(statestack)
+
+
+def to_attribs(tokens, length):
+    # turn (token, text) pairs into urwid (attribute, length) runs for a line of
+    # the given length, neighbouring runs of the same token are merged
+    attribs = []
+    for tok, value in tokens:
+        size = min(len(value), length)
+        if size <= 0:
+            break
+        length -= size
+        if attribs and attribs[-1][0] == tok:
+            attribs[-1] = (tok, attribs[-1][1] + size)
+        else:
+            attribs.append((tok, size))
+    return attribs
+
+
+def lex_lines(lexer, lines, stack):
+    """
+    Lex a run of lines starting in the given state. Returns a list with the
+    (attribs, start state) of each line, and the state after the last line.
+    With a stack of None every line is lexed on its own.
+    """
+    results = []
+    for line in lines:
+        if stack is None:
+            results.append((to_attribs(lexer.get_tokens(line), len(line)), None))
+        else:
+            tokens, end = lex_line(lexer, line + '\n', stack)
+            results.append((to_attribs(tokens, len(line)), stack))
+            stack = end
+    return results, stack
+
+
+def fit(attribs, length):
+    # cut attributes from an older version of a line down to its current length
+    fitted = []
+    for tok, size in attribs:
+        if length <= 0:
+            break
+        fitted.append((tok, min(size, length)))
+        length -= size
+    return fitted
+
+
+class HighlightJob(object):
+    """A run of lines for the HighlightWorker to lex"""
+
+    def __init__(self, highlighter, start, lines, stack):
+        self.highlighter = highlighter
+        self.lexer = highlighter.lexer
+        self.start = start
+        self.lines = lines
+        self.stack = stack
+        # rows from here on were changed while the job was running
+        self.valid = start + len(lines)
+        self.results = None
+        self.end = None
+
+
+class HighlightWorker(object):
+    """
+    Lexes HighlightJobs on a background thread so typing never waits for
+    Pygments. When a job is done a byte is written to pipe (the write end of
+    an urwid watch pipe) so the main loop can pick up the results.
+    """
+
+    def __init__(self, pipe):
+        self.pipe = pipe
+        self.jobs = queue.Queue()
+        self.done = collections.deque()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, job):
+        self.jobs.put(job)
+
+    def run(self):
+        while True:
+            job = self.jobs.get()
+            job.results, job.end = lex_lines(job.lexer, job.lines, job.stack)
+            self.done.append(job)
+            os.write(self.pipe, b'.')
+
+    def finished(self):
+        while self.done:
+            yield self.done.popleft()
+
+
+class Highlighter(object):
+    """Keeps the syntax highlighting of one document (see the comment above)"""
+
+    interval = 64
+    max_cache = 4096
+    job_size = 500 # the most lines a single background job lexes
+    lookahead = 100 # rows past the first wanted one every job lexes, about a screenful
+
+    def __init__(self, lexer, get_text, get_length, worker=None):
+        self.lexer = lexer
+        self.stateful = stateful(lexer)
+        self.get_text = get_text # row -> the text shown for that row
+        self.get_length = get_length # -> the number of rows
+        self.states = {ROOT: ROOT} # every state is only stored once
+        # without a worker lines are lexed right away when they are drawn
+        self.worker = worker
+        self.updated = None # called with the rows the worker found new attributes for
+        self.reset()
+
+    def reset(self):
+        self.mark_rows = [0]
+        self.mark_states = [ROOT]
+        self.cache = {} # row -> (text, attribs, start state)
+        # rows before clean all start in a state that is known to be right
+        self.clean = 1
+        # the last row that was changed, or lexed again, since the marks were last
+        # verified. Marks and cached lines after it still hold the states from
+        # before the changes, so they can be compared to see when lexing can stop
+        self.dirty = -1
+        # the row after the last one lexed and the state it starts in
+        self.resume = None
+        # rows that were drawn without attributes and the job lexing them
+        self.wanted = set()
+        self.job = None
+
+    def set_lexer(self, lexer):
+        self.lexer = lexer
+        self.stateful = stateful(lexer)
+        self.reset()
+
+    def ready(self, row, text):
+        # the cached attributes of row can be used as they are
+        cached = self.cache.get(row)
+        return (cached is not None and cached[0] == text and
+                (row < self.clean or not self.stateful))
+
+    def get_attribs(self, row, text):
+        if self.ready(row, text):
+            return self.cache[row][1]
+
+        if self.worker is None:
+            return self.lex_to(row, text)
+
+        # draw the line with what we have for now and let the worker lex it
+        self.wanted.add(row)
+        if self.job is None:
+            self.submit()
+        cached = self.cache.get(row)
+        if cached is not None:
+            return fit(cached[1], len(text))
+        return []
+
+    def store(self, row, text, attribs, stack):
+        if len(self.cache) >= self.max_cache:
+            # forget the half of the cache that is farthest away from this row
+            far = sorted(self.cache, key=lambda r: abs(r - row))
+            for r in far[len(far)//2:]:
+                del self.cache[r]
+        self.cache[row] = (text, attribs, stack)
+
+    def start_point(self, row):
+        # the row lexing has to start from to reach row, and the state it starts in
+        if not self.stateful:
+            return row, None
+        i = bisect.bisect_right(self.mark_rows, min(row, self.clean - 1)) - 1
+        start, stack = self.mark_rows[i], self.mark_states[i]
+        if self.resume is not None and start < self.resume[0] <= row:
+            start, stack = self.resume
+        return start, stack
+
+    def lex_to(self, row, text):
+        # lex everything needed for row right away
+        start, stack = self.start_point(row)
+        lines = [self.get_text(r) for r in range(start, row)] + [text]
+        results, end = lex_lines(self.lexer, lines, stack)
+        # the rows just above are usually on screen too (the cursor jumped down
+        # a few lines at once), keep them so they aren't lexed again from the mark
+        self.apply(start, lines, results, end, range(max(start, row - self.lookahead), row + 1))
+        return self.cache[row][1]
+
+    def submit(self):
+        length = self.get_length()
+        self.wanted = set(r for r in self.wanted if r < length)
+        if not self.wanted:
+            return
+        first = min(self.wanted)
+        start, stack = self.start_point(first)
+        stop = max(max(self.wanted) + 1, first + self.lookahead)
+        stop = min(stop, start + self.job_size, length)
+        lines = [self.get_text(r) for r in range(start, stop)]
+        self.job = HighlightJob(self, start, lines, stack)
+        self.worker.submit(self.job)
+
+    def finish(self, job):
+        # the worker is done with job, keep whatever is still up to date
+        if job is not self.job:
+            return
+        self.job = None
+        count = job.valid - job.start
+        rows = []
+        if count > 0:
+            end = job.results[count][1] if count < len(job.results) else job.end
+            rows = self.apply(job.start, job.lines[:count], job.results[:count], end, self.wanted)
+        self.wanted = set(r for r in self.wanted
+                          if r >= self.get_length() or not self.ready(r, self.get_text(r)))
+        if self.wanted:
+            self.submit()
+        if rows and self.updated is not None:
+            self.updated(rows)
+
+    def apply(self, start, lines, results, end, wanted):
+        """
+        Take in the results of lexing lines from start on, moving the marks
+        along and caching the attributes of the rows in wanted (or that were
+        already cached). Returns the rows that were cached
+        """
+        stored = []
+        if not self.stateful:
+            for r, line, (attribs, stack) in zip(range(start, start + len(lines)), lines, results):
+                if r in wanted or r in self.cache:
+                    self.store(r, line, attribs, None)
+                    stored.append(r)
+            return stored
+
+        # i is the next mark lexing will reach
+        i = bisect.bisect_left(self.mark_rows, start)
+        for r, line, (attribs, stack) in zip(range(start, start + len(lines)), lines, results):
+            stack = self.states.setdefault(stack, stack)
+            if i < len(self.mark_rows) and self.mark_rows[i] == r:
+                if r >= self.clean and r > self.dirty and self.mark_states[i] == stack:
+                    # the state at this mark didn't change, so nothing after it did
+                    self.clean = self.get_length()
+                    self.dirty = -1
+                self.mark_states[i] = stack
+                i += 1
+            elif r - self.mark_rows[i-1] >= self.interval:
+                self.mark_rows.insert(i, r)
+                self.mark_states.insert(i, stack)
+                i += 1
+
+            cached = self.cache.get(r)
+            if (cached is not None and r >= self.clean and r > self.dirty and
+                    cached[0] == line and cached[2] == stack):
+                # this line starts the same way it did before the edit
+                self.clean = self.get_length()
+                self.dirty = -1
+            if r in wanted or cached is not None:
+                self.store(r, line, attribs, stack)
+                stored.append(r)
+            self.clean = max(self.clean, r + 1)
+
+        last = start + len(lines) - 1
+        if self.dirty >= 0:
+            # the marks up to here were overwritten with new states
+            self.dirty = max(self.dirty, last)
+        self.resume = (last + 1, self.states.setdefault(end, end))
+        return stored
+
+    # the TextList tells the highlighter about every change so the marks and
+    # the cache stay lined up with the rows of the document
+
+    def changed(self, row):
+        self.forget(row)
+        self.clean = min(self.clean, row + 1)
+        self.dirty = max(self.dirty, row)
+
+    def inserted(self, row, count):
+        self.forget(row)
+        self.shift(row, count)
+        self.clean = min(self.clean, row + 1)
+        self.dirty = max(self.dirty, row + count - 1)
+
+    def deleted(self, row, count):
+        self.forget(row)
+        self.shift(row, -count)
+        # the line that moved up into row may not start the way it used to
+        self.clean = min(self.clean, max(row, 1))
+        if row == 0:
+            # the first line is always trusted, so its old attributes have to go
+            self.cache.pop(0, None)
+        self.dirty = max(self.dirty, row - 1)
+
+    def forget(self, row):
+        if self.resume is not None and self.resume[0] > row:
+            self.resume = None
+        if self.job is not None:
+            # whatever the worker finds for this row and the ones after it is stale
+            self.job.valid = min(self.job.valid, row)
+
+    def shift(self, row, amount):
+        # move marks and cached rows at or after row, dropping any that were deleted
+        gone = row - amount if amount < 0 else row
+        rows, states = [0], [ROOT]
+        for r, state in zip(self.mark_rows, self.mark_states):
+            if r == 0 or (row <= r < gone):
+                continue
+            if r >= row:
+                r += amount
+            if r > 0:
+                rows.append(r)
+                states.append(state)
+        self.mark_rows, self.mark_states = rows, states
+
+        cache = {}
+        for r, value in self.cache.items():
+            if row <= r < gone:
+                continue
+            if r >= row:
+                r += amount
+            cache[r] = value
+        self.cache = cache
+
+        if self.dirty >= row:
+            self.dirty += amount
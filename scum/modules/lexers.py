@@ -0,0 +1,153 @@
+import fnmatch
+import os
+import re
+
+# pygments finds the lexer for a file by matching its name against the
+# filename patterns of every lexer it knows, and asks every installed plugin
+# for theirs on top of that, each time it is called. Here the patterns are
+# indexed once, so a name only has to be looked up by its extensions:
+#
+#   exact:   {'Makefile': [...], 'CMakeLists.txt': [...]}
+#   suffix:  {'.py': [(module, 'Python', '*.py'), ...], '.h': [...]}
+#   other:   ['Makefile.*', '*.[1-9]', ...]     (matched with fnmatch)
+#
+# the patterns a name matched are the cache key, so every .py file (or every
+# file the config maps to a lexer) shares one lexer instance. Only when the
+# name matches nothing is the start of the text looked at, for a vim modeline
+# or a #! line. pygments' guess_lexer isn't used for that since it imports
+# every lexer module there is.
+
+RE_SHEBANG = re.compile(r'#!\s*(?:\S*/)?(?:env\s+)?([A-Za-z_-]+)')
+
+
+def make_lexer(cls):
+    lexer = cls()
+    lexer.add_filter('tokenmerge')
+    return lexer
+
+
+class LexerCache(object):
+    """Hands out one lexer per kind of file"""
+
+    def __init__(self, overrides=''):
+        self.exact = None # built the first time it's needed
+        self.suffix = None
+        self.other = None
+        self.instances = {} # lexer class -> lexer
+        self.resolved = {} # patterns a name matched -> lexer
+        self._plain = None
+        self.set_overrides(overrides)
+
+    @property
+    def plain(self):
+        # the lexer for files nothing is known about
+        if self._plain is None:
+            from pygments.lexers.special import TextLexer
+            self._plain = self.instances[TextLexer] = make_lexer(TextLexer)
+        return self._plain
+
+    def set_overrides(self, overrides):
+        # overrides comes from the config as "pattern=lexer, pattern=lexer", a
+        # pattern is an extension (.h), a file name (Jenkinsfile) or a glob (*.conf.in)
+        self.overrides = []
+        for item in overrides.split(','):
+            pattern, _, name = item.partition('=')
+            pattern, name = pattern.strip(), name.strip()
+            if not pattern or not name:
+                continue
+            if pattern.startswith('.'):
+                pattern = '*' + pattern
+            self.overrides.append((pattern, name))
+        self.resolved = {}
+
+    def build_index(self):
+        from pygments.lexers._mapping import LEXERS
+        self.exact = {}
+        self.suffix = {}
+        self.other = []
+        for module, name, _, patterns, _ in LEXERS.values():
+            for pattern in patterns:
+                entry = (module, name, pattern)
+                wild = any(c in pattern for c in '*?[')
+                if not wild:
+                    self.exact.setdefault(pattern, []).append(entry)
+                elif pattern.startswith('*.') and not any(c in pattern[1:] for c in '*?['):
+                    self.suffix.setdefault(pattern[1:], []).append(entry)
+                else:
+                    self.other.append((pattern, entry))
+
+    def matches(self, name):
+        # every (module, lexer name, pattern) whose pattern matches the file name
+        if self.exact is None:
+            self.build_index()
+        found = list(self.exact.get(name, ()))
+        # a.tar.gz is looked up as .tar.gz and as .gz
+        dot = name.find('.', 1)
+        while dot != -1:
+            found.extend(self.suffix.get(name[dot:], ()))
+            dot = name.find('.', dot + 1)
+        for pattern, entry in self.other:
+            if fnmatch.fnmatch(name, pattern):
+                found.append(entry)
+        return found
+
+    def get(self, fname, head=''):
+        # the lexer for a file, head is the start of its text in case the name says nothing
+        name = os.path.basename(fname)
+        for pattern, lexer_name in self.overrides:
+            if fnmatch.fnmatch(name, pattern):
+                key = ('override', pattern)
+                if key not in self.resolved:
+                    self.resolved[key] = self.by_alias(lexer_name) or self.plain
+                return self.resolved[key]
+
+        found = self.matches(name)
+        if not found:
+            return self.sniff(head)
+        key = tuple(sorted(pattern for _, _, pattern in found))
+        lexer = self.resolved.get(key)
+        if lexer is None:
+            lexer = self.resolved[key] = self.best(found)
+        return lexer
+
+    def best(self, found):
+        # the same rating pygments uses: the lexer's priority, plus a bonus for
+        # a pattern without a wildcard, ties go to the name that sorts last
+        from pygments.lexers import find_lexer_class
+        ranked = []
+        for module, name, pattern in found:
+            cls = find_lexer_class(name)
+            if cls is not None:
+                bonus = 0 if '*' in pattern else 0.5
+                ranked.append((cls.priority + bonus, cls.__name__, cls))
+        if not ranked:
+            return self.plain
+        return self.instance(max(ranked, key=lambda r: r[:2])[2])
+
+    def instance(self, cls):
+        lexer = self.instances.get(cls)
+        if lexer is None:
+            lexer = self.instances[cls] = make_lexer(cls)
+        return lexer
+
+    def by_alias(self, alias):
+        from pygments.lexers import get_lexer_by_name
+        import pygments.util
+        try:
+            return self.instance(type(get_lexer_by_name(alias)))
+        except pygments.util.ClassNotFound:
+            return None
+
+    def sniff(self, head):
+        # look for a vim modeline or a #! line at the start of the text
+        if not head:
+            return self.plain
+        from pygments.modeline import get_filetype_from_buffer
+        alias = get_filetype_from_buffer(head)
+        if alias is None:
+            m = RE_SHEBANG.match(head)
+            if m is not None:
+                alias = m.group(1).rstrip('-')
+        if alias is None:
+            return self.plain
+        return self.by_alias(alias) or self.plain
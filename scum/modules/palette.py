@@ -0,0 +1,117 @@
+import json
+import os
+
+import pygments
+from pygments.token import string_to_tokentype
+
+from .save import write_lines
+
+# the syntax colours come from a pygments style, every token type gets an urwid
+# palette entry with the style's foreground colour. On a 256 colour terminal
+# the colour is the closest one in the xterm colour cube or the grey ramp:
+#
+#   16 + 36*r + 6*g + b    r, g, b in 0..5 (steps 00 5f 87 af d7 ff)
+#   232 + k                grey 08 + 10*k, k in 0..23
+#
+# the closest step for every possible channel value is worked out once below,
+# so finding a colour is a few table lookups. The palette a style turns into is
+# kept in the user's cache directory, keyed by style, pygments version and the
+# number of colours, so a style that was used before doesn't even have to be
+# imported again. Terminals that say they do truecolor get the exact colours.
+
+STEPS = (0x00, 0x5f, 0x87, 0xaf, 0xd7, 0xff)
+GREYS = tuple(8 + 10 * k for k in range(24))
+TRUECOLOR = 2 ** 24
+
+
+def _closest(levels):
+    # for every value 0-255 the index of the closest level, ties go to the brighter one
+    return bytes(min(range(len(levels)), key=lambda i: (abs(levels[i] - v), -i)) for v in range(256))
+
+CUBE = _closest(STEPS)
+GREY = _closest(GREYS)
+
+
+def rgb_to_short(r, g, b):
+    """The xterm-256 colour closest to the given RGB value"""
+    ri, gi, bi = CUBE[r], CUBE[g], CUBE[b]
+    cube = (STEPS[ri] - r) ** 2 + (STEPS[gi] - g) ** 2 + (STEPS[bi] - b) ** 2
+    k = GREY[(r + g + b) // 3]
+    level = GREYS[k]
+    grey = (level - r) ** 2 + (level - g) ** 2 + (level - b) ** 2
+    if grey < cube:
+        return 232 + k
+    return 16 + 36 * ri + 6 * gi + bi
+
+
+def parse_color(value):
+    # '#abc' or '#aabbcc' -> (r, g, b), None for anything else
+    value = value.lstrip('#')
+    if len(value) == 3:
+        value = ''.join(c * 2 for c in value)
+    if len(value) != 6:
+        return None
+    try:
+        return int(value[0:2], 16), int(value[2:4], 16), int(value[4:6], 16)
+    except ValueError:
+        return None
+
+
+def cache_dir():
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'scum')
+
+
+def style_colors(style, colors=256):
+    # (token type, urwid foreground) for every token type the style knows
+    rows = []
+    for tok in style.styles.keys():
+        # the colour is inherited from the closest parent token that has one
+        for t in tok.split()[::-1]:
+            st = style.styles[t]
+            if '#' in st:
+                break
+        if '#' not in st:
+            st = ''
+        st = sorted(st.split()) # '#' comes before '[A-Za-z0-9]'
+        rgb = parse_color(st[0]) if st and st[0].startswith('#') else None
+        if rgb is None:
+            fg = 'default'
+        elif colors == TRUECOLOR:
+            fg = '#%02x%02x%02x' % rgb
+        else:
+            fg = 'h%d' % rgb_to_short(*rgb)
+        rows.append((tok, fg))
+    return rows
+
+
+class PaletteCache(object):
+    """The palette entries of each style, kept in memory and on the disk"""
+
+    def __init__(self, path=None):
+        self.path = cache_dir() if path is None else path
+        self.styles = {} # key -> rows
+
+    def key(self, name, colors):
+        safe = ''.join(c if c.isalnum() or c in '-_' else '_' for c in name)
+        return '%s-%s-%d' % (safe, pygments.__version__, colors)
+
+    def get(self, name, colors=256):
+        key = self.key(name, colors)
+        rows = self.styles.get(key)
+        if rows is not None:
+            return rows
+        fname = os.path.join(self.path, 'palette-%s.json' % key)
+        try:
+            with open(fname) as f:
+                rows = [(string_to_tokentype(tok), fg) for tok, fg in json.load(f)]
+        except (OSError, ValueError, TypeError):
+            from pygments.styles import get_style_by_name
+            rows = style_colors(get_style_by_name(name), colors)
+            try:
+                os.makedirs(self.path, exist_ok=True)
+                write_lines(fname, [json.dumps([(str(tok), fg) for tok, fg in rows])], strip=False)
+            except OSError:
+                pass # it just won't be cached
+        self.styles[key] = rows
+        return rows
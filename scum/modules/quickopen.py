@@ -0,0 +1,407 @@
+import hashlib
+import itertools
+import json
+import os
+import re
+import threading
+
+import urwid
+
+from .grep import SKIP_DIRS, IgnoreRules
+from .palette import cache_dir
+from .save import write_lines
+
+# quick open finds a file by typing a few characters of its path instead of
+# walking the file browser one directory at a time. Every file under the
+# project root is kept in an index in the user's cache directory, one entry
+# per directory with the mtime it had when it was read:
+#
+#   {"root": "/home/me/src", "dirs": {"": [1690000000, ["setup.py"], ["scum"]],
+#                                     "scum": [1690000123, ["main.py"], ["modules"]], ...}}
+#
+# opening quick open walks the tree again on a background thread, but only the
+# directories whose mtime changed are listed again, the rest is a stat each.
+#
+# the paths are kept in lower case and sorted by length, so anything picked
+# out of them in order is still shortest first. Typing narrows the paths that
+# matched the query so far (like the find bar does), and the ranking only looks
+# at as many paths as are shown:
+#
+#   1. the file name starts with the query
+#   2. the file name contains the query
+#   3. the path contains the query
+#   4. the letters of the query appear in order in the file name
+#   5. the letters of the query appear in order in the path
+#
+# each step is a regex run over the candidates by filter(). With half a million
+# paths that still takes a few hundred milliseconds, so matching is done by a
+# worker thread a chunk of paths at a time (the main loop gets the GIL back in
+# between). A key that comes in while a match is running makes it give up, only
+# the newest query is matched and the list is updated once that's done.
+
+SEP = re.escape(os.sep)
+
+
+def subsequence(query, within=''):
+    # the letters of query in order with anything but the letter (or within) in
+    # between, so the regex never has to backtrack
+    parts = [re.escape(ch) for ch in query]
+    return parts[0] + ''.join('[^%s%s]*%s' % (part, within, part) for part in parts[1:])
+
+
+def name_pattern(pattern):
+    # pattern, but only inside the last part of a path
+    return re.compile('%s[^%s]*$' % (pattern, SEP)).search
+
+
+class MatchCancelled(Exception):
+    pass
+
+
+def never():
+    return False
+
+
+def chunked(function, paths, stale, size=16384):
+    # filter(function, paths) a chunk at a time, gives up once stale() is true
+    for k in range(0, len(paths), size):
+        if stale():
+            raise MatchCancelled()
+        yield from filter(function, paths[k:k + size])
+
+
+class PathIndex(object):
+    """Every file under root, read on a background thread and kept in the cache directory"""
+
+    def __init__(self, root, path=None):
+        self.root = root
+        if path is None:
+            digest = hashlib.sha1(root.encode('utf-8', 'surrogateescape')).hexdigest()[:16]
+            path = os.path.join(cache_dir(), 'paths-%s.json' % digest)
+        self.path = path
+        self.dirs = None # relative directory -> [mtime, files, subdirectories]
+        # the paths in lower case, the real path for each (a list for paths that
+        # only differ in case) and how many paths there are
+        self.table = ([], {}, 0)
+        self.pipe = None
+        self.indexing = False
+        self.thread = None
+
+    def refresh(self, pipe):
+        # bring the index up to date in the background, pipe gets a byte whenever table changes
+        self.pipe = pipe
+        self.indexing = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        try:
+            if self.dirs is None:
+                self.dirs = self.load()
+                if self.dirs:
+                    # the old index is good enough to start typing
+                    self.publish()
+            dirs, changed = self.walk(self.dirs or {})
+            if changed:
+                self.dirs = dirs
+                self.publish()
+                self.save()
+        finally:
+            self.indexing = False
+            self.notify()
+            # the main loop closes its end once it sees the index is done
+            os.close(self.pipe)
+
+    def notify(self):
+        try:
+            os.write(self.pipe, b'.')
+        except OSError:
+            pass
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        if not isinstance(data, dict) or data.get('root') != self.root:
+            return {}
+        return data.get('dirs') or {}
+
+    def save(self):
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            write_lines(self.path, [json.dumps({'root': self.root, 'dirs': self.dirs})], strip=False)
+        except OSError:
+            pass # it is built again next time
+
+    def walk(self, old):
+        # the directories under root, read again only where the mtime changed
+        dirs = {}
+        changed = False
+        stack = [('', IgnoreRules(self.root))]
+        while stack:
+            rel, rules = stack.pop()
+            full = os.path.join(self.root, rel)
+            try:
+                mtime = os.stat(full).st_mtime_ns
+            except OSError:
+                continue
+            entry = old.get(rel)
+            if entry is not None and entry[0] == mtime:
+                files, subdirs = entry[1], entry[2]
+            else:
+                changed = True
+                files, subdirs = self.list_dir(full, rules)
+            dirs[rel] = [mtime, files, subdirs]
+            for name in subdirs:
+                path = os.path.join(full, name)
+                stack.append((os.path.join(rel, name), IgnoreRules(path, rules)))
+        # a directory that went away doesn't change the mtime of anything that is left
+        return dirs, changed or len(dirs) != len(old)
+
+    def list_dir(self, path, rules):
+        files = []
+        subdirs = []
+        try:
+            entries = list(os.scandir(path))
+        except OSError:
+            return files, subdirs
+        for entry in entries:
+            try:
+                is_dir = entry.is_dir(follow_symlinks=False)
+                if not is_dir and not entry.is_file():
+                    continue
+            except OSError:
+                continue
+            if is_dir and entry.name in SKIP_DIRS:
+                continue
+            if rules.ignored(entry.path, entry.name, is_dir):
+                continue
+            (subdirs if is_dir else files).append(entry.name)
+        return files, subdirs
+
+    def publish(self):
+        paths = [os.path.join(rel, name) for rel, entry in self.dirs.items() for name in entry[1]]
+        # sorted by name and then (the sort is stable) by length, both keys are builtins
+        paths.sort()
+        paths.sort(key=len)
+        lowered = list(map(str.lower, paths))
+        original = dict(zip(lowered, paths))
+        if len(original) < len(paths):
+            # names that only differ in case, both have to be shown
+            original = {}
+            for low, path in zip(lowered, paths):
+                original.setdefault(low, []).append(path)
+            lowered = list(original)
+        # replaced in one go, the main loop may be reading the old one
+        self.table = (lowered, original, len(paths))
+
+
+class PathMatcher(object):
+    """Ranks the paths of an index against a query"""
+
+    def __init__(self, table=([], {}, 0)):
+        self.set_table(table)
+
+    def set_table(self, table):
+        self.table = table
+        # (query, the paths that match it) for the query and the ones before it,
+        # so typing another letter or taking one back doesn't start from scratch
+        self.history = []
+
+    def __len__(self):
+        return self.table[2]
+
+    def candidates(self, query, stale=never):
+        # the lowered paths that have the letters of query in order
+        while self.history and not query.startswith(self.history[-1][0]):
+            self.history.pop()
+        if self.history and self.history[-1][0] == query:
+            return self.history[-1][1]
+        done, paths = self.history[-1] if self.history else ('', self.table[0])
+        # the letters that are new have to be somewhere in the path, checking that
+        # is much quicker than the regex, which then only has to check their order
+        for ch in set(query[len(done):]):
+            paths = list(chunked(re.compile(re.escape(ch)).search, paths, stale))
+        if len(query) > 1:
+            paths = list(chunked(re.compile(subsequence(query)).search, paths, stale))
+        self.history.append((query, paths))
+        return paths
+
+    def match(self, query, limit=100, stale=never):
+        # the best paths for the query, at most limit of them, and how many matched
+        # in all. Raises MatchCancelled as soon as stale() is true
+        query = query.lower()
+        lowered = self.candidates(query, stale) if query else self.table[0]
+        if query:
+            escaped = re.escape(query)
+            # a regex that starts with the query is much quicker than one that
+            # starts with (^|/), so the names that start with it are picked out
+            # of the ones that contain it
+            in_name = name_pattern(escaped)
+            tiers = (
+                filter(name_pattern('(?:^|%s)%s' % (SEP, escaped)), chunked(in_name, lowered, stale)),
+                chunked(in_name, lowered, stale),
+                chunked(re.compile(escaped).search, lowered, stale),
+                chunked(name_pattern(subsequence(query, SEP)), lowered, stale),
+                lowered,
+            )
+        else:
+            tiers = (lowered,)
+        results = []
+        seen = set()
+        original = self.table[1]
+        for low in itertools.chain.from_iterable(tiers):
+            if low in seen:
+                continue
+            seen.add(low)
+            path = original[low]
+            results.extend(path if isinstance(path, list) else (path,))
+            if len(results) >= limit:
+                break
+        return results[:limit], len(lowered)
+
+
+class MatchWorker(object):
+    """Runs a PathMatcher on a background thread, always for the newest query"""
+
+    def __init__(self, pipe):
+        self.matcher = PathMatcher() # only used by the thread
+        self.pipe = pipe
+        self.job = None # (table, query, limit) waiting to be matched
+        self.result = None # (query, paths, count) of the last match that finished
+        self.lock = threading.Condition()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, table, query, limit):
+        with self.lock:
+            self.job = (table, query, limit)
+            self.lock.notify_all()
+
+    def stale(self):
+        # a newer query came in, so the one being matched isn't wanted any more
+        return self.job is not None
+
+    def run(self):
+        while True:
+            with self.lock:
+                while self.job is None:
+                    self.lock.wait()
+                (table, query, limit), self.job = self.job, None
+            if table is not self.matcher.table:
+                self.matcher.set_table(table)
+            try:
+                paths, count = self.matcher.match(query, limit, self.stale)
+            except MatchCancelled:
+                continue
+            with self.lock:
+                self.result = (query, paths, count)
+                self.lock.notify_all()
+            os.write(self.pipe, b'.')
+
+    def wait(self, query):
+        # block until query was matched and return its result
+        with self.lock:
+            while self.result is None or self.result[0] != query:
+                self.lock.wait()
+            return self.result
+
+
+class PathItem(urwid.Text):
+    def selectable(self):
+        return True
+
+    def keypress(self, size, key):
+        return key
+
+
+class QuickOpen(urwid.WidgetWrap):
+    """The quick open palette, the query on top and the paths that match it below"""
+
+    limit = 200 # paths listed at once
+
+    def __init__(self, display, root):
+        self.display = display
+        self.root = root
+        self.index = PathIndex(root)
+        self.table = self.index.table # the paths the query is matched against
+        self.worker = MatchWorker(display.loop.watch_pipe(self.match_done))
+        self.edit = urwid.Edit('open: ')
+        self.walker = urwid.SimpleFocusListWalker([])
+        self.results = urwid.ListBox(self.walker)
+        self.status = urwid.Text('')
+        self.shown = None # the query the list shows the paths for
+        self.count = 0
+        frame = urwid.Frame(self.results, header=urwid.AttrMap(self.edit, 'footer'),
+                            footer=urwid.AttrMap(self.status, 'footer'))
+        self.__super.__init__(frame)
+
+    def start(self):
+        # called when quick open is shown, the index is brought up to date while typing
+        self.edit.set_edit_text('')
+        if not self.index.indexing:
+            self.index.refresh(self.display.loop.watch_pipe(self.index_done))
+        self.update()
+
+    def index_done(self, data):
+        # runs in the main loop whenever the index has new paths
+        indexing = self.index.indexing
+        if self.index.table is not self.table:
+            self.table = self.index.table
+            self.update()
+        else:
+            self.update_status()
+        return indexing
+
+    def update(self):
+        # the list is filled in by match_done once the worker matched the query
+        self.worker.submit(self.table, self.edit.edit_text, self.limit)
+
+    def match_done(self, data):
+        # runs in the main loop whenever the worker finished a match
+        self.show(self.worker.result)
+        return True
+
+    def show(self, result):
+        query, paths, self.count = result
+        self.shown = query
+        self.walker[:] = [urwid.AttrMap(PathItem(path, wrap='clip'), None, 'focus') for path in paths]
+        if paths:
+            self.walker.set_focus(0)
+        self.update_status()
+
+    def update_status(self):
+        text = '%d of %d files in %s' % (self.count, self.table[2], self.root)
+        if self.index.indexing:
+            text += ' (indexing...)'
+        self.status.set_text(text)
+
+    def selected(self):
+        if not self.walker:
+            return None
+        return os.path.join(self.root, self.walker.get_focus()[0].original_widget.text)
+
+    def keypress(self, size, key):
+        if key in ('up', 'down', 'page up', 'page down'):
+            return self.__super.keypress(size, key)
+        if key == 'esc':
+            self.display.close_quick_open()
+        elif key == 'enter':
+            # typed faster than the paths could be matched, enter picks from the right ones
+            if self.shown != self.edit.edit_text:
+                self.show(self.worker.wait(self.edit.edit_text))
+            path = self.selected()
+            if path is not None:
+                self.display.close_quick_open(path)
+        else:
+            old = self.edit.edit_text
+            key = self.edit.keypress((size[0],), key)
+            if self.edit.edit_text != old:
+                self.update()
+            # anything else would act on the editor underneath (the find footer
+            # over the palette, the editing keys on the text of the tab), only
+            # leaving the editor altogether still gets through
+            if key == 'ctrl x':
+                return key
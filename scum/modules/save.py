@@ -0,0 +1,149 @@
+import os
+import shutil
+import threading
+
+# files are never written in place. The text goes to a temporary file next to
+# the real one, which is flushed all the way to the disk and then renamed over
+# the old file, so a crash or a full disk halfway through a save leaves the old
+# file as it was instead of an empty or half written one:
+#
+#   lines -> file.txt.scum~  (chunks of about a megabyte, then fsync)
+#         -> os.replace(file.txt.scum~, file.txt)
+#
+# big files are saved on a background thread (see FileSave) so the editor
+# keeps running, it reports how far it got over a pipe like the highlight
+# worker does.
+
+
+class SaveCancelled(Exception):
+    pass
+
+
+def saved_lines(lines, strip, changed):
+    # the lines the way they go in the file (tabs expanded, trailing whitespace
+    # stripped), the ones that come out different are added to changed as
+    # (index, text) so the buffer can be made to match the file afterwards
+    for i, line in enumerate(lines):
+        text = line.expandtabs(4) if '\t' in line else line
+        if strip:
+            text = text.rstrip()
+        if text != line:
+            changed.append((i, text))
+        yield text
+
+
+def write_lines(fname, lines, strip=True, progress=None, cancelled=None, chunk_size=1024 * 1024):
+    # write the lines to fname through a temporary file, progress is called with
+    # the number of lines written so far after every chunk
+    temp = fname + '.scum~'
+    count = 0
+    try:
+        with open(temp, 'w', encoding='utf-8', errors='surrogateescape') as f:
+            chunk = []
+            size = 0
+            for line in lines:
+                if strip:
+                    line = line.rstrip()
+                chunk.append(line)
+                size += len(line) + 1
+                if size >= chunk_size:
+                    chunk.append('')
+                    f.write('\n'.join(chunk))
+                    count += len(chunk) - 1
+                    chunk = []
+                    size = 0
+                    if cancelled is not None and cancelled.is_set():
+                        raise SaveCancelled()
+                    if progress is not None:
+                        progress(count)
+            if chunk:
+                chunk.append('')
+                f.write('\n'.join(chunk))
+                count += len(chunk) - 1
+            f.flush()
+            os.fsync(f.fileno())
+        # keep the permissions the old file had
+        if os.path.exists(fname):
+            shutil.copymode(fname, temp)
+        os.replace(temp, fname)
+    except BaseException:
+        try:
+            os.remove(temp)
+        except OSError:
+            pass
+        raise
+    # the rename itself only survives a crash once the directory is synced too
+    try:
+        fd = os.open(os.path.dirname(os.path.abspath(fname)), os.O_RDONLY)
+    except OSError:
+        return count
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+    return count
+
+
+class FileSave(object):
+    """Saves a snapshot of a TextBuffer on a background thread"""
+
+    min_lines = 100000 # buffers smaller than this are quicker to just save right away
+
+    def __init__(self, fname, buffer, pipe, strip=True):
+        self.fname = fname
+        # the user can keep editing while this runs, so a copy of the piece
+        # table is saved instead of the buffer itself
+        self.buffer = buffer.snapshot()
+        self.pipe = pipe
+        self.strip = strip
+        self.total = len(buffer)
+        self.written = 0 # lines written so far
+        self.saving = True
+        self.error = None # the exception that stopped the save, if there was one
+        self.saved = None # the text that is in the file now, once the save is done (see TextBuffer.written)
+        self.cancelled = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        try:
+            # a memory mapped file might still be being indexed
+            if self.buffer.loading:
+                self.buffer.wait()
+                self.total = len(self.buffer)
+            changed = []
+            lines = saved_lines(self.buffer.iter_lines(), self.strip, changed)
+            write_lines(self.fname, lines, False, self.progress, self.cancelled)
+            self.saved = self.buffer.written(changed)
+            self.written = self.total
+        except SaveCancelled:
+            pass
+        except Exception as e:
+            self.error = e
+        finally:
+            self.saving = False
+            self.notify()
+            # the main loop closes its end once it sees the save is over
+            os.close(self.pipe)
+
+    def progress(self, count):
+        self.written = count
+        self.notify()
+
+    def notify(self):
+        try:
+            os.write(self.pipe, b'.')
+        except OSError:
+            pass
+
+    def percent(self):
+        if not self.total:
+            return 100
+        return min(100, self.written * 100 // self.total)
+
+    def cancel(self):
+        # stop after the chunk being written, the old file is left untouched
+        self.cancelled.set()
+        self.thread.join()
@@ -0,0 +1,247 @@
+import bisect
+import re
+from functools import lru_cache
+
+# the find bar keeps every match of the current query in a sorted list of
+# (row, col) pairs, so jumping to the next or previous match is a bisect and
+# the number of matches is just the length of the list. The whole file is only
+# scanned when a new query is started, when the query gets longer the matches
+# of the shorter query are narrowed down instead, since a longer query can
+# only match where its prefix matched:
+#
+#   "ab"   -> [(0, 4), (2, 0), (2, 7)]
+#   "abc"  -> [(2, 0)]             (only the three old matches are checked)
+#
+# a plain search is a substring test, the other modes (regex, ignore case and
+# whole word) go through a compiled pattern. Narrowing is only done for the
+# literal modes, a longer regex or whole word doesn't have to match where the
+# shorter one did.
+
+
+@lru_cache(maxsize=64)
+def compile_pattern(query, regex=False, case=True, word=False):
+    # patterns are cached by query and flags since every keypress searches again,
+    # returns None if the query isn't a valid regex
+    if not regex:
+        query = re.escape(query)
+    if word:
+        query = r'\b(?:' + query + r')\b'
+    try:
+        return re.compile(query, 0 if case else re.IGNORECASE)
+    except re.error:
+        return None
+
+
+def replacer(query, replacement, regex=False, case=True, word=False):
+    # returns a function that replaces every match in a line, or None if the
+    # query isn't a valid regex
+    if not (regex or word or not case):
+        return lambda text: text.replace(query, replacement)
+    pattern = compile_pattern(query, regex, case, word)
+    if pattern is None:
+        return None
+    if regex:
+        sub = pattern.sub
+        return lambda text: sub(replacement, text)
+    sub = pattern.sub
+    return lambda text: sub(lambda m: replacement, text)
+
+
+def replace_match(text, col, query, replacement, regex=False, case=True, word=False):
+    # replace the one match that starts at col, returns the new text and the
+    # column the replacement ends at, or None if there is no match there
+    if not (regex or word or not case):
+        if not query or not text.startswith(query, col):
+            return None
+        end, new = col + len(query), replacement
+    else:
+        pattern = compile_pattern(query, regex, case, word)
+        m = None if pattern is None else pattern.match(text, col)
+        if m is None or m.end() == m.start():
+            return None
+        end = m.end()
+        try:
+            new = m.expand(replacement) if regex else replacement
+        except re.error:
+            return None
+    return text[:col] + new + text[end:], col + len(new)
+
+
+def replace_lines(lines, query, replacement, regex=False, case=True, word=False):
+    # one pass over the lines, returns (row, old text, new text) for every line that changes
+    replace = replacer(query, replacement, regex, case, word)
+    if replace is None or not query:
+        return []
+    plain = not (regex or word or not case)
+    pattern = compile_pattern(query, regex, case, word)
+    changes = []
+    try:
+        for row, text in enumerate(lines):
+            # checking for a match first is a lot cheaper than replacing in every line
+            if plain:
+                if query not in text:
+                    continue
+            elif pattern.search(text) is None:
+                continue
+            new = replace(text)
+            if new != text:
+                changes.append((row, text, new))
+    except re.error: # a bad group reference in the replacement
+        return []
+    return changes
+
+
+class SearchIndex(object):
+    """All the matches of a query in the lines of one file"""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.lines = None
+        self.options = None
+        self.query = ''
+        self.matches = []
+        self.rows = 0 # how many lines were searched, a big file can get longer (see extend)
+        # (query, matches) of the shorter queries typed so far, used on backspace
+        self.stack = []
+
+    def __len__(self):
+        return len(self.matches)
+
+    def search(self, lines, query, regex=False, case=True, word=False):
+        # lines is a LineWalker, anything with iter_text() and get_text(row) works
+        options = (regex, case, word)
+        if lines is not self.lines or options != self.options:
+            self.reset()
+            self.lines = lines
+            self.options = options
+
+        # go back to the results of a shorter query if the new one doesn't extend it
+        while self.query and not query.startswith(self.query):
+            self.query, self.matches = self.stack.pop() if self.stack else ('', [])
+
+        if query == self.query:
+            return self.matches
+
+        if self.query and not (regex or word):
+            self.stack.append((self.query, self.matches))
+            self.matches = self.narrow(query)
+        elif regex or word or not case:
+            self.matches = self.scan_pattern(compile_pattern(query, regex, case, word))
+        else:
+            self.matches = self.scan(query)
+        self.query = query
+        self.rows = len(lines)
+        return self.matches
+
+    def extend(self):
+        # the file got longer while it was being indexed, only the new lines are searched
+        if self.lines is None or not self.query or len(self.lines) <= self.rows:
+            return
+        regex, case, word = self.options
+        if regex or word or not case:
+            self.matches += self.scan_pattern(compile_pattern(self.query, regex, case, word), self.rows)
+        else:
+            self.matches += self.scan(self.query, self.rows)
+        self.rows = len(self.lines)
+        # the results of the shorter queries only cover the lines there were before
+        self.stack = []
+
+    def scan(self, query, start=0):
+        # one pass over the file, overlapping matches are kept so narrowing is exact
+        matches = []
+        append = matches.append
+        for row, text in enumerate(self.lines.iter_text(start), start):
+            if query not in text:
+                continue
+            col = text.find(query)
+            while col != -1:
+                append((row, col))
+                col = text.find(query, col + 1)
+        return matches
+
+    def scan_pattern(self, pattern, start=0):
+        matches = []
+        if pattern is None:
+            return matches
+        search = pattern.search
+        for row, text in enumerate(self.lines.iter_text(start), start):
+            if search(text) is not None:
+                matches.extend(self._match_line(pattern, text, row))
+        return matches
+
+    def narrow(self, query):
+        # when most lines matched it is quicker to just scan the file again
+        regex, case, word = self.options
+        if len(self.matches) > len(self.lines) // 4:
+            if case:
+                return self.scan(query)
+            return self.scan_pattern(compile_pattern(query, regex, case, word))
+        if case:
+            match = lambda text, col: text.startswith(query, col)
+        else:
+            match = compile_pattern(query, regex, case, word).match
+        matches = []
+        last = -1
+        for row, col in self.matches:
+            if row != last:
+                text = self.lines.get_text(row)
+                last = row
+            if match(text, col):
+                matches.append((row, col))
+        return matches
+
+    def rescan(self, row):
+        # a single line changed (replace next), so only its matches are found again
+        if self.lines is None or not self.query:
+            return
+        regex, case, word = self.options
+        lo = bisect.bisect_left(self.matches, (row, -1))
+        hi = bisect.bisect_left(self.matches, (row + 1, -1))
+        text = self.lines.get_text(row)
+        if regex or word or not case:
+            found = self._match_line(compile_pattern(self.query, regex, case, word), text, row)
+        else:
+            found = []
+            col = text.find(self.query)
+            while col != -1:
+                found.append((row, col))
+                col = text.find(self.query, col + 1)
+        self.matches[lo:hi] = found
+        # the results of the shorter queries don't know about the change
+        self.stack = []
+
+    def _match_line(self, pattern, text, row):
+        found = []
+        if pattern is None:
+            return found
+        # literal patterns keep overlapping matches like scan does, regexes don't
+        step = not self.options[0]
+        m = pattern.search(text)
+        while m is not None:
+            if m.end() > m.start(): # a regex like a* matches nothing everywhere
+                found.append((row, m.start()))
+            pos = m.start() + 1 if step else max(m.end(), m.start() + 1)
+            if pos > len(text):
+                break
+            m = pattern.search(text, pos)
+        return found
+
+    def next(self, pos):
+        # the index of the first match after pos, wrapping around to the top
+        if not self.matches:
+            return -1
+        return bisect.bisect_right(self.matches, pos) % len(self.matches)
+
+    def prev(self, pos):
+        # the index of the last match before pos, wrapping around to the bottom
+        if not self.matches:
+            return -1
+        return (bisect.bisect_left(self.matches, pos) - 1) % len(self.matches)
+
+    def find(self, pos):
+        # the index of the first match at or after pos
+        if not self.matches:
+            return -1
+        return bisect.bisect_left(self.matches, pos) % len(self.matches)
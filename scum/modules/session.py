@@ -0,0 +1,245 @@
+import json
+import os
+import threading
+
+from .save import write_lines
+
+# the open tabs are kept in a journal in the user's state directory instead of
+# a data file inside the package. Every change is appended to the end as one
+# line of json, nothing is ever rewritten in place, so a crash at any point
+# loses at most the last line (which is skipped when it can't be read):
+#
+#   {"op": "open", "path": "/home/me/a.py"}
+#   {"op": "cursor", "path": "/home/me/a.py", "row": 40, "col": 8}
+#   {"op": "edits", "path": "/home/me/a.py", "base": [2311, 1690000000], "pieces": [[0, 12], ["new line"], [13, 80]]}
+#   {"op": "lines", "path": "/home/me/a.py", "edits": [[12, 1, ["new line!"]], [40, 0, ["x = 1"]]]}
+#   {"op": "focus", "path": "/home/me/a.py"}
+#   {"op": "close", "path": "/home/me/a.py"}
+#
+# reading the journal from the top gives the last session. "edits" are the
+# unsaved changes of a tab in the form of its piece table, runs of lines kept
+# from the file are [start, count] and the lines that were typed are written
+# out. They only apply as long as the file still has the size and modification
+# time in "base". Writing the whole piece table every time would mean writing
+# out every added line again after each key, so once a tab has "edits" only the
+# edits made since are appended, as "lines" records of [line, count, lines]
+# (see TextBuffer.log). Once the journal gets long it is compacted, which means
+# it is replaced by a fresh one holding only the current state, with the piece
+# table of every tab written out in full again.
+
+
+def state_dir():
+    base = os.environ.get('XDG_STATE_HOME') or os.path.join(os.path.expanduser('~'), '.local', 'state')
+    return os.path.join(base, 'scum')
+
+
+def file_base(fname):
+    # what a file looked like when it was read, used to tell if it changed since
+    try:
+        st = os.stat(fname)
+    except OSError:
+        return None
+    return [st.st_size, st.st_mtime_ns]
+
+
+class SessionTab(object):
+    def __init__(self, path):
+        self.path = path
+        self.cursor = (0, 0)
+        self.base = None
+        self.pieces = None # the unsaved edits, or None if there aren't any
+        self.lines = [] # the edits made after pieces, see TextBuffer.replay
+
+
+class TabPrefetch(object):
+    """Reads the file of a placeholder tab on a background thread"""
+
+    def __init__(self, tab, read, pipe):
+        self.tab = tab
+        self.read = read # tab -> (buffer, base) or None, must not touch the display
+        self.pipe = pipe
+        self.loaded = None # what read returned, once the thread is done
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        try:
+            self.loaded = self.read(self.tab)
+        finally:
+            try:
+                os.write(self.pipe, b'.')
+            except OSError:
+                pass
+            # the main loop closes its end once it picked up the tab
+            os.close(self.pipe)
+
+
+class Session(object):
+    """The append only journal of the open tabs"""
+
+    compact_after = 1000 # records appended before the journal is compacted
+    compact_size = 4 * 1024 * 1024 # or bytes, edits of big files can make long records
+
+    def __init__(self, path):
+        self.path = path
+        self.tabs = {} # path -> SessionTab, in the order they were opened
+        self.active = None
+        self.layout = False
+        self.records = 0
+        self.size = 0
+        self.compacted = 0 # the size right after the last compaction
+        self.file = None
+        # path -> (base, pieces) of a tab as it is now, or None if it isn't known.
+        # Compacting uses it to write the whole piece table instead of the records
+        self.dump = None
+
+    def load(self):
+        # replay the journal, returns False if there wasn't one
+        try:
+            with open(self.path, errors='replace') as f:
+                text = f.read()
+        except OSError:
+            return False
+        lines = text.split('\n')
+        for line in lines:
+            try:
+                self.apply(json.loads(line))
+            except (ValueError, KeyError, TypeError):
+                continue # a line cut short by a crash
+        self.records = len(lines)
+        self.size = len(text)
+        if text and not text.endswith('\n'):
+            # the last record was cut short, appending to it would glue the next
+            # record onto the torn one and lose both
+            self.compact()
+        return True
+
+    def apply(self, record):
+        op = record['op']
+        if op == 'layout':
+            self.layout = bool(record['value'])
+            return
+        path = record['path']
+        if op == 'open':
+            self.tabs.setdefault(path, SessionTab(path))
+        elif op == 'close':
+            self.tabs.pop(path, None)
+            if self.active == path:
+                self.active = None
+        elif path in self.tabs:
+            tab = self.tabs[path]
+            if op == 'focus':
+                self.active = path
+            elif op == 'cursor':
+                tab.cursor = (record['row'], record['col'])
+            elif op == 'edits':
+                tab.base = record['base']
+                tab.pieces = record['pieces']
+                tab.lines = []
+            elif op == 'lines':
+                if tab.pieces is not None:
+                    tab.lines.extend(record['edits'])
+            elif op == 'saved':
+                tab.base = None
+                tab.pieces = None
+                tab.lines = []
+
+    def write(self, record):
+        self.apply(record)
+        if self.file is None:
+            try:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                self.file = open(self.path, 'a')
+            except OSError:
+                return # nowhere to keep the session, the editor works without it
+        line = json.dumps(record, separators=(',', ':')) + '\n'
+        self.file.write(line)
+        self.records += 1
+        self.size += len(line)
+
+    def open(self, path):
+        if path not in self.tabs:
+            self.write({'op': 'open', 'path': path})
+
+    def close(self, path):
+        self.write({'op': 'close', 'path': path})
+
+    def focus(self, path):
+        if path in self.tabs and path != self.active:
+            self.write({'op': 'focus', 'path': path})
+
+    def cursor(self, path, row, col):
+        tab = self.tabs.get(path)
+        if tab is not None and tab.cursor != (row, col):
+            self.write({'op': 'cursor', 'path': path, 'row': row, 'col': col})
+
+    def edits(self, path, base, pieces):
+        if path in self.tabs:
+            self.write({'op': 'edits', 'path': path, 'base': base, 'pieces': pieces})
+
+    def lines(self, path, edits):
+        # edits made after the last "edits" of the tab, returns False if there isn't one
+        tab = self.tabs.get(path)
+        if tab is None or tab.pieces is None:
+            return False
+        self.write({'op': 'lines', 'path': path, 'edits': edits})
+        return True
+
+    def saved(self, path):
+        tab = self.tabs.get(path)
+        if tab is not None and tab.pieces is not None:
+            self.write({'op': 'saved', 'path': path})
+
+    def set_layout(self, layout):
+        if layout != self.layout:
+            self.write({'op': 'layout', 'value': layout})
+
+    def sync(self):
+        # make what was written so far survive a crash, compacting when it got long
+        if self.file is None:
+            return
+        # the whole state can be bigger than compact_size, so the journal has to have
+        # grown to twice that size before compacting it again does any good
+        if self.records >= self.compact_after or self.size >= max(self.compact_size, 2 * self.compacted):
+            self.compact()
+            return
+        try:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+        except OSError:
+            pass
+
+    def snapshot(self):
+        # the records that rebuild the current state
+        records = [{'op': 'layout', 'value': self.layout}]
+        for tab in self.tabs.values():
+            records.append({'op': 'open', 'path': tab.path})
+            row, col = tab.cursor
+            records.append({'op': 'cursor', 'path': tab.path, 'row': row, 'col': col})
+            if tab.pieces is not None:
+                dumped = self.dump(tab.path) if self.dump is not None else None
+                if dumped is not None:
+                    tab.base, tab.pieces = dumped
+                    tab.lines = []
+                records.append({'op': 'edits', 'path': tab.path, 'base': tab.base, 'pieces': tab.pieces})
+                if tab.lines:
+                    records.append({'op': 'lines', 'path': tab.path, 'edits': tab.lines})
+        if self.active is not None:
+            records.append({'op': 'focus', 'path': self.active})
+        return records
+
+    def compact(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        records = self.snapshot()
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            write_lines(self.path, (json.dumps(r, separators=(',', ':')) for r in records), strip=False)
+        except OSError:
+            return
+        self.records = len(records)
+        self.size = self.compacted = os.path.getsize(self.path)
+
+    def close_journal(self):
+        self.compact()
@@ -0,0 +1,28 @@
+import time
+
+# scum --profile-startup times each step of starting up and prints them once
+# the editor is closed:
+#
+#   imports          61.2 ms
+#   config            2.0 ms
+#   ...
+#   total           103.5 ms
+
+
+class StartupTimer(object):
+    """Times the phases of start up, each mark ends the phase before it"""
+
+    def __init__(self, start=None):
+        self.start = time.perf_counter() if start is None else start
+        self.last = self.start
+        self.phases = [] # (name, seconds)
+
+    def mark(self, name):
+        now = time.perf_counter()
+        self.phases.append((name, now - self.last))
+        self.last = now
+
+    def report(self):
+        lines = ['%-14s %8.1f ms' % (name, took * 1000) for name, took in self.phases]
+        lines.append('%-14s %8.1f ms' % ('total', (self.last - self.start) * 1000))
+        return '\n'.join(lines)
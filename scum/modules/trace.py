@@ -0,0 +1,135 @@
+import collections
+import json
+import time
+
+from .save import write_lines
+
+# the frame tracer times what the main loop does between a key coming in and
+# the screen being written out. While it is on, the methods of each phase are
+# wrapped with a timer, and while it is off they are put back, so it costs
+# nothing unless it is being used:
+#
+#   input        loop.process_input, every keypress handler runs inside it
+#   highlight    Highlighter.get_attribs and the highlight worker's results
+#   line numbers MainGUI.update_line_numbers and drawing the gutter
+#   render       loop.draw_screen, the widgets being rendered and written out
+#   flush        the part of render that writes to the terminal
+#
+# a frame starts with the first phase after the last frame was drawn and ends
+# when the screen has been written. Every phase is kept as a trace event in
+# the Chrome trace format, which chrome://tracing and Perfetto can open:
+#
+#   {"traceEvents": [{"name": "render", "ph": "X", "ts": 1520.3, "dur": 812.0, "pid": 1, "tid": 1}, ...]}
+#
+# counters (like the bytes written to the terminal) are read at the end of
+# every frame and kept as counter events:
+#
+#   {"name": "tty bytes", "ph": "C", "ts": 2332.3, "pid": 1, "args": {"tty bytes": 812}}
+
+PHASES = ('input', 'highlight', 'line numbers', 'render', 'flush')
+
+
+class FrameTracer(object):
+    """Times the phases of every frame while it's on"""
+
+    max_events = 100000 # the oldest events are dropped after this many
+    window = 100 # frames the average and the worst time are taken over
+
+    def __init__(self, on_frame=None):
+        self.on_frame = on_frame # called with the time of each phase of a frame when it is done
+        self.enabled = False
+        self.patched = [] # (object, name, whether it had its own attribute, the attribute)
+        self.events = collections.deque(maxlen=self.max_events)
+        self.recent = collections.deque(maxlen=self.window) # frame times
+        self.active = set() # phases being timed right now, so nested calls are only counted once
+        self.start = time.perf_counter()
+        self.frame_start = None
+        self.phases = {}
+        self.counters = {} # name -> function returning how much of it the last frame used
+
+    def wrap(self, owner, name, phase):
+        # time every call of owner.name as phase, owner is a class or a single object
+        attrs = vars(owner)
+        had = name in attrs
+        old = attrs.get(name)
+        func = old if isinstance(owner, type) else getattr(owner, name)
+        tracer = self
+
+        def timed(*args, **kwargs):
+            if phase in tracer.active:
+                return func(*args, **kwargs)
+            tracer.begin(phase)
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                tracer.end(phase, start)
+
+        setattr(owner, name, timed)
+        self.patched.append((owner, name, had, old))
+
+    def enable(self, targets):
+        # targets is a list of (object, method name, phase)
+        if self.enabled:
+            return
+        for owner, name, phase in targets:
+            self.wrap(owner, name, phase)
+        self.enabled = True
+
+    def disable(self):
+        for owner, name, had, old in reversed(self.patched):
+            if had:
+                setattr(owner, name, old)
+            else:
+                delattr(owner, name)
+        self.patched = []
+        self.active = set()
+        self.frame_start = None
+        self.enabled = False
+
+    def begin(self, phase):
+        self.active.add(phase)
+        if self.frame_start is None:
+            self.frame_start = time.perf_counter()
+            self.phases = {}
+
+    def end(self, phase, start):
+        now = time.perf_counter()
+        self.active.discard(phase)
+        self.phases[phase] = self.phases.get(phase, 0) + now - start
+        self.add_event(phase, start, now)
+        if phase == 'render' and self.frame_start is not None:
+            self.add_event('frame', self.frame_start, now)
+            self.recent.append(now - self.frame_start)
+            phases = self.phases
+            phases['frame'] = now - self.frame_start
+            self.frame_start = None
+            for name, take in self.counters.items():
+                phases[name] = take()
+                self.events.append({'name': name, 'ph': 'C', 'pid': 1,
+                                    'ts': round((now - self.start) * 1e6, 1),
+                                    'args': {name: phases[name]}})
+            if self.on_frame is not None:
+                self.on_frame(phases)
+
+    def add_event(self, name, start, end):
+        self.events.append({'name': name, 'ph': 'X', 'pid': 1, 'tid': 1,
+                            'ts': round((start - self.start) * 1e6, 1),
+                            'dur': round((end - start) * 1e6, 1)})
+
+    def summary(self, phases):
+        # one line for the status bar, times in milliseconds. The frame time and the
+        # counters come first, the line is cut off on narrow terminals
+        parts = ['frame %.1f ms' % (phases['frame'] * 1000)]
+        parts += ['%s %d' % (name, phases[name]) for name in self.counters if name in phases]
+        for phase in PHASES:
+            if phase in phases:
+                parts.append('%s %.1f' % (phase, phases[phase] * 1000))
+        if self.recent:
+            parts.append('avg %.1f max %.1f' % (sum(self.recent) * 1000 / len(self.recent),
+                                               max(self.recent) * 1000))
+        return '  '.join(parts) + ' ms'
+
+    def write(self, fname):
+        trace = {'traceEvents': list(self.events), 'displayTimeUnit': 'ms'}
+        write_lines(fname, [json.dumps(trace)], strip=False)
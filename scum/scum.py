@@ -1,22 +1,34 @@
 #!/usr/bin/env python
 
-# from scum.main import MainGUI, START_PATH, TABS_PATH
-from main import MainGUI, START_PATH, TABS_PATH
+import time
+START = time.perf_counter() # for --profile-startup, before the slow imports
+
+# from scum.main import MainGUI, StartupTimer
+from main import MainGUI, StartupTimer
 import os
 import signal
+import sys
 
 def main():
+    args = sys.argv[1:]
+    profile = None
+    if '--profile-startup' in args:
+        profile = StartupTimer(START)
+        profile.mark('imports')
+    # --trace FILE times every frame and writes them to FILE on exit
+    trace = None
+    if '--trace' in args and args.index('--trace') + 1 < len(args):
+        trace = args[args.index('--trace') + 1]
     os.system('stty -ixon') # disable XOFF to accept Ctrl-S
     # instantiate it!
-    main = MainGUI()
+    main = MainGUI(profile, trace)
     signal.signal(signal.SIGTSTP, signal.SIG_IGN)
     signal.signal(signal.SIGINT, signal.SIG_IGN)
-    status = main.display()
+    # the open tabs are kept in the session journal even if this fails
+    main.display()
     os.system('stty ixon') # re-enable XOFF!
-    if status == 'failure':
-        with open(TABS_PATH, 'w') as f:
-            f.write(START_PATH + '\n')
-            f.write('False')
+    if profile is not None:
+        print(profile.report())
 
 if __name__=="__main__":
        main()